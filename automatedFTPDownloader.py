@@ -30,11 +30,45 @@ Parameters/Options:
         |                       - Default in %USERPROFILE%/Downloads on Windows
         |                       - Default in $HOME on Linux
     -p  | --preserve        : (Force-disabled right now) Do not delete older files that start with 'SureDone_' in the download directory
-        |                       - This funciton is limited to default download locations only.
+        |                       - This funciton is limited to default download locations only, and doesn't look into subdirectories.
         |                       - Defining custom output path will render this feature useless.
+        | --log-format      : 'text' (default) or 'json' to write the log file as one JSON object per line
+        | --log-level       : Lowest severity to log: debug, normal (default), warning, error or code-breaker
+        |                       - Can be set per module or function, e.g. 'warning,automatedFTPDownloader.downloadFile=debug'
+        |                       - Line numbers are only logged when debug is enabled somewhere
+        | --report          : Write a JSON report of the run (timings of every connect, login, listing, transfer and extraction) to this file
+        | --prometheus      : Write the per-site metrics of the run to this file in the Prometheus textfile format
+    -r  | --recursive       : Mirror the whole directory tree under each site's remote path into the output directory
+        |                       - Without it only the files directly in the remote path are downloaded
+        |                       - Can also be enabled per site with 'recursive: true' in the YAML file
     -s  | --site            : A specific site in the YAML file that should be targetted to connect and download files from
     -u  | --unzip           : If provided, all the .zip and .tar files downloaded from FTP sites will be unzipped in the root folder as well
+        |                       - Archives are extracted in background processes as soon as they finish downloading
+        |                       - The members of large zip files are shared between the processes
+        |                       - Members already extracted and unchanged are skipped (size and CRC for zip, size and modify time for tar)
+        |                       - .gz, .bz2 and .xz files are decompressed next to themselves
     -v  | --verbose         : Show outputs in terminal as well as the log file
+    -w  | --workers         : Number of FTP sites to download from concurrently (default: 1, one site after another)
+        |                       - Each site gets its own worker, a slow or hung site does not hold up the rest
+    -e  | --engine          : Transfer engine, 'thread' (default) or 'async'
+        |                       - 'thread' uses one thread per FTP connection
+        |                       - 'async' runs every connection of every site on a single asyncio event loop
+        |                       - FTPS sites ('tls: true') need Python 3.11 or higher on the 'async' engine
+    -d  | --daemon          : Keep running and poll every site for new and changed files, instead of downloading once
+        |                       - Sessions stay logged in between polls, kept alive with NOOP ('keepalive' seconds per site, default 60)
+        |                       - Edits of the YAML file are picked up without a restart
+        |                       - Stop it with Ctrl+C or SIGTERM
+        | --interval        : Seconds between two polls of a site in daemon mode (default: 300)
+        |                       - Can be set per site with 'poll_interval' in the YAML file
+        | --plan            : Connect, list and filter every site, then print what a run would transfer without downloading anything
+        |                       - Per site: files and bytes to transfer, unchanged files skipped and an estimated duration
+        |                       - The estimate is based on the throughput of the site's previous runs
+        | --plan-json       : Same as --plan, and write the plan as JSON to this file ('-' for the standard output, instead of the table)
+        | --stats           : Print statistics of the previous runs as JSON, from the run database ('runs.sqlite' in the state directory)
+        |                       - 'slowest': the sites that took longest on average
+        |                       - 'trend': the throughput of every run of each site, or of the site given with -s
+        |                       - 'changed': the files downloaded again most often
+        | --since           : How far back --stats looks, e.g. '24h' or '30d' (default: 7d)
 
 Example:
     $ python3 automatedFTPDownloader.py
@@ -47,69 +81,345 @@ Example:
 
     $ python3 automatedFTPDownloader.py -f [config.yaml] -o [XYZFiles/today/] -s XYZ_ftp -v -p
     $ python3 automatedFTPDownloader.py -file [config.yaml] --output [XYZFiles/today/] --site XYZ_ftp --verbose --preserve
+
+    $ python3 automatedFTPDownloader.py -f [config.yaml] -w 8
+    $ python3 automatedFTPDownloader.py --file [config.yaml] --workers 8
+
+    $ python3 automatedFTPDownloader.py -f [config.yaml] -s XYZ_ftp -r
+    $ python3 automatedFTPDownloader.py --file [config.yaml] --site XYZ_ftp --recursive
+
+    $ python3 automatedFTPDownloader.py -f [config.yaml] -w 20 -e async
+    $ python3 automatedFTPDownloader.py --file [config.yaml] --workers 20 --engine async
+
+    $ python3 automatedFTPDownloader.py -f [config.yaml] -d --interval 120
+    $ python3 automatedFTPDownloader.py --file [config.yaml] --daemon --interval 120
+
+    $ python3 automatedFTPDownloader.py -f [config.yaml] --report run.json --prometheus /var/lib/node_exporter/ftp_download.prom
+
+    $ python3 automatedFTPDownloader.py -f [config.yaml] -w 8 --plan
+    $ python3 automatedFTPDownloader.py --file [config.yaml] --workers 8 --plan-json plan.json
+
+    $ python3 automatedFTPDownloader.py --stats slowest --since 7d
+    $ python3 automatedFTPDownloader.py --stats trend --site XYZ_ftp --since 30d
 """
 
 # Imports
+# Only light modules are imported here, so that importing this module (or asking for -h) is quick.
+# Heavy ones are imported by the functions that need them, or through LazyModule when they are used all over.
 import sys
 import os
-from ftplib import FTP
-import getopt
-import platform
-import re
-import yaml
-import inspect
+import zlib
+import contextlib
+import functools
+import importlib
+import posixpath
+import atexit
+import signal
 import time
-import traceback
+import threading
+import queue
 from os.path import expanduser
 from datetime import datetime
-import zipfile
-from zipfile import ZipFile
-import tarfile
-from tarfile import TarFile
+from collections import namedtuple
+
+class LazyModule(object):
+    """ Stands in for a module that is only imported the first time one of its attributes is used. """
+    def __init__(self, moduleName):
+        self.__dict__['_moduleName'] = moduleName
+
+    def __getattr__(self, attribute):
+        return getattr(importlib.import_module(self._moduleName), attribute)
+
+json = LazyModule('json')
+re = LazyModule('re')
+ftplib = LazyModule('ftplib')
+asyncio = LazyModule('asyncio')
+ssl = LazyModule('ssl')
+sqlite3 = LazyModule('sqlite3')
 
 currentMilliTime = lambda: int(round(time.time() * 1000))
 
-START_TIME = datetime.now()
-RUN_TIME = currentMilliTime()
+# Set by main() when the run starts
+START_TIME = None
+RUN_TIME = None
+
+# Seconds a control or data connection may block before the site is given up on
+DEFAULT_TIMEOUT = 60
+# Times an operation failing with a transient error (timeout, dropped connection, 4xx reply) is retried,
+# on a fresh connection, before it is given up on. Set per site with 'retries'.
+DEFAULT_RETRIES = 2
+# Seconds waited before the first retry, doubled for every further one up to the maximum, with jitter.
+# Set per site with 'retry_delay' and 'retry_max_delay'.
+DEFAULT_RETRY_DELAY = 1.0
+DEFAULT_RETRY_MAX_DELAY = 60.0
+
+# Bytes received from a data connection before they are written out, set per site with 'block_size'
+DEFAULT_BLOCK_SIZE = 1048576
+
+# Whether files are transferred deflated with MODE Z: 'auto' if the server lists it in FEAT, 'on' or 'off'.
+# Set per site with 'mode_z'.
+DEFAULT_MODE_Z = 'auto'
+
+# Hash computed on every download as it is received, set per site with 'checksum' ('none' turns it off)
+DEFAULT_CHECKSUM = 'sha256'
+CHECKSUM_ALGORITHMS = ('sha256', 'xxhash', 'crc32', 'md5', 'sha1', 'sha512')
+
+# Seconds between two polls of a site in daemon mode, set per site with 'poll_interval'
+DEFAULT_POLL_INTERVAL = 300
+# Latest runs of a site averaged by the run database to estimate the next one
+RUN_DATABASE_RECENT_RUNS = 5
+# Queries of the run database answered by --stats, and how far back they look by default
+STATS_QUERIES = ('slowest', 'trend', 'changed')
+DEFAULT_STATS_SINCE = '7d'
+# Seconds an idle daemon session waits before a NOOP keeps it alive, set per site with 'keepalive'
+DEFAULT_KEEPALIVE = 60
+
+# Zip files larger than this are extracted by several processes, each taking a share of the members
+PARALLEL_EXTRACTION_SIZE = 64 * 1048576
+# Bytes decompressed or compared at a time while extracting
+EXTRACTION_BLOCK_SIZE = 1048576
+# Single-file compressions decompressed next to the file, by the module that reads them
+COMPRESSED_FILE_MODULES = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'lzma'}
+
+# Digests the content store keeps of every file: SHA-256 names the blob, the others are what servers hash files with
+STORE_ALGORITHMS = ('sha256', 'md5', 'crc32')
+# Commands that make the server hash a file, by preference, with the algorithm of their digest
+HASH_COMMANDS = (('HASH', 'sha256'), ('XMD5', 'md5'), ('HASH', 'md5'), ('XCRC', 'crc32'), ('HASH', 'crc32'))
+# Names of the algorithms in the HASH command
+HASH_NAMES = {'sha256': 'SHA-256', 'md5': 'MD5', 'crc32': 'CRC32'}
+
+# Formats of an absolute 'modified_since' filter, read as UTC like the listings' modify times
+MODIFIED_SINCE_FORMATS = ('%Y-%m-%d', '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y%m%d%H%M%S')
+
+# Older exports deleted from the default download directory unless -p is given
+PURGE_PREFIX = 'SureDone_'
+# Units of the durations and sizes in the config, e.g. 'max_age: 7d' or 'max_size: 20G'
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+SIZE_UNITS = {'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+# Counts and bytes summed up by the transfer plan of every site, see planSite()
+PLAN_COUNTERS = ('files', 'bytes', 'transferFiles', 'transferBytes', 'unchangedFiles', 'unchangedBytes', 'excludedFiles', 'excludedBytes', 'resumeBytes', 'unknownSizes')
+
+# Work queue priorities. Directories are listed before anything is downloaded, then the largest files go
+# first: a big file started last would drag the whole run out, small files fill the gaps on idle connections.
+LISTING_PRIORITY = (0, 0)
+# Priority of the task stopping a worker, after every other task
+STOP_PRIORITY = (float('inf'),)
+
+def getDownloadPriority(entry):
+    return (1, -(entry.size or 0))
+
+# Checksum files vendors publish next to their files, e.g. 'data.csv.sha256' for 'data.csv'
+CHECKSUM_SIDECARS = {
+    '.sha256': 'sha256',
+    '.md5': 'md5',
+    '.sha1': 'sha1',
+    '.sha512': 'sha512',
+    '.crc32': 'crc32',
+    '.xxh64': 'xxhash',
+}
+
 # Connects to remote ftp server using credentials from get_credentials() using a YAML file
 def main(argv):
-    localFrame = inspect.currentframe()
+    global START_TIME, RUN_TIME
+    # Help is answered before the logger or anything heavy is set up
+    if isHelpRequested(argv):
+        print (HELP_MESSAGE)
+        return
+    START_TIME = datetime.now()
+    RUN_TIME = currentMilliTime()
+    startLogging()
+
     # Parse arguments
-    ftpYAMLPath, outputDIRPath, preserveOldFiles, verbose, unzipFiles, ftpConfigs, targetFTPSite = parseArgs(argv)
+    ftpYAMLPath, outputDIRPath, preserveOldFiles, verbose, unzipFiles, ftpConfigs, targetFTPSite, runOptions = parseArgs(argv)
     # Force-enablinbg the preserve feature in order to disable purging
     preserveOldFiles = True
 
-    LOGGER.writeLog("FTP YAML path: {}".format(ftpYAMLPath), localFrame.f_lineno, severity='normal')
-    LOGGER.writeLog("Local directory: {}".format(outputDIRPath), localFrame.f_lineno, severity='normal')
-    LOGGER.writeLog("Preserve: {}".format(preserveOldFiles), localFrame.f_lineno, severity='normal')
-    LOGGER.writeLog("Verbose: {}".format(verbose), localFrame.f_lineno, severity='normal')
-    LOGGER.writeLog("Unzip files: {}".format(unzipFiles), localFrame.f_lineno, severity='normal')
+    LOGGER.writeLog("FTP YAML path: {}".format(ftpYAMLPath), severity='normal')
+    LOGGER.writeLog("Local directory: {}".format(outputDIRPath), severity='normal')
+    LOGGER.writeLog("Preserve: {}".format(preserveOldFiles), severity='normal')
+    LOGGER.writeLog("Verbose: {}".format(verbose), severity='normal')
+    LOGGER.writeLog("Unzip files: {}".format(unzipFiles), severity='normal')
+    LOGGER.writeLog("Workers: {}".format(runOptions['workers']), severity='normal')
+    LOGGER.writeLog("Recursive: {}".format(runOptions['recursive']), severity='normal')
+    LOGGER.writeLog("Engine: {}".format(runOptions['engine']), severity='normal')
+
+    if runOptions['stats']:
+        try:
+            since = time.time() - parseDuration(runOptions['since'])
+        except ValueError as sinceError:
+            LOGGER.writeLog("Invalid --since, counting every run: {}".format(sinceError), severity='warning')
+            since = None
+        writeRunStatistics(runOptions['stats'], None if targetFTPSite == '.*_.*' else targetFTPSite, since)
+        return
 
     # Iterate over all the ftp sites if target ftp site is ".*_.*"
+    allSites = targetFTPSite == '.*_.*'
     if targetFTPSite == '.*_.*':
         targetFTPSite = []
         for key in ftpConfigs.keys():
             targetFTPSite.append(key)
     else:
         targetFTPSite = [targetFTPSite]
-    LOGGER.writeLog("Target sites: {}".format(targetFTPSite), localFrame.f_lineno, severity='normal')
+    # Start the sites expected to take longest first, weighted by their priority
+    history = RunDatabase()
+    targetFTPSite = scheduleSites(targetFTPSite, ftpConfigs, history)
+    LOGGER.writeLog("Target sites: {}".format(targetFTPSite), severity='normal')
+
+    if runOptions['plan']:
+        # A dry run: nothing is downloaded and neither the manifests nor the history change
+        plan = runPlan(targetFTPSite, ftpConfigs, outputDIRPath, runOptions, history)
+        if runOptions['planJson']:
+            writePlan(plan, runOptions['planJson'])
+        if runOptions['planJson'] != '-':
+            printPlan(plan)
+        return
     
-    allFilesDownloaded = []
+    # Archives are extracted in the background while the downloads go on
+    extractor = ExtractionPipeline() if unzipFiles else None
+    if runOptions['daemon']:
+        if runOptions['engine'] == 'async':
+            LOGGER.writeLog("The daemon mode runs on the thread engine.", severity='warning')
+        runDaemon(ftpYAMLPath, ftpConfigs, None if allSites else targetFTPSite, outputDIRPath, runOptions, extractor=extractor, history=history)
+        if extractor:
+            extractor.finish()
+        DELETER.join()
+        return
+    if runOptions['engine'] == 'async':
+        allFilesDownloaded = runSitesAsync(targetFTPSite, ftpConfigs, outputDIRPath, unzipFiles, runOptions, extractor=extractor)
+    else:
+        allFilesDownloaded = runSites(targetFTPSite, ftpConfigs, outputDIRPath, unzipFiles, runOptions, extractor=extractor)
+    extractionTimings = extractor.finish() if extractor else []
+    # Old files are purged while the sites download, make sure it's done
+    DELETER.join()
+
+    history.record(METRICS, runOptions)
+    if runOptions['report']:
+        METRICS.writeReport(runOptions['report'])
+    if runOptions['prometheus']:
+        METRICS.writePrometheus(runOptions['prometheus'])
     
+    safeExit(outputDIRPath, allFilesDownloaded, marker='execution-complete', extractionTimings=extractionTimings)
+
+def scheduleSites(targetFTPSite, ftpConfigs, history):
+    """
+    Function that orders the sites so the run finishes as early as possible: the sites expected to take
+    longest start first, so the short ones fill in around them instead of a long one starting last.
+    Each site's expected duration is multiplied by its `priority` from the config (1 by default),
+    so a higher priority makes a site start earlier.
+
+    Parameters
+    ----------
+        - targetFTPSite : list
+            Names of the sites to download from
+        - ftpConfigs : dict
+            Dictionary of all the site configs loaded from the YAML file
+        - history : RunDatabase
+            Durations of the previous runs. Sites without history are assumed to be as long as the longest known one.
+
+    Returns
+    -------
+        - targetFTPSite : list
+            The same sites, in the order they should be started
+    """
+    estimates = dict((site, history.getEstimatedSeconds(site)) for site in targetFTPSite)
+    knownEstimates = [seconds for seconds in estimates.values() if seconds is not None]
+    longest = max(knownEstimates) if knownEstimates else 1.0
+
+    def getWeight(site):
+        try:
+            priority = float(ftpConfigs[site].get('priority', 1))
+        except (TypeError, ValueError):
+            LOGGER.writeLog("Invalid priority for {}. Using 1.".format(site), severity='warning')
+            priority = 1.0
+        seconds = estimates[site] if estimates[site] is not None else longest
+        return priority * seconds
+
+    # sorted() is stable, sites of the same weight keep their config order
+    return sorted(targetFTPSite, key=getWeight, reverse=True)
+
+def runSites(targetFTPSite, ftpConfigs, outputDIRPath, unzipFiles, runOptions, extractor=None):
+    """
+    Function that downloads from every target site, running up to `workers` sites at the same time.
+    Each site runs in its own worker, so a slow or failing site does not hold up the others.
+
+    Parameters
+    ----------
+        - targetFTPSite : list
+            Names of the sites in the config that need to be downloaded from
+        - ftpConfigs : dict
+            Dictionary of all the site configs loaded from the YAML file
+        - outputDIRPath : str
+            Local machine's download path
+        - unzipFiles : bool
+            Unzip the .zip and .tar files once a site has finished downloading
+        - runOptions : dict
+            Behavioral options from parseArgs(). `workers` is the number of sites to process concurrently,
+            1 processes the sites one after another.
+        - extractor : ExtractionPipeline
+            If provided, archives are handed to it as soon as they are downloaded instead of being unzipped after each site
+
+    Returns
+    -------
+        - allFilesDownloaded : list
+            Names of the files downloaded from all the sites, in the order the sites finished
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    allFilesDownloaded = []
+    workers = runOptions['workers']
+
     # Spin through the list of target sites
-    for site in targetFTPSite:
+    if workers <= 1 or len(targetFTPSite) <= 1:
+        for site in targetFTPSite:
+            allFilesDownloaded = allFilesDownloaded + processSite(ftpConfigs[site], site, outputDIRPath, unzipFiles, runOptions, extractor)
+        return allFilesDownloaded
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(targetFTPSite)), thread_name_prefix='site') as executor:
+        futures = [executor.submit(processSite, ftpConfigs[site], site, outputDIRPath, unzipFiles, runOptions, extractor) for site in targetFTPSite]
+        for future in as_completed(futures):
+            allFilesDownloaded = allFilesDownloaded + future.result()
+    return allFilesDownloaded
+
+def processSite(siteConfig, siteName, outputDIRPath, unzipFiles, runOptions=None, extractor=None):
+    """
+    Function that downloads all the files of one site and unzips them if required.
+    Any error is logged and the site is given up on, so that the remaining sites still run.
+
+    Parameters
+    ----------
+        - siteConfig : dict
+            Dictionary that contains host, name, password, and path.
+        - siteName : str
+            Name of the site in the config file
+        - outputDIRPath : str
+            Local machine's download path
+        - unzipFiles : bool
+            Unzip the .zip and .tar files after downloading
+        - runOptions : dict
+            Behavioral options from parseArgs()
+        - extractor : ExtractionPipeline
+            If provided, archives are handed to it as soon as they are downloaded
+
+    Returns
+    -------
+        - downloadedFiles : list
+            Names of the files downloaded from the site, empty if the site failed
+    """
+    runOptions = runOptions or {}
+    try:
         # Connect to FTP and download all files in the specified directory
-        downloadedFiles = connectToFTP(ftpConfigs[site], site, outputDIRPath)
+        with METRICS.span(siteName, 'site'):
+            downloadedFiles = connectToFTP(siteConfig, siteName, outputDIRPath, recursive=runOptions.get('recursive', False), extractor=extractor)
+    except Exception as siteError:
+        LOGGER.writeLog("Downloading from {} failed, skipping the site: {}".format(siteName, siteError), severity='error')
+        return []
 
-        # Unzip downloaded files if present
-        if unzipFiles:
-            unzipZippedFiles(outputDIRPath, downloadedFiles)
-        
-        allFilesDownloaded = allFilesDownloaded + downloadedFiles
-    
-    safeExit(outputDIRPath, allFilesDownloaded, marker='execution-complete')
+    # Unzip downloaded files if present
+    if unzipFiles and extractor is None:
+        unzipZippedFiles(outputDIRPath, downloadedFiles)
+    return downloadedFiles
 
-def safeExit(downloadPath, downloadedFiles, marker=''):
+def safeExit(downloadPath, downloadedFiles, marker='', extractionTimings=None):
     """
     Function that will perform a basic print job at the end of the script.
 
@@ -120,6 +430,8 @@ def safeExit(downloadPath, downloadedFiles, marker=''):
         - marker : str
             An identifier of what initiated the function.
             Currently we only have one initiator of this function, could be more later.
+        - extractionTimings : list
+            Results of ExtractionPipeline.finish(), one per extracted archive
     """
     # Get ending time
     END_TIME = datetime.now()
@@ -129,6 +441,9 @@ def safeExit(downloadPath, downloadedFiles, marker=''):
     downloadedFilesizes = []
     for f in downloadedFiles:
         file = os.path.join(downloadPath, f)
+        # Purged by a retention policy or moved away since
+        if not os.path.isfile(file):
+            continue
         size = os.path.getsize(file)
         downloadedFilesizes.append(
             {
@@ -147,182 +462,4639 @@ def safeExit(downloadPath, downloadedFiles, marker=''):
         print ("Total files downloaded: {}".format(len(downloadedFiles)))
         for file in downloadedFilesizes:
             print ("\tFilename: {}\t\tSize: {} bytes.".format(file['name'], file['size']))
+        totals = METRICS.getTotals()
+        print ("Unchanged files skipped: {}".format(totals['skippedFiles']))
+        print ("Bytes avoided: {} bytes".format(totals['skippedBytes']))
+        print ("Retries after transient errors: {}".format(totals['retries']))
+        print ("Files excluded by the filters: {} ({} bytes)".format(totals['excludedFiles'], totals['excludedBytes']))
+        print ("Files purged by retention policies: {} ({} bytes)".format(totals['purgedFiles'], totals['purgedBytes']))
+        print ("Transfers skipped as the content store had the file: {} ({} bytes)".format(totals['dedupFiles'], totals['dedupBytes']))
+        print ("Duplicate downloads stored once: {} ({} bytes)".format(totals['linkedFiles'], totals['linkedBytes']))
+        for site, summary in sorted(METRICS.getSiteSummaries().items()):
+            print ("\tSite: {}\t\tFiles: {}\t\tBytes: {}\t\tThroughput: {:.1f} KB/s\t\tErrors: {}".format(site, summary['files'], summary['bytes'], summary['throughput'] / 1024, summary['errors']))
+        if extractionTimings:
+            print ("Archives extracted: {}".format(len(extractionTimings)))
+            for timing in extractionTimings:
+                print ("\tArchive: {}\t\tMembers: {}\t\tAlready extracted: {}\t\tExtraction time: {} milliseconds.".format(timing['archive'], timing['members'], timing['skipped'], int(timing['seconds'] * 1000)))
         print ("=================================================================")
 
-def loadCredentials(ftpPath):
+def loadCredentials(ftpPath):
+    """
+    Function that parses the configuration file and reads all the ftp credentials present in the file
+
+    Parameters
+    ----------
+        - ftpPath : str
+            Path to the ftp yaml file
+    
+    Returns
+    -------
+        - ftpConfigs : dict
+            A dictionary of all FTP credentials present in the YAML path
+            Each dictionary contains the host, name, password, and path to the directory to download from
+    """
+    import yaml
+    with open(ftpPath, 'r') as stream:
+        try:
+            ftpConfigs = yaml.safe_load(stream)
+        except yaml.YAMLError as exc:
+            LOGGER.writeLog("Error while loading YAML.", severity='code-breaker', data={'code':3, 'error':exc})
+
+    # Check if each config is in proper order or lese remove the faulty configs
+    for config in list(ftpConfigs.keys()):
+        site = ftpConfigs[config]
+        # Check if all four keys are present
+        if not all(item in site.keys() for item in ['site', 'user', 'password', 'remote_path']):
+            LOGGER.writeLog("Key missing from {} site info. Removing faulty config...".format(config), severity='warning')
+            del ftpConfigs[config]
+
+        # Check if all four keys are not None
+        if not (site['site'] and site['user'] and site['password'] and site['remote_path']):
+            LOGGER.writeLog("A value in in {} site info is None (Not present). Removing faulty config...".format(config), severity='warning')
+            del ftpConfigs[config]
+    return ftpConfigs
+
+def connectToFTP(siteConfig, siteName, downloadPath, recursive=False, extractor=None):
+    """
+    Function that connects to the required FTP site, navigates to the specified path and hands over to the download function
+
+    Parameters
+    ----------
+        - siteConfig : dict
+            Dictionary that contains host, name, password, and path.
+            An optional `port` overrides the default FTP port 21.
+            An optional `timeout` (seconds) limits how long a blocked connection is waited on.
+            An optional `connections` sets how many connections download the site's files in parallel.
+            An optional `retries` (2 by default) sets how many times an operation failing with a transient error is retried,
+            waiting `retry_delay` seconds (1 by default) before the first retry and twice as long before every next one,
+            up to `retry_max_delay` (60 by default). A connection that drops is opened again in the remote path.
+            An optional `block_size` (bytes, 1 MiB by default) sets how much data is received before it is written to disk.
+            An optional `checksum` (sha256 by default, xxhash, crc32 or none) sets the hash computed on every download.
+            An optional `incremental: false` downloads every file again, even if it didn't change.
+            An optional `retention` dict purges the site's old downloads after every run: `max_age` (e.g. '7d') keeps the files
+            downloaded within that time, `max_files` keeps that many of the latest files and `max_size` (e.g. '20G') keeps
+            the latest files up to that total size. Only files the script downloaded are purged.
+            An optional `tls: true` connects with explicit FTPS (AUTH TLS), encrypting the data connections too. They resume
+            the TLS session of the control connection unless `tls_session_reuse: false`. The server's certificate is
+            checked against the system's certificates, or those in `tls_ca_file`, unless `tls_verify: false`.
+            An optional `mode_z` ('auto' by default, 'on' or 'off') transfers the files deflated with MODE Z when the server
+            lists it in FEAT ('auto') or always ('on'), and inflates them as they are written.
+            An optional `filters` dict picks the files to download from the listing: `include` and `exclude` globs (or
+            regular expressions prefixed by 're:'), `min_size` and `max_size` (e.g. '10K'), `modified_since` (e.g. '24h'
+            or '2024-01-31') and `newest_per_pattern` (e.g. 1 keeps only the latest 'export_#.csv' of a directory).
+            An optional `dedup: true` keeps every download once by content in a store (`dedup_store`, 'store' in the state
+            directory by default) and hardlinks duplicates to it. A remote file whose size and name pattern match a stored
+            file is not transferred if the server's XCRC, XMD5 or HASH digest of it matches too.
+            An optional `recursive: true` mirrors the whole directory tree under the remote path.
+            An optional `priority` (1 by default) weighs how early the site is started, see scheduleSites().
+        - siteName : str
+            Name of the site in the config file
+        - downloadPath : str
+            Local machine's download path
+        - recursive : bool
+            Mirror the whole directory tree under the remote path, whatever the site config says
+        - extractor : ExtractionPipeline
+            If provided, every downloaded archive is handed to it for extraction
+    """
+
+    hostname = siteConfig['site']
+    sourceDirectory = siteConfig['remote_path'] # TODO: change to camel case
+
+    LOGGER.writeLog("Connecting to {} at host {}...".format(siteName, hostname), severity='normal')
+
+    # Attempt to connect, a busy or restarting server is given a few more chances
+    ftp = callWithRetries(lambda: openFtpConnection(siteConfig, siteName=siteName), siteConfig, "Connecting to {}".format(siteName), siteName)
+
+    # Welcome could be multiple lines
+    ftpWelcome = ftp.getwelcome()
+    welcomeLines = []
+    while True:
+        try:
+            oneline = ftpWelcome[:ftpWelcome.index('\n')]
+            welcomeLines.append(oneline)
+            ftpWelcome = ftpWelcome[ftpWelcome.index('\n')+1:]
+        except ValueError:
+            welcomeLines.append(ftpWelcome)
+            break
+    
+    LOGGER.writeLog("Welcome: ", severity='normal')
+    for i in welcomeLines:
+        LOGGER.writeLog(i, severity='normal')
+    LOGGER.writeLog("Connected Successfully!", severity='normal')
+    
+    recursive = recursive or bool(siteConfig.get('recursive', False))
+    return downloadFiles(ftp, hostname, sourceDirectory, downloadPath, siteConfig=siteConfig, siteName=siteName, recursive=recursive, extractor=extractor)
+
+def openFtpConnection(siteConfig, sourceDirectory=None, siteName=None):
+    """
+    Function that opens a new connection to an FTP site and logs in
+
+    Parameters
+    ----------
+        - siteConfig : dict
+            Dictionary that contains host, name, password, and path.
+        - sourceDirectory : str
+            If provided, the connection changes into this remote directory after logging in
+        - siteName : str
+            Name of the site the connect and login timings are recorded under, the hostname by default
+    
+    Returns
+    -------
+        - ftp : FTP Object
+            Logged-in FTP connection
+    """
+    siteName = siteName or siteConfig['site']
+    tls = siteConfig.get('tls', False)
+    if tls:
+        ftp = getFtpTlsClass()(context=getTlsContext(siteConfig), timeout=siteConfig.get('timeout', DEFAULT_TIMEOUT))
+        ftp.reuseSession = siteConfig.get('tls_session_reuse', True)
+    else:
+        ftp = ftplib.FTP(timeout=siteConfig.get('timeout', DEFAULT_TIMEOUT))
+    with METRICS.span(siteName, 'connect'):
+        ftp.connect(siteConfig['site'], siteConfig.get('port', 21))
+    try:
+        if tls:
+            with METRICS.span(siteName, 'tls'):
+                ftp.auth()
+        with METRICS.span(siteName, 'login'):
+            ftp.login(siteConfig['user'], str(siteConfig['password']))
+        if tls:
+            # Data connections are encrypted too
+            ftp.prot_p()
+        if sourceDirectory:
+            ftp.cwd(sourceDirectory)
+    except Exception:
+        ftp.close()
+        raise
+    return ftp
+
+def getTlsContext(siteConfig, contextClass=None):
+    """
+    Function that creates the TLS context of an FTPS site
+
+    Parameters
+    ----------
+        - siteConfig : dict
+            Config of the site. `tls_verify: false` doesn't check the server's certificate,
+            `tls_ca_file` trusts the certificates in that file instead of the system's.
+        - contextClass : type
+            Subclass of ssl.SSLContext to create, see getSessionReusingContextClass()
+
+    Returns
+    -------
+        - context : ssl.SSLContext
+    """
+    context = (contextClass or ssl.SSLContext)(ssl.PROTOCOL_TLS_CLIENT)
+    if siteConfig.get('tls_ca_file'):
+        context.load_verify_locations(siteConfig['tls_ca_file'])
+    else:
+        context.load_default_certs()
+    if not siteConfig.get('tls_verify', True):
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+@functools.lru_cache(maxsize=None)
+def getFtpTlsClass():
+    """
+    Function that defines, on first use as ftplib is only imported then, the FTP_TLS class of FTPS connections.
+    Its data connections resume the TLS session of the control connection: servers enforcing session reuse refuse
+    them otherwise, and every listing and transfer would pay for a full handshake.
+    """
+    class SessionReusingFTPTLS(ftplib.FTP_TLS):
+        # Set to False to negotiate a new session on every data connection
+        reuseSession = True
+
+        def ntransfercmd(self, cmd, rest=None):
+            connection, size = ftplib.FTP.ntransfercmd(self, cmd, rest)
+            if self._prot_p:
+                session = self.sock.session if self.reuseSession else None
+                connection = self.context.wrap_socket(connection, server_hostname=self.host, session=session)
+            return connection, size
+
+    return SessionReusingFTPTLS
+
+def getConnectionCount(siteConfig):
+    """
+    Function that reads the number of parallel connections allowed for a site from its config
+
+    Parameters
+    ----------
+        - siteConfig : dict
+            Dictionary that contains host, name, password, path and optionally `connections`
+
+    Returns
+    -------
+        - connections : int
+            Number of connections to use, 1 if not configured or invalid
+    """
+    if not siteConfig:
+        return 1
+    try:
+        return max(1, int(siteConfig.get('connections', 1)))
+    except (TypeError, ValueError):
+        LOGGER.writeLog("Invalid number of connections for {}. Using 1.".format(siteConfig['site']), severity='warning')
+        return 1
+
+def isTransientError(error):
+    """
+    Function that tells whether an error is worth retrying: timeouts, dropped or refused connections, 4xx replies
+    (e.g. 421 Too many connections), garbled replies and corrupted transfers.
+    5xx replies (e.g. a wrong password or a missing file) and local errors (e.g. a full disk) are permanent.
+
+    Parameters
+    ----------
+        - error : Exception
+            Error raised by an FTP operation
+
+    Returns
+    -------
+        - transient : bool
+    """
+    if isinstance(error, ftplib.error_perm):
+        return False
+    if isinstance(error, (ftplib.error_temp, ftplib.error_reply, ftplib.error_proto, ChecksumError, EOFError, TimeoutError, ConnectionError)):
+        return True
+    if isinstance(error, (ssl.SSLEOFError, ssl.SSLZeroReturnError)):
+        # A TLS connection cut short, unlike a certificate that doesn't verify
+        return True
+    import errno
+    import socket
+    if isinstance(error, socket.gaierror):
+        # A failed lookup may succeed later, an unknown host stays unknown
+        return error.errno == socket.EAI_AGAIN
+    return isinstance(error, OSError) and error.errno in (errno.ENETDOWN, errno.ENETUNREACH, errno.ENETRESET, errno.EHOSTDOWN, errno.EHOSTUNREACH)
+
+def getRetryCount(siteConfig):
+    """ Function that reads how many times a site's operations are retried from its config, see DEFAULT_RETRIES. """
+    try:
+        return max(0, int((siteConfig or {}).get('retries', DEFAULT_RETRIES)))
+    except (TypeError, ValueError):
+        LOGGER.writeLog("Invalid number of retries for {}. Using {}.".format(siteConfig['site'], DEFAULT_RETRIES), severity='warning')
+        return DEFAULT_RETRIES
+
+def getRetryDelay(siteConfig, attempt):
+    """
+    Function that computes how long to wait before retrying after a transient error.
+    The delay doubles with every attempt, and a random part of it keeps the connections
+    that failed together (e.g. when the server restarted) from all coming back at the same moment.
+
+    Parameters
+    ----------
+        - siteConfig : dict
+            Config of the site, optionally with `retry_delay` and `retry_max_delay` (seconds)
+        - attempt : int
+            Number of attempts that failed so far, from 1
+
+    Returns
+    -------
+        - delay : float
+            Seconds to wait
+    """
+    import random
+    siteConfig = siteConfig or {}
+    try:
+        delay = float(siteConfig.get('retry_delay', DEFAULT_RETRY_DELAY))
+        maxDelay = float(siteConfig.get('retry_max_delay', DEFAULT_RETRY_MAX_DELAY))
+    except (TypeError, ValueError):
+        LOGGER.writeLog("Invalid retry delay for {}. Using {} seconds.".format(siteConfig['site'], DEFAULT_RETRY_DELAY), severity='warning')
+        delay, maxDelay = DEFAULT_RETRY_DELAY, DEFAULT_RETRY_MAX_DELAY
+    delay = max(0.0, min(maxDelay, delay * 2 ** (attempt - 1)))
+    return random.uniform(delay / 2, delay)
+
+def noteRetry(siteName, siteConfig, description, error, attempt):
+    """ Function that logs and counts a retry after a transient error, and returns the seconds to wait before it. """
+    delay = getRetryDelay(siteConfig, attempt)
+    METRICS.increment(siteName, 'retries')
+    LOGGER.writeLog("{} failed ({!r}), retrying in {:.1f} seconds ({}/{})...".format(description, error, delay, attempt, getRetryCount(siteConfig)), severity='warning')
+    return delay
+
+def callWithRetries(function, siteConfig, description, siteName=None):
+    """
+    Function that calls function() until it succeeds, waiting a little longer after every transient error.
+    Permanent errors, and the transient error of the last attempt, are raised.
+
+    Parameters
+    ----------
+        - function : callable
+            Operation to run, without arguments
+        - siteConfig : dict
+            Config of the site, see getRetryCount() and getRetryDelay()
+        - description : str
+            What the operation does, for the log
+        - siteName : str
+            Name of the site the retries are counted under, the hostname by default
+
+    Returns
+    -------
+        - result
+            What function() returned
+    """
+    siteName = siteName or siteConfig['site']
+    retries = getRetryCount(siteConfig)
+    attempt = 0
+    while True:
+        try:
+            return function()
+        except Exception as error:
+            attempt += 1
+            if attempt > retries or not isTransientError(error):
+                raise
+            time.sleep(noteRetry(siteName, siteConfig, description, error, attempt))
+
+def downloadFiles(ftp, hostname, sourceDirectory, localDownloadPath, siteConfig=None, siteName=None, recursive=False, extractor=None, disconnect=True, pool=None):
+    """
+    Function that downloads all the files present in the current working directory of the ftp connection to the local download path
+
+    Parameters
+    ----------
+        - ftp : FTP Object
+            FTP connection
+        - hostname : str
+            Hostname of the FTP site that the ftp object is connected to
+        - sourceDirectory : str
+            Path to the source directory in ftp server from where the files will be downloaded
+        - localDownloadPath : str
+            Local machine's path where the files need to be downloaded
+        - siteConfig : dict
+            Config of the site. When it asks for more than one connection, extra connections are
+            opened to download the files in parallel. Without it only the ftp connection is used.
+        - siteName : str
+            Name of the site in the config file. When provided, a manifest of the files downloaded
+            from the site is kept and files that didn't change since the last run are skipped.
+        - recursive : bool
+            Also download the files in the subdirectories, recreating the remote tree in the local download path.
+            Subdirectories are listed in parallel and their files start downloading as soon as they are found.
+        - extractor : ExtractionPipeline
+            If provided, every archive is handed to it as soon as its download completes,
+            to be extracted next to it while the other files keep downloading
+        - disconnect : bool
+            Log out of the ftp connection once done. The daemon mode keeps it for the next poll.
+        - pool : FTPConnectionPool
+            Connections to the site already in the source directory, the ftp connection being one acquired from it.
+            They are all left open, the daemon mode keeps them for the next poll.
+
+    Returns
+    -------
+        - filesDownloaded : list
+            Paths of the downloaded files, relative to the local download path
+    """
+
+    if pool is None:
+        ftp.cwd(sourceDirectory)
+    if recursive:
+        LOGGER.writeLog("Mirroring the directory tree under {}.".format(sourceDirectory), severity='normal')
+    else:
+        LOGGER.writeLog("This script will only download files, not directories.", severity='normal')
+
+    # One listing is used both for the log and to decide what to download.
+    # It goes through the pool, so a connection that drops is replaced and the listing tried again.
+    connections = getConnectionCount(siteConfig)
+    keptPool = pool is not None
+    if keptPool:
+        pool.size = connections
+        pool.release(ftp)
+    else:
+        pool = FTPConnectionPool(siteConfig, sourceDirectory, size=connections, connection=ftp, siteName=siteName or hostname)
+    try:
+        entries = listRemoteEntries(pool, '')
+    except BaseException:
+        if not keptPool:
+            pool.closeAll(keep=ftp)
+        raise
+    filesDownloaded = []
+
+    def download(entry):
+        if downloadFile(pool, entry, localDownloadPath, manifest, sidecar=walk.sidecars.get(entry.name)):
+            filesDownloaded.append(entry.name)
+            recordDownload(entry, localDownloadPath, index, extractor, pool.siteName)
+
+    walk = RemoteWalk(pool, siteConfig, recursive, download)
+    fileEntries, directoryEntries = walk.addListing('', entries)
+
+    # Remember what was downloaded before so unchanged files can be skipped
+    manifest = None
+    if siteName and (siteConfig or {}).get('incremental', True):
+        manifest = SiteManifest(siteName)
+    # And when, so the retention policy can purge old files
+    index = DownloadIndex(siteName) if siteName else None
+
+    # Download each file, over as many connections as the site allows
+    if not recursive:
+        connections = min(connections, max(1, len(fileEntries)))
+        pool.size = min(pool.size, connections)
+    if connections > 1:
+        LOGGER.writeLog("Downloading with up to {} connections to {}".format(connections, hostname), severity='normal')
+    workQueue = WorkQueue(connections, name='transfer')
+
+    try:
+        walk.start(workQueue, fileEntries, directoryEntries)
+        workQueue.join()
+    finally:
+        workQueue.close()
+        if not keptPool:
+            pool.closeAll(keep=ftp)
+        if index is not None:
+            applyRetention(siteName, siteConfig, index, manifest, keep=[getLocalPath(localDownloadPath, name) for name in filesDownloaded])
+            index.save()
+        store = getContentStore(siteConfig)
+        if store is not None:
+            store.save()
+        if manifest is not None:
+            # Entries of a tree that couldn't be listed are kept for the next run
+            if not walk.failed:
+                manifest.prune([entry.name for entry in walk.files])
+            manifest.save()
+
+    LOGGER.writeLog("{} files successfully downloaded".format(len(filesDownloaded)), severity='normal')
+
+    if disconnect:
+        disconnectFtp(ftp, hostname)
+
+    return filesDownloaded
+
+class RemoteWalk(object):
+    """
+    The files of a site: its listing filtered like the site asks and, when recursive, its subdirectories'.
+    The subdirectories are listed in a work queue, their files handled as soon as they are found.
+    """
+    def __init__(self, pool, siteConfig, recursive, handleFile):
+        """
+        Parameters
+        ----------
+            - pool : FTPConnectionPool
+                Pool of connections sitting in the source directory
+            - siteConfig : dict
+                Config of the site, its `filters` pick the files
+            - recursive : bool
+                Walk the subdirectories too
+            - handleFile : callable
+                Called in the work queue with the RemoteEntry of every file kept, e.g. to download it
+        """
+        self.pool = pool
+        self.listingFilter = getListingFilter(siteConfig)
+        self.recursive = recursive
+        self.handleFile = handleFile
+        self.workQueue = None
+        # Every file kept, and the checksum files published next to the files, see getChecksumSidecars()
+        self.files = []
+        self.sidecars = {}
+        self.excludedFiles = 0
+        self.excludedBytes = 0
+        # Set when a subdirectory couldn't be listed, the files found are then only part of the tree
+        self.failed = False
+
+    def addListing(self, path, entries):
+        """
+        Function that logs the listing of a directory and filters it
+
+        Returns
+        -------
+            - files : list
+                RemoteEntry of the files kept
+            - directories : list
+                RemoteEntry of the subdirectories to walk, none unless recursive
+        """
+        LOGGER.writeLog("Files at {}:".format(posixpath.join(self.pool.sourceDirectory, path) if path else self.pool.sourceDirectory), severity='normal')
+        for entry in entries:
+            LOGGER.writeLog(formatRemoteEntry(entry), severity='normal')
+        # Checksum files are looked for in the whole listing, the filters may well exclude them
+        self.sidecars.update(getChecksumSidecars(entries))
+        kept = filterEntries(entries, self.listingFilter, self.pool.siteName)
+        if len(kept) < len(entries):
+            keptNames = set(entry.name for entry in kept)
+            excluded = [entry for entry in entries if entry.name not in keptNames]
+            self.excludedFiles += len(excluded)
+            self.excludedBytes += sum(entry.size or 0 for entry in excluded)
+        files = [entry for entry in kept if entry.type != 'dir']
+        directories = [entry for entry in kept if entry.type == 'dir'] if self.recursive else []
+        self.files.extend(files)
+        return files, directories
+
+    def start(self, workQueue, files, directories):
+        """ Function that queues the listing of the directories and the handling of the files. """
+        self.workQueue = workQueue
+        for entry in directories:
+            workQueue.submit(self.listDirectory, entry.name, priority=LISTING_PRIORITY)
+        for entry in files:
+            workQueue.submit(self.handleFile, entry, priority=getDownloadPriority(entry))
+
+    def listDirectory(self, path):
+        # Directories are walked before any queued download so discovery keeps ahead of the transfers
+        try:
+            entries = listRemoteEntries(self.pool, path)
+        except Exception as listingError:
+            self.failed = True
+            LOGGER.writeLog("Listing {} failed, skipping it: {}".format(path, listingError), severity='error')
+            return
+        self.start(self.workQueue, *self.addListing(path, entries))
+
+def listRemoteEntries(pool, path):
+    """
+    Function that lists a subdirectory of the pool's directory over a connection borrowed from the pool
+
+    Parameters
+    ----------
+        - pool : FTPConnectionPool
+            Pool of connections sitting in the source directory
+        - path : str
+            Path of the subdirectory, relative to the source directory, '' for the source directory itself
+
+    Returns
+    -------
+        - entries : list
+            RemoteEntry of every file and directory in the subdirectory, named by their path relative to the source directory
+    """
+    def listPath(ftp):
+        with METRICS.span(pool.siteName, 'listing', path=posixpath.join(pool.sourceDirectory, path) if path else pool.sourceDirectory) as listing:
+            entries = listRemoteDirectory(ftp, path)
+            listing['entries'] = len(entries)
+        return entries
+
+    entries = pool.run(listPath, "Listing {}".format(posixpath.join(pool.sourceDirectory, path)))
+    return [entry._replace(name=posixpath.join(path, entry.name)) for entry in entries]
+
+def recordDownload(entry, localDownloadPath, index=None, extractor=None, siteName=None):
+    """
+    Function that hands a file that was just downloaded to the download index and the extraction pipeline, whatever transfer engine is used
+
+    Parameters
+    ----------
+        - entry : RemoteEntry
+            Listing entry of the file, named by its path relative to the remote directory
+        - localDownloadPath : str
+            Local machine's download path
+        - index : DownloadIndex
+            Index of the files downloaded from the site
+        - extractor : ExtractionPipeline
+            If provided, the file is extracted if it is an archive
+        - siteName : str
+            Name of the site the extraction is recorded under
+    """
+    localPath = getLocalPath(localDownloadPath, entry.name)
+    if index is not None:
+        index.add(localPath, os.path.getsize(localPath))
+    if extractor is not None:
+        extractor.submit(localPath, os.path.dirname(localPath), siteName=siteName)
+
+class WorkQueue(object):
+    """ A fixed number of worker threads running queued tasks, where a task can queue more tasks while it runs. """
+    def __init__(self, workers, name='work'):
+        """
+        Parameters
+        ----------
+            - workers : int
+                Number of tasks that run at the same time
+            - name : str
+                Prefix of the worker thread names
+        """
+        self.tasks = queue.PriorityQueue()
+        self.counter = 0
+        self.lock = threading.Lock()
+        self.threads = []
+        for index in range(workers):
+            thread = threading.Thread(target=self.work, name='{}_{}'.format(name, index), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, function, *args, priority=LISTING_PRIORITY):
+        """
+        Function that queues a task
+
+        Parameters
+        ----------
+            - function : callable
+                Function to run with args
+            - priority : tuple
+                Tasks with a lower priority run first, tasks of the same priority run in the order they were queued
+        """
+        with self.lock:
+            self.counter += 1
+            order = self.counter
+        self.tasks.put((priority, order, function, args))
+
+    def work(self):
+        while True:
+            priority, order, function, args = self.tasks.get()
+            try:
+                if function is None:
+                    return
+                function(*args)
+            except Exception as taskError:
+                LOGGER.writeLog("A queued task failed: {!r}".format(taskError), severity='error')
+            finally:
+                self.tasks.task_done()
+
+    def join(self):
+        """ Function that waits until all the tasks, including the ones queued by other tasks, have run. """
+        self.tasks.join()
+
+    def close(self):
+        """ Function that stops the worker threads once the queued tasks have run. """
+        for thread in self.threads:
+            self.submit(None, priority=STOP_PRIORITY)
+        for thread in self.threads:
+            thread.join()
+
+def downloadFile(pool, entry, localDownloadPath, manifest=None, sidecar=None):
+    """
+    Function that downloads one file over a connection borrowed from the pool.
+    The data goes to a '.part' file that is only renamed once it is complete. An interrupted
+    transfer is resumed from the end of the '.part' file, on a fresh connection or in the next run.
+
+    Parameters
+    ----------
+        - pool : FTPConnectionPool
+            Pool of connections sitting in the directory of the file
+        - entry : RemoteEntry
+            Listing entry of the file, named by its path relative to the remote directory
+        - localDownloadPath : str
+            Local machine's path where the file needs to be downloaded, subdirectories are created as needed
+        - manifest : SiteManifest
+            Manifest of the site. If provided, the file is skipped when it didn't change since it was last downloaded.
+        - sidecar : tuple
+            (path, algorithm) of the checksum file the vendor published for the file, see getChecksumSidecars()
+
+    Returns
+    -------
+        - downloaded : bool
+            True if the file was downloaded
+    """
+    filename = entry.name
+    decision = getTransferDecision(entry, localDownloadPath, manifest)
+    localPath = decision.localPath
+    if localPath is None:
+        LOGGER.writeLog("{} points outside of the download directory, skipping...".format(filename), severity='warning')
+        return False
+    partPath = localPath + '.part'
+    retries = getRetryCount(pool.siteConfig)
+    blockSize = getBlockSize(pool.siteConfig)
+    algorithms = getChecksumAlgorithms(pool.siteConfig, sidecar)
+    store = getContentStore(pool.siteConfig)
+
+    # The listing usually tells already, an unchanged file doesn't need a connection
+    if decision.unchanged:
+        noteUnchangedFile(entry, manifest)
+        return False
+
+    attempt = 0
+    while True:
+        ftp = pool.acquire()
+        offset = 0
+        try:
+            entry = getRemoteMetadata(ftp, entry, modify=manifest is not None)
+            if skipUnchangedFile(entry, localPath, manifest):
+                pool.release(ftp)
+                return False
+            # A file already in the content store doesn't need to be transferred
+            candidates = store.findCandidates(entry) if store is not None else None
+            if candidates and linkKnownFile(store, candidates, getRemoteHash(ftp, pool, filename), entry, localPath, partPath, manifest, pool.siteName):
+                pool.release(ftp)
+                return True
+
+            offset = startDownload(entry, partPath, localPath, manifest)
+            compressed = useModeZ(ftp, pool)
+            with PartFile(partPath, offset, entry.size, algorithms, compressed) as file, METRICS.span(pool.siteName, 'transfer', file=filename, offset=offset, size=entry.size, modify=entry.modify) as transfer:
+                try:
+                    retrieveFile(ftp, "RETR " + filename, file, rest=offset or None, blockSize=blockSize)
+                finally:
+                    transfer['bytes'] = file.position - offset
+                    transfer['wireBytes'] = file.received
+            digests = file.getDigests()
+            if algorithms:
+                with METRICS.span(pool.siteName, 'checksum', file=filename) as check:
+                    sidecarText = readRemoteFile(ftp, sidecar[0]) if sidecar else None
+                    verifyChecksum(entry, partPath, digests, pool.siteConfig, sidecar, sidecarText, check)
+
+            completeDownload(entry, partPath, localPath, manifest)
+            storeDownload(store, entry, localPath, digests, pool.siteName)
+            pool.release(ftp)
+            return True
+        except ftplib.error_perm as permanentError:
+            pool.release(ftp)
+            if offset and attempt < retries:
+                # The server doesn't support REST, start over
+                LOGGER.writeLog("{} can't be resumed ({}), downloading it again...".format(filename, permanentError), severity='warning')
+                os.remove(partPath)
+                attempt += 1
+                continue
+            rejectDownload(entry, partPath, permanentError)
+            return False
+        except Exception as transferError:
+            # The connection may be broken, don't hand it out again
+            pool.discard(ftp)
+            attempt += 1
+            if attempt > retries or not isTransientError(transferError):
+                LOGGER.writeLog("Downloading {} failed, it will be resumed in the next run: {!r}".format(filename, transferError), severity='error')
+                return False
+            # The '.part' file is resumed on the connection that replaces this one
+            time.sleep(noteRetry(pool.siteName, pool.siteConfig, "Downloading {}".format(filename), transferError, attempt))
+
+def getBlockSize(siteConfig):
+    """ Function that reads the transfer block size of a site from its config, see DEFAULT_BLOCK_SIZE. """
+    try:
+        return max(4096, int((siteConfig or {}).get('block_size', DEFAULT_BLOCK_SIZE)))
+    except (TypeError, ValueError):
+        LOGGER.writeLog("Invalid block size for {}. Using {} bytes.".format(siteConfig['site'], DEFAULT_BLOCK_SIZE), severity='warning')
+        return DEFAULT_BLOCK_SIZE
+
+# Receive buffer of each transfer thread, reused for every file the thread downloads
+TRANSFER_BUFFERS = threading.local()
+
+def getTransferBuffer(size):
+    buffer = getattr(TRANSFER_BUFFERS, 'buffer', None)
+    if buffer is None or len(buffer) != size:
+        buffer = TRANSFER_BUFFERS.buffer = bytearray(size)
+    return buffer
+
+def retrieveFile(ftp, command, file, rest=None, blockSize=DEFAULT_BLOCK_SIZE):
+    """
+    Function that does what ftplib's retrbinary() does, but receives the data straight into the
+    buffer of the calling thread and writes it out a whole block at a time
+
+    Parameters
+    ----------
+        - ftp : FTP Object
+            Connection to run the command on
+        - command : str
+            Command such as 'RETR name'
+        - file : PartFile
+            File the data is written to
+        - rest : int
+            Byte to start the transfer from, sent with REST
+        - blockSize : int
+            Bytes received before they are written to the file
+
+    Returns
+    -------
+        - reply : str
+            Final reply of the server
+    """
+    ftp.voidcmd('TYPE I')
+    with ftp.transfercmd(command, rest) as connection:
+        file.receive(connection, getTransferBuffer(blockSize))
+        if hasattr(connection, 'unwrap'):
+            # Like ftplib, close the TLS layer of an FTPS data connection before the socket
+            connection.unwrap()
+    reply = ftp.voidresp()
+    file.finish()
+    return reply
+
+def getModeZSetting(siteConfig):
+    """ Function that returns the 'mode_z' setting of a site: 'auto', 'on' or 'off'. YAML reads a bare on/off as a bool. """
+    setting = (siteConfig or {}).get('mode_z', DEFAULT_MODE_Z)
+    if isinstance(setting, bool):
+        return 'on' if setting else 'off'
+    setting = str(setting).strip().lower()
+    if setting not in ('auto', 'on', 'off'):
+        LOGGER.writeLog("Unknown mode_z '{}' for {}, using {}.".format(setting, siteConfig['site'], DEFAULT_MODE_Z), severity='warning')
+        return DEFAULT_MODE_Z
+    return setting
+
+def parseFeatures(featReply):
+    """ Function that turns a FEAT reply into a dict of feature to its arguments, e.g. {'MODE': 'Z', 'HASH': 'SHA-256*;MD5'}. """
+    features = {}
+    for line in featReply.splitlines()[1:-1]:
+        feature, _, arguments = line.strip().partition(' ')
+        features[feature.upper()] = arguments
+    return features
+
+def getServerFeatures(ftp, pool):
+    """ Function that returns the features of the pool's server, asking for them with FEAT once per pool. """
+    if pool.features is None:
+        try:
+            pool.features = parseFeatures(ftp.sendcmd('FEAT'))
+        except ftplib.error_perm:
+            pool.features = {}
+    return pool.features
+
+def setTransferMode(ftp, mode):
+    """ Function that switches a connection to MODE S or Z, if it isn't in it already. """
+    if getattr(ftp, 'transferMode', 'S') != mode:
+        ftp.voidcmd('MODE ' + mode)
+        ftp.transferMode = mode
+
+def useModeZ(ftp, pool):
+    """
+    Function that puts a connection in the transfer mode of the site before a file is downloaded. Listings and
+    small files stay in stream mode, see setTransferMode().
+
+    Parameters
+    ----------
+        - ftp : FTP Object
+            Connection of the pool the file is downloaded on
+        - pool : FTPConnectionPool
+            Pool of the connection, remembers whether the server compresses
+
+    Returns
+    -------
+        - compressed : bool
+            True if the file will be received deflated
+    """
+    if pool.modeZ is None:
+        setting = getModeZSetting(pool.siteConfig)
+        pool.modeZ = setting == 'on' or (setting == 'auto' and 'Z' in getServerFeatures(ftp, pool).get('MODE', '').upper().split(','))
+    if not pool.modeZ:
+        setTransferMode(ftp, 'S')
+        return False
+    try:
+        setTransferMode(ftp, 'Z')
+    except ftplib.error_perm as permanentError:
+        LOGGER.writeLog("{} refused MODE Z, transferring uncompressed: {}".format(pool.siteName, permanentError), severity='warning')
+        pool.modeZ = False
+        return False
+    return True
+
+class PartFile(object):
+    """
+    The '.part' file of a download. It is written without Python's own buffering, in large blocks,
+    and preallocated to the remote size so the filesystem can reserve the space in one go.
+    On close it is cut back to the data actually received, so an interrupted download can still be resumed.
+    The requested checksums are computed on the data as it is written.
+    """
+    def __init__(self, partPath, offset=0, size=None, algorithms=(), compressed=False):
+        """
+        Parameters
+        ----------
+            - partPath : str
+                Path of the '.part' file
+            - offset : int
+                Bytes already in the file, new data is written after them
+            - size : int
+                Size of the remote file, None if unknown
+            - algorithms : list
+                Checksums to compute on the whole file, see CHECKSUM_ALGORITHMS
+            - compressed : bool
+                The data is received deflated (MODE Z) and inflated as it is written
+        """
+        self.checksums = dict((algorithm, createChecksum(algorithm)) for algorithm in algorithms)
+        self.decompressor = zlib.decompressobj() if compressed else None
+        # Bytes received from the data connection, fewer than written when compressed
+        self.received = 0
+        self.file = open(partPath, "r+b" if offset else "wb", buffering=0)
+        if offset and self.checksums:
+            # Only the data received from now on streams through, the part resumed from is read back once
+            self.hashExistingData(offset)
+        self.file.seek(offset)
+        self.position = offset
+        if size is not None and size > offset and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self.file.fileno(), offset, size - offset)
+            except OSError:
+                # Not supported by the filesystem, the file simply grows as it is written
+                pass
+
+    def write(self, data):
+        for checksum in self.checksums.values():
+            checksum.update(data)
+        view = memoryview(data)
+        while view:
+            # Unbuffered writes may write less than asked
+            view = view[self.file.write(view):]
+        self.position += len(data)
+
+    def feed(self, data):
+        """ Function that writes a block as received from the data connection. """
+        self.received += len(data)
+        if self.decompressor is not None:
+            data = self.decompressor.decompress(data)
+        self.write(data)
+
+    def finish(self):
+        """ Function that writes what is left once the data connection is closed, and checks a compressed transfer was complete. """
+        if self.decompressor is None:
+            return
+        self.write(self.decompressor.flush())
+        if not self.decompressor.eof:
+            raise EOFError("the compressed data ended before the end of the stream")
+
+    def hashExistingData(self, offset):
+        remaining = offset
+        while remaining:
+            block = self.file.read(min(remaining, DEFAULT_BLOCK_SIZE))
+            if not block:
+                break
+            for checksum in self.checksums.values():
+                checksum.update(block)
+            remaining -= len(block)
+
+    def getDigests(self):
+        """ Function that returns the hex digest of every checksum, by algorithm. """
+        return dict((algorithm, checksum.hexdigest()) for algorithm, checksum in self.checksums.items())
+
+    def receive(self, connection, buffer):
+        """
+        Function that reads a data connection until the server closes it, filling the buffer before every write
+
+        Parameters
+        ----------
+            - connection : socket
+                Data connection of the transfer
+            - buffer : bytearray
+                Buffer the data is received into
+        """
+        view = memoryview(buffer)
+        while True:
+            filled = 0
+            while filled < len(view):
+                received = connection.recv_into(view[filled:])
+                if not received:
+                    break
+                filled += received
+            if filled:
+                self.feed(view[:filled])
+            if filled < len(view):
+                return
+
+    def close(self):
+        try:
+            self.file.truncate(self.position)
+        finally:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+class ChecksumError(Exception):
+    """ Raised when a downloaded file doesn't match the checksum published for it. """
+
+class Crc32Checksum(object):
+    """ zlib's crc32 behind the update()/hexdigest() interface of hashlib. """
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return '{:08x}'.format(self.value)
+
+def createChecksum(algorithm):
+    if algorithm == 'crc32':
+        return Crc32Checksum()
+    if algorithm == 'xxhash':
+        return importXxhash().xxh64()
+    import hashlib
+    return hashlib.new(algorithm)
+
+@functools.lru_cache(maxsize=None)
+def importXxhash():
+    """ Function that imports the optional xxhash module, None if it isn't installed. """
+    try:
+        import xxhash
+    except ImportError:
+        return None
+    return xxhash
+
+def getChecksumAlgorithm(siteConfig):
+    """
+    Function that reads the checksum computed on the downloads of a site from its config
+
+    Returns
+    -------
+        - algorithm : str
+            One of CHECKSUM_ALGORITHMS, None if checksums are turned off
+    """
+    algorithm = (siteConfig or {}).get('checksum', DEFAULT_CHECKSUM)
+    if not algorithm or str(algorithm).lower() == 'none':
+        return None
+    algorithm = str(algorithm).lower()
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        LOGGER.writeLog("Unknown checksum '{}' for {}, must be one of: {}. Using {}.".format(algorithm, siteConfig['site'], ', '.join(CHECKSUM_ALGORITHMS), DEFAULT_CHECKSUM), severity='warning')
+        return DEFAULT_CHECKSUM
+    if algorithm == 'xxhash' and importXxhash() is None:
+        LOGGER.writeLog("The xxhash module isn't installed, using {} for {}.".format(DEFAULT_CHECKSUM, siteConfig['site']), severity='warning')
+        return DEFAULT_CHECKSUM
+    return algorithm
+
+def getChecksumAlgorithms(siteConfig, sidecar=None):
+    """ Function that returns the checksums to compute on a download: the site's, the one of its sidecar file and the content store's. """
+    algorithms = []
+    algorithm = getChecksumAlgorithm(siteConfig)
+    if algorithm:
+        algorithms.append(algorithm)
+    if sidecar is not None and sidecar[1] not in algorithms:
+        algorithms.append(sidecar[1])
+    if (siteConfig or {}).get('dedup'):
+        algorithms.extend(algorithm for algorithm in STORE_ALGORITHMS if algorithm not in algorithms)
+    return algorithms
+
+def getChecksumSidecars(entries):
+    """
+    Function that finds the checksum files published next to the files of a listing
+
+    Parameters
+    ----------
+        - entries : list
+            RemoteEntry of the files of a directory
+
+    Returns
+    -------
+        - sidecars : dict
+            Path of a file to the (path, algorithm) of its checksum file, see CHECKSUM_SIDECARS
+    """
+    names = set(entry.name for entry in entries if entry.type != 'dir')
+    sidecars = {}
+    for name in names:
+        for extension, algorithm in CHECKSUM_SIDECARS.items():
+            if algorithm == 'xxhash' and importXxhash() is None:
+                continue
+            if name + extension in names:
+                sidecars[name] = (name + extension, algorithm)
+                break
+    return sidecars
+
+def parseChecksumFile(text, name, algorithm):
+    """
+    Function that finds the checksum of a file in the content of a checksum file.
+    Handles a bare digest, 'digest  name' lines as written by sha256sum and 'SHA256 (name) = digest' lines.
+
+    Returns
+    -------
+        - digest : str
+            Lowercase hex digest, None if none was found
+    """
+    digestLength = len(createChecksum(algorithm).hexdigest())
+    basename = posixpath.basename(name)
+    candidates = []
+    for line in text.splitlines():
+        digests = [digest for digest in re.findall(r'[0-9a-fA-F]+', line) if len(digest) == digestLength]
+        if not digests:
+            continue
+        if basename in line:
+            return digests[-1].lower()
+        candidates.append(digests[-1].lower())
+    # A file with a single digest and no names is about the file it is named after
+    return candidates[0] if len(candidates) == 1 else None
+
+def readRemoteFile(ftp, path):
+    """ Function that downloads a small file, such as a checksum file, into memory and returns its text, None if the server refuses it. """
+    chunks = []
+    try:
+        setTransferMode(ftp, 'S')
+        ftp.retrbinary("RETR " + path, chunks.append)
+    except ftplib.error_perm as permanentError:
+        LOGGER.writeLog("Reading {} failed: {}".format(path, permanentError), severity='warning')
+        return None
+    return b''.join(chunks).decode('utf-8', 'replace')
+
+def verifyChecksum(entry, partPath, digests, siteConfig, sidecar=None, sidecarText=None, check=None):
+    """
+    Function that records the checksum of a download and compares it with the one published by the vendor, if any
+
+    Parameters
+    ----------
+        - entry : RemoteEntry
+            Listing entry of the remote file
+        - partPath : str
+            Path of the '.part' file holding the download
+        - digests : dict
+            Hex digest of the download by algorithm, see PartFile.getDigests()
+        - siteConfig : dict
+            Config of the site, tells which checksum is recorded
+        - sidecar : tuple
+            (path, algorithm) of the checksum file of the download
+        - sidecarText : str
+            Content of the checksum file
+        - check : dict
+            Attributes of the checksum span in the run report, filled in here
+
+    Raises
+    ------
+        - ChecksumError
+            If the download doesn't match the published checksum. The '.part' file is removed, so it is downloaded again.
+    """
+    check = check if check is not None else {}
+    algorithm = getChecksumAlgorithm(siteConfig) or (sidecar[1] if sidecar else None)
+    if algorithm is None:
+        # Only computed for the content store
+        return
+    check['algorithm'] = algorithm
+    check['digest'] = digests[algorithm]
+    if sidecar is None:
+        return
+    check['sidecar'] = sidecar[0]
+    expected = parseChecksumFile(sidecarText, entry.name, sidecar[1]) if sidecarText is not None else None
+    if expected is None:
+        LOGGER.writeLog("{} doesn't hold a {} checksum for {}, it can't be verified.".format(sidecar[0], sidecar[1], entry.name), severity='warning')
+        return
+    check['expected'] = '{}:{}'.format(sidecar[1], expected)
+    check['verified'] = digests[sidecar[1]] == expected
+    if not check['verified']:
+        os.remove(partPath)
+        raise ChecksumError("{} checksum {} doesn't match {} from {}".format(sidecar[1], digests[sidecar[1]], expected, sidecar[0]))
+    LOGGER.writeLog("{} matches its {} checksum.".format(entry.name, sidecar[1]), severity='normal')
+
+def skipUnchangedFile(entry, localPath, manifest=None):
+    """
+    Function that tells whether a file can be skipped because it didn't change since the last run, and counts it if so
+
+    Parameters
+    ----------
+        - entry : RemoteEntry
+            Listing entry of the remote file, with its size and modify time
+        - localPath : str
+            Path the file is downloaded to
+        - manifest : SiteManifest
+            Manifest of the site, nothing is skipped without it
+
+    Returns
+    -------
+        - skip : bool
+    """
+    if manifest is None or not manifest.isUnchanged(entry, localPath):
+        return False
+    noteUnchangedFile(entry, manifest)
+    return True
+
+def noteUnchangedFile(entry, manifest):
+    """ Function that logs and counts a file skipped because it didn't change since the last run. """
+    LOGGER.writeLog("{} didn't change since the last run, skipping...".format(entry.name), severity='normal')
+    METRICS.increment(manifest.siteName, 'skippedFiles')
+    METRICS.increment(manifest.siteName, 'skippedBytes', entry.size)
+    METRICS.skip(manifest.siteName, entry, 'unchanged')
+
+# What downloading a file of the listing takes, see getTransferDecision()
+TransferDecision = namedtuple('TransferDecision', ['localPath', 'unchanged', 'offset'])
+
+def getTransferDecision(entry, localDownloadPath, manifest=None):
+    """
+    Function that decides what downloading a file of the listing takes, for the downloads as well as
+    the transfer plan (--plan). Nothing is changed on disk.
+
+    Parameters
+    ----------
+        - entry : RemoteEntry
+            Listing entry of the remote file, named by its path relative to the remote directory
+        - localDownloadPath : str
+            Local machine's download path
+        - manifest : SiteManifest
+            Manifest of the site, nothing is unchanged without it
+
+    Returns
+    -------
+        - decision : TransferDecision
+            The 'localPath' the file is downloaded to, None if it points outside of the download path.
+            Whether it is 'unchanged' since it was last downloaded and otherwise the 'offset' its '.part' file can be resumed from.
+    """
+    localPath = getLocalPath(localDownloadPath, entry.name)
+    if localPath is None:
+        return TransferDecision(None, False, 0)
+    if manifest is not None and manifest.isUnchanged(entry, localPath):
+        return TransferDecision(localPath, True, 0)
+    return TransferDecision(localPath, False, getResumeOffset(entry, localPath + '.part', localPath, manifest))
+
+def startDownload(entry, partPath, localPath, manifest=None):
+    """
+    Function that prepares the '.part' file of a download, whatever transfer engine is used
+
+    Parameters
+    ----------
+        - entry : RemoteEntry
+            Listing entry of the remote file
+        - partPath : str
+            Path of the '.part' file the data is written to
+        - localPath : str
+            Path the file is downloaded to
+        - manifest : SiteManifest
+            Manifest of the site, records that the download was started
+
+    Returns
+    -------
+        - offset : int
+            Byte to resume the download from, the '.part' file must be opened in append mode if it isn't 0
+    """
+    offset = getResumeOffset(entry, partPath, localPath, manifest)
+    if offset:
+        LOGGER.writeLog("Resuming {} from byte {}...".format(entry.name, offset), severity='normal')
+        return offset
+
+    LOGGER.writeLog("Downloading {}...".format(entry.name), severity='normal')
+    if manifest is not None:
+        manifest.update(entry, localPath, partial=True)
+    os.makedirs(os.path.dirname(partPath), exist_ok=True)
+    return 0
+
+def completeDownload(entry, partPath, localPath, manifest=None):
+    """
+    Function that gives a '.part' file its real name once the transfer finished, if it has the size of the remote file
+
+    Parameters
+    ----------
+        - entry : RemoteEntry
+            Listing entry of the remote file
+        - partPath : str
+            Path of the '.part' file the data was written to
+        - localPath : str
+            Path the file is downloaded to
+        - manifest : SiteManifest
+            Manifest of the site, records the completed download
+
+    Raises
+    ------
+        - EOFError
+            If less data than the remote size was received, the download can be resumed
+    """
+    # Only a complete file takes the real name
+    receivedSize = os.path.getsize(partPath)
+    if entry.size is not None and receivedSize != entry.size:
+        raise EOFError("received {} of {} bytes".format(receivedSize, entry.size))
+    os.replace(partPath, localPath)
+    if manifest is not None:
+        manifest.update(entry, localPath)
+
+def rejectDownload(entry, partPath, permanentError):
+    """
+    Function that cleans up after the server refused to send a file
+
+    Parameters
+    ----------
+        - entry : RemoteEntry
+            Listing entry of the remote file
+        - partPath : str
+            Path of the '.part' file the data would have been written to
+        - permanentError : Exception
+            The error returned by the server
+    """
+    # Nothing was received, so there is nothing to resume
+    if os.path.exists(partPath) and os.path.getsize(partPath) == 0:
+        os.remove(partPath)
+    if entry.type is None:
+        # The listing couldn't tell, it is most likely a directory
+        LOGGER.writeLog("{} couldn't be downloaded, it is probably a directory. Skipping...".format(entry.name), severity='normal')
+    else:
+        LOGGER.writeLog("Downloading {} failed: {}".format(entry.name, permanentError), severity='error')
+
+def getLocalPath(localDownloadPath, remotePath):
+    """
+    Function that maps the path of a remote file, relative to the remote directory, to its local path
+
+    Parameters
+    ----------
+        - localDownloadPath : str
+            Local machine's download path
+        - remotePath : str
+            Path of the remote file relative to the remote directory, with '/' separators
+
+    Returns
+    -------
+        - localPath : str
+            Path of the file in the local download path, None if the remote path would lead outside of it
+    """
+    parts = [part for part in remotePath.split('/') if part not in ('', '.')]
+    if not parts or '..' in parts or any(os.sep in part or (os.altsep and os.altsep in part) for part in parts):
+        return None
+    return os.path.join(localDownloadPath, *parts)
+
+def getResumeOffset(entry, partPath, localPath, manifest=None):
+    """
+    Function that determines from which byte an interrupted download can be resumed
+
+    Parameters
+    ----------
+        - entry : RemoteEntry
+            Listing entry of the remote file
+        - partPath : str
+            Path of the '.part' file holding the data received so far
+        - localPath : str
+            Path the file is downloaded to
+        - manifest : SiteManifest
+            Manifest of the site, tells if the remote file changed since the '.part' file was started
+
+    Returns
+    -------
+        - offset : int
+            Number of bytes already received, 0 if the download has to start over
+    """
+    if not os.path.isfile(partPath) or entry.size is None:
+        return 0
+    offset = os.path.getsize(partPath)
+    # A '.part' file that isn't shorter than the remote file can't be trusted
+    if offset >= entry.size:
+        return 0
+    if manifest is not None and manifest.isPartialOfOtherVersion(entry, localPath):
+        return 0
+    return offset
+
+# A file or directory in a remote listing.
+#   - type : 'file', 'dir', or None when the listing couldn't tell
+#   - size : int, or None if unknown
+#   - modify : str formatted as YYYYMMDDHHMMSS (UTC for MLSD), or None if unknown
+RemoteEntry = namedtuple('RemoteEntry', ['name', 'type', 'size', 'modify'])
+
+LIST_MONTHS = {month: index + 1 for index, month in enumerate(['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'])}
+# Compiled (and cached by re) on first use
+UNIX_LIST_REGEX = r'^([\-dlbcps])[\w\-\.+@]{9,10}\s+\d+\s+\S+\s+(?:\S+\s+)?(\d+)\s+(\w{3})\s+(\d{1,2})\s+(\d{1,2}:\d{2}|\d{4})\s(.+)$'
+DOS_LIST_REGEX = r'^(\d{2})-(\d{2})-(\d{2,4})\s+(\d{1,2}):(\d{2})([AaPp][Mm])?\s+(<DIR>|\d+)\s+(.+)$'
+
+def listRemoteDirectory(ftp, path=''):
+    """
+    Function that lists a remote directory with one MLSD command, falling back to parsing the LIST output
+    on servers that don't support it
+
+    Parameters
+    ----------
+        - ftp : FTP Object
+            FTP connection
+        - path : str
+            Remote directory to list, the current working directory if empty
+
+    Returns
+    -------
+        - entries : list
+            RemoteEntry of every file and directory in the remote directory, without '.' and '..'
+    """
+    entries = []
+    setTransferMode(ftp, 'S')
+    try:
+        for name, facts in ftp.mlsd(path):
+            entry = parseMlsdFacts(name, facts)
+            if entry is not None:
+                entries.append(entry)
+        return entries
+    except ftplib.error_perm:
+        pass
+
+    lines = []
+    ftp.retrlines("LIST " + path if path else "LIST", lines.append)
+    unparsedLines = []
+    for line in lines:
+        entry = parseListLine(line)
+        if entry is None:
+            if line.strip() and not line.lower().startswith('total'):
+                unparsedLines.append(line)
+        elif entry.name not in ('.', '..'):
+            entries.append(entry)
+
+    # Get the names the LIST format didn't give away, their type can only be found out when downloading them
+    if unparsedLines:
+        LOGGER.writeLog("{} lines of the LIST output couldn't be parsed, getting the names with NLST.".format(len(unparsedLines)), severity='warning')
+        knownNames = set(entry.name for entry in entries)
+        names = []
+        ftp.retrlines("NLST " + path if path else "NLST", names.append)
+        for name in names:
+            name = name.rsplit('/', 1)[-1]
+            if name not in knownNames and name not in ('.', '..'):
+                entries.append(RemoteEntry(name, None, None, None))
+    return entries
+
+def parseMlsdFacts(name, facts):
+    """
+    Function that turns the facts of one MLSD line into a RemoteEntry
+
+    Parameters
+    ----------
+        - name : str
+            Name of the entry
+        - facts : dict
+            Facts of the entry, with lowercase keys
+
+    Returns
+    -------
+        - entry : RemoteEntry
+            None for the current and parent directory entries
+    """
+    entryType = facts.get('type', '').lower()
+    if entryType in ('cdir', 'pdir') or name in ('.', '..'):
+        return None
+    size = facts.get('size', facts.get('sizd'))
+    modify = facts.get('modify')
+    return RemoteEntry(
+        name,
+        'dir' if entryType == 'dir' else ('file' if entryType == 'file' else None),
+        int(size) if size is not None and size.isdigit() else None,
+        modify.split('.')[0] if modify else None,
+    )
+
+def parseListLine(line):
+    """
+    Function that parses one line of a LIST output in the Unix (ls -l) or the DOS/IIS format
+
+    Parameters
+    ----------
+        - line : str
+            A line of the LIST output
+
+    Returns
+    -------
+        - entry : RemoteEntry
+            None if the line isn't in a known format
+    """
+    match = re.match(UNIX_LIST_REGEX, line)
+    if match:
+        kind, size, month, day, timeOrYear, name = match.groups()
+        month = LIST_MONTHS.get(month.lower())
+        if month is None:
+            return None
+        now = datetime.utcnow()
+        if ':' in timeOrYear:
+            hour, minute = (int(part) for part in timeOrYear.split(':'))
+            # Without a year, the date is within the last 6 months
+            year = now.year if (month, int(day)) <= (now.month, now.day) else now.year - 1
+        else:
+            hour, minute, year = 0, 0, int(timeOrYear)
+        if kind == 'l':
+            name = name.split(' -> ')[0]
+        return RemoteEntry(
+            name,
+            'dir' if kind == 'd' else ('file' if kind == '-' else None),
+            int(size),
+            '{:04d}{:02d}{:02d}{:02d}{:02d}00'.format(year, month, int(day), hour, minute),
+        )
+
+    match = re.match(DOS_LIST_REGEX, line)
+    if match:
+        month, day, year, hour, minute, meridiem, size, name = match.groups()
+        year = int(year)
+        if year < 100:
+            year += 2000 if year < 70 else 1900
+        hour = int(hour)
+        if meridiem:
+            hour = hour % 12 + (12 if meridiem.lower() == 'pm' else 0)
+        isDirectory = size == '<DIR>'
+        return RemoteEntry(
+            name,
+            'dir' if isDirectory else 'file',
+            None if isDirectory else int(size),
+            '{:04d}{:02d}{:02d}{:02d}{:02d}00'.format(year, int(month), int(day), hour, int(minute)),
+        )
+    return None
+
+def formatRemoteEntry(entry):
+    """ Function that formats a RemoteEntry as a line for the log. """
+    return "{:<5} {:>14} {:<14} {}".format(
+        entry.type or '?',
+        entry.size if entry.size is not None else '-',
+        entry.modify or '-',
+        entry.name,
+    )
+
+def getRemoteMetadata(ftp, entry, modify=True):
+    """
+    Function that completes the size and modify time of a remote file with SIZE and MDTM if the listing didn't have them
+
+    Parameters
+    ----------
+        - ftp : FTP Object
+            FTP connection sitting in the directory of the file
+        - entry : RemoteEntry
+            Listing entry of the remote file
+        - modify : bool
+            Also ask for the modify time if it isn't known
+
+    Returns
+    -------
+        - entry : RemoteEntry
+            The entry with the size and modify time filled in where the server provided them
+    """
+    if entry.size is None:
+        try:
+            # Many servers refuse SIZE in ASCII mode
+            ftp.voidcmd('TYPE I')
+            entry = entry._replace(size=ftp.size(entry.name))
+        except ftplib.error_perm:
+            pass
+    if modify and entry.modify is None:
+        try:
+            entry = entry._replace(modify=ftp.sendcmd('MDTM ' + entry.name)[4:].strip().split('.')[0])
+        except ftplib.error_perm:
+            pass
+    return entry
+
+def getStateDirectory():
+    """
+    Function that determines the directory where the script keeps its state between runs (manifests etc.)
+    based on the operating system being used. The directory is created if it isn't present.
+
+    Returns
+    -------
+        - stateDirectory : str
+            Path to the state directory
+    """
+    # If the platform is windows, keep the state in the current user's local app data
+    if sys.platform == 'win32' or sys.platform == 'win64': # Windows
+        stateDirectory = os.path.join(os.path.expandvars(r'%LOCALAPPDATA%'), 'AutomatedFTPDownloader')
+    # Otherwise in a hidden folder in $HOME
+    else:
+        stateDirectory = os.path.join(expanduser('~'), '.automatedFTPDownloader')
+    os.makedirs(stateDirectory, exist_ok=True)
+    return stateDirectory
+
+class SiteManifest(object):
+    """ A persistent record of the remote size and modify time of every file downloaded from a site. """
+    def __init__(self, siteName):
+        """
+        Parameters
+        ----------
+            - siteName : str
+                Name of the site in the config file, the manifest is stored under this name
+        """
+        self.siteName = siteName
+        manifestDirectory = os.path.join(getStateDirectory(), 'manifests')
+        os.makedirs(manifestDirectory, exist_ok=True)
+        self.path = os.path.join(manifestDirectory, re.sub(r'[^\w.-]', '_', siteName) + '.json')
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as stream:
+                    self.entries = json.load(stream)
+            except (ValueError, OSError) as manifestError:
+                LOGGER.writeLog("Manifest {} couldn't be read ({}), downloading every file again.".format(self.path, manifestError), severity='warning')
+
+    def isUnchanged(self, remoteEntry, localPath):
+        """
+        Function that tells whether a remote file is the same as when it was last downloaded and its local copy is still there
+
+        Parameters
+        ----------
+            - remoteEntry : RemoteEntry
+                Current listing entry of the remote file
+            - localPath : str
+                Path the file would be downloaded to
+
+        Returns
+        -------
+            - unchanged : bool
+        """
+        if remoteEntry.size is None or remoteEntry.modify is None:
+            return False
+        with self.lock:
+            entry = self.entries.get(remoteEntry.name)
+        if not entry or entry.get('partial'):
+            return False
+        if (entry['size'], entry['modify'], entry['localPath']) != (remoteEntry.size, remoteEntry.modify, localPath):
+            return False
+        if entry.get('purged'):
+            # Deleted on purpose by the retention policy, not worth downloading again until it changes
+            return True
+        return os.path.isfile(localPath) and os.path.getsize(localPath) == entry['size']
+
+    def isPartialOfOtherVersion(self, remoteEntry, localPath):
+        """
+        Function that tells whether the '.part' file of a remote file was started on a different version of it,
+        in which case the partial data can't be resumed
+
+        Parameters
+        ----------
+            - remoteEntry : RemoteEntry
+                Current listing entry of the remote file
+            - localPath : str
+                Path the file is downloaded to
+
+        Returns
+        -------
+            - otherVersion : bool
+        """
+        with self.lock:
+            entry = self.entries.get(remoteEntry.name)
+        if not entry or not entry.get('partial'):
+            return False
+        return (entry['size'], entry['modify'], entry['localPath']) != (remoteEntry.size, remoteEntry.modify, localPath)
+
+    def update(self, remoteEntry, localPath, partial=False):
+        """
+        Function that records the remote size and modify time of a file
+
+        Parameters
+        ----------
+            - remoteEntry : RemoteEntry
+                Listing entry of the remote file
+            - localPath : str
+                Path the file is downloaded to
+            - partial : bool
+                True when the download of the file was only started, False once it completed
+        """
+        entry = {
+            'size': remoteEntry.size,
+            'modify': remoteEntry.modify,
+            'localPath': localPath,
+        }
+        if partial:
+            entry['partial'] = True
+        with self.lock:
+            self.entries[remoteEntry.name] = entry
+
+    def markPurged(self, localPaths):
+        """ Function that records that the local copies of files were deleted by the retention policy, see applyRetention(). """
+        localPaths = set(localPaths)
+        with self.lock:
+            for entry in self.entries.values():
+                if entry['localPath'] in localPaths and not entry.get('partial'):
+                    entry['purged'] = True
+
+    def prune(self, names):
+        """ Function that forgets the files that are no longer in the remote listing. """
+        names = set(names)
+        with self.lock:
+            for name in [name for name in self.entries if name not in names]:
+                del self.entries[name]
+
+    def save(self):
+        """ Function that writes the manifest to disk, replacing the previous one in one step. """
+        with self.lock:
+            temporaryPath = self.path + '.tmp'
+            with open(temporaryPath, 'w') as stream:
+                json.dump(self.entries, stream, indent=1, sort_keys=True)
+            os.replace(temporaryPath, self.path)
+
+class FTPConnectionPool(object):
+    """ A pool of logged-in connections to one FTP site, all sitting in the same remote directory. """
+    def __init__(self, siteConfig, sourceDirectory, size=1, connection=None, siteName=None):
+        """
+        Parameters
+        ----------
+            - siteConfig : dict
+                Config of the site, used to open new connections
+            - sourceDirectory : str
+                Remote directory every connection of the pool is changed into
+            - size : int
+                Maximum number of connections. Connections are only opened when all the others are busy.
+            - connection : FTP Object
+                An already open connection (in the source directory) to start the pool with
+            - siteName : str
+                Name of the site the timings of the pool's connections are recorded under
+        """
+        self.siteName = siteName
+        self.siteConfig = siteConfig
+        self.sourceDirectory = sourceDirectory
+        self.size = size
+        self.connections = []
+        # Holds None too, put by discard() to wake up a thread waiting for a connection
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+        # Set when the site can't be reconnected to, every later acquire() raises it
+        self.lostError = None
+        # What the server supports, found out on the first connection that needs it: its FEAT reply,
+        # the commands it hashes files with (see getRemoteHash()) and whether it compresses transfers (see useModeZ())
+        self.features = None
+        self.hashCommands = None
+        self.modeZ = None
+        if connection is not None:
+            self.connections.append(connection)
+            self.idle.put(connection)
+
+    def acquire(self):
+        """
+        Function that hands out an idle connection, opening a new one if all are busy and the pool isn't full yet.
+        Blocks until a connection is released otherwise.
+
+        Returns
+        -------
+            - ftp : FTP Object
+                Connection in the source directory, must be given back with release()
+        """
+        while True:
+            if self.lostError is not None:
+                # Pass the wake-up on, so every waiting thread gives up
+                self.idle.put(None)
+                raise self.lostError
+            try:
+                ftp = self.idle.get_nowait()
+            except queue.Empty:
+                ftp = self.open()
+            if ftp is not None:
+                return ftp
+
+    def open(self):
+        """
+        Function that opens a new connection if the pool isn't full, or waits for one to be released otherwise.
+        When every connection was lost, opening one is retried like any transient error before the site is given up on.
+
+        Returns
+        -------
+            - ftp : FTP Object
+                Connection in the source directory, None if the thread should look at the pool again
+        """
+        with self.lock:
+            canOpen = len(self.connections) < self.size
+            if canOpen:
+                alone = not self.connections
+                # Reserve the slot before connecting so other threads don't open one too
+                self.connections.append(None)
+        if not canOpen:
+            return self.idle.get()
+
+        try:
+            if alone:
+                ftp = callWithRetries(lambda: openFtpConnection(self.siteConfig, self.sourceDirectory, siteName=self.siteName), self.siteConfig, "Reconnecting to {}".format(self.siteName), self.siteName)
+            else:
+                ftp = openFtpConnection(self.siteConfig, self.sourceDirectory, siteName=self.siteName)
+        except Exception as connectionError:
+            with self.lock:
+                self.connections.remove(None)
+                if alone:
+                    self.lostError = connectionError
+                    return None
+                if not self.connections:
+                    # The others were lost meanwhile, try again as the only one
+                    return None
+                # The server may cap the number of sessions, make do with what is open
+                self.size = len(self.connections)
+            LOGGER.writeLog("Could not open another connection to {} ({}), continuing with {}.".format(self.siteConfig['site'], connectionError, self.size), severity='warning')
+            return self.idle.get()
+
+        with self.lock:
+            self.connections[self.connections.index(None)] = ftp
+        return ftp
+
+    def run(self, function, description):
+        """
+        Function that calls function(ftp) with a connection borrowed from the pool. If the connection breaks with a
+        transient error, it is replaced by a new one (logged in and back in the source directory) and function is called again.
+
+        Parameters
+        ----------
+            - function : callable
+                Operation to run on the connection
+            - description : str
+                What the operation does, for the log
+
+        Returns
+        -------
+            - result
+                What function(ftp) returned
+        """
+        retries = getRetryCount(self.siteConfig)
+        attempt = 0
+        while True:
+            ftp = self.acquire()
+            try:
+                result = function(ftp)
+            except ftplib.error_perm:
+                self.release(ftp)
+                raise
+            except Exception as error:
+                self.discard(ftp)
+                attempt += 1
+                if attempt > retries or not isTransientError(error):
+                    raise
+                time.sleep(noteRetry(self.siteName, self.siteConfig, description, error, attempt))
+                continue
+            self.release(ftp)
+            return result
+
+    def release(self, ftp):
+        """ Function that gives a connection acquired from the pool back to it. """
+        self.idle.put(ftp)
+
+    def discard(self, ftp):
+        """
+        Function that closes a connection acquired from the pool instead of giving it back,
+        e.g. when it broke in the middle of a transfer. A new connection takes its place when needed.
+        """
+        with self.lock:
+            if ftp in self.connections:
+                self.connections.remove(ftp)
+        ftp.close()
+        # A thread waiting for a connection may open the replacement
+        self.idle.put(None)
+
+    def keepAlive(self):
+        """
+        Function that sends a NOOP over every idle connection, so the server doesn't log them out.
+        The connections that were lost are closed, acquire() opens new ones when needed.
+
+        Returns
+        -------
+            - lost : int
+                Number of connections that were lost
+        """
+        idle = []
+        while True:
+            try:
+                ftp = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            if ftp is not None:
+                idle.append(ftp)
+        lost = 0
+        for ftp in idle:
+            try:
+                ftp.voidcmd('NOOP')
+            except ftplib.all_errors:
+                lost += 1
+                with self.lock:
+                    self.connections.remove(ftp)
+                ftp.close()
+                continue
+            self.idle.put(ftp)
+        return lost
+
+    def closeAll(self, keep=None):
+        """
+        Function that closes all the connections opened by the pool
+
+        Parameters
+        ----------
+            - keep : FTP Object
+                A connection that must be left open, as it is closed by the caller
+        """
+        with self.lock:
+            connections = [ftp for ftp in self.connections if ftp is not None and ftp is not keep]
+            self.connections = [ftp for ftp in self.connections if ftp is keep]
+        for ftp in connections:
+            try:
+                ftp.quit()
+            except Exception:
+                ftp.close()
+
+def disconnectFtp(ftp, hostname):
+    """
+    Function that disconnects from the ftp connection
+
+    Parameters
+    ----------
+        - ftp : FTP Object
+            FTP connection
+        - hostname : str
+            Hostname of the FTP site that the ftp object is connected to
+    """
+    LOGGER.writeLog("Disconnecting from {}...".format(hostname), severity='normal')
+    try:
+        ftp.quit()
+    except (ftplib.all_errors + (AttributeError,)):
+        # The connection was already dropped
+        ftp.close()
+    LOGGER.writeLog("Disconnected from {}.".format(hostname), severity='normal')
+
+def unzipZippedFiles(downloadPath, downloadedFiles):
+    """
+    This function will read all the files that were downloaded, find the zip files, and unzip them.
+    The archives, and the members of large zip files, are extracted in parallel processes.
+
+    Parameters
+    ----------
+        - downloadPath : str
+            Local machine's path where the files were downloaded
+        - downloadedFiles : list
+            Name of the files that were downloaded
+
+    """
+    extractor = ExtractionPipeline()
+    for i in downloadedFiles:
+        extractor.submit(os.path.join(downloadPath, i), downloadPath)
+    extractor.finish()
+
+def extractArchive(archivePath, destination, part=0, parts=1):
+    """
+    Function that extracts a zip or tar file, or decompresses a gzip, bz2 or xz file.
+    Members that are already extracted and unchanged are skipped: zip members by their size and CRC,
+    tar members by their size and modify time. It runs in the extraction processes, so it must not log.
+
+    Parameters
+    ----------
+        - archivePath : str
+            Path to the downloaded file
+        - destination : str
+            Directory to extract the archive into
+        - part : int
+            Share of the members of a zip file to extract, from 0
+        - parts : int
+            Number of processes the members of a zip file are shared between, see getExtractionParts()
+
+    Returns
+    -------
+        - timing : dict
+            'archive' path, 'kind' of archive, number of 'members', how many of them were 'skipped'
+            and 'seconds' the extraction took. None if the file isn't an archive.
+    """
+    import zipfile
+    import tarfile
+    startTime = time.perf_counter()
+    # Check if file is zip file and unzip it
+    if zipfile.is_zipfile(archivePath):
+        members, skipped = extractZipMembers(archivePath, destination, part, parts)
+        kind = 'zip'
+    # Check if tar file
+    elif tarfile.is_tarfile(archivePath):
+        members, skipped = extractTarMembers(archivePath, destination)
+        kind = 'tar'
+    elif os.path.splitext(archivePath)[1].lower() in COMPRESSED_FILE_MODULES:
+        members, skipped = 1, decompressFile(archivePath, destination)
+        kind = os.path.splitext(archivePath)[1].lower().lstrip('.')
+    else:
+        return None
+    return {
+        'archive': archivePath,
+        'kind': kind,
+        'members': members,
+        'skipped': skipped,
+        'seconds': time.perf_counter() - startTime,
+    }
+
+def extractZipMembers(archivePath, destination, part=0, parts=1):
+    """
+    Function that extracts the members of a zip file that changed since they were last extracted
+
+    Returns
+    -------
+        - members : int
+            Number of members in this part
+        - skipped : int
+            Number of members that were already extracted
+    """
+    import zipfile
+    members = 0
+    skipped = 0
+    with zipfile.ZipFile(archivePath, 'r') as zipObj:
+        for member in shareZipMembers(zipObj.infolist(), parts)[part]:
+            members += 1
+            targetPath = getMemberPath(destination, member.filename)
+            if targetPath is None:
+                continue
+            if member.is_dir():
+                os.makedirs(targetPath, exist_ok=True)
+                continue
+            if isExtractedFileCurrent(targetPath, member.file_size, crc=member.CRC):
+                skipped += 1
+                continue
+            # Other processes extract into the same directories
+            os.makedirs(os.path.dirname(targetPath), exist_ok=True)
+            with zipObj.open(member) as source:
+                writeMemberFile(source, targetPath)
+    return members, skipped
+
+def extractTarMembers(archivePath, destination):
+    """
+    Function that extracts the members of a tar file that changed since they were last extracted.
+    The tar file is read once from start to end, so compressed tar files are never decompressed twice.
+    Member names are mapped like zip members, so nothing is written outside of the destination. Links and
+    special files are only extracted where tarfile has the 'data' filter, which rejects the unsafe ones.
+
+    Returns
+    -------
+        - members : int
+            Number of members
+        - skipped : int
+            Number of members that were already extracted
+    """
+    import tarfile
+    members = 0
+    skipped = 0
+    with tarfile.open(archivePath) as tarFile:
+        for member in tarFile:
+            members += 1
+            targetPath = getMemberPath(destination, member.name)
+            if targetPath is None:
+                continue
+            if member.isdir():
+                os.makedirs(targetPath, exist_ok=True)
+                continue
+            if not member.isfile():
+                if hasattr(tarfile, 'data_filter'):
+                    try:
+                        tarFile.extract(member, destination, filter='data')
+                    except tarfile.FilterError:
+                        pass
+                continue
+            if isExtractedFileCurrent(targetPath, member.size, mtime=member.mtime):
+                skipped += 1
+                continue
+            os.makedirs(os.path.dirname(targetPath), exist_ok=True)
+            with tarFile.extractfile(member) as source:
+                writeMemberFile(source, targetPath, mtime=member.mtime, mode=member.mode)
+    return members, skipped
+
+def writeMemberFile(source, targetPath, mtime=None, mode=None):
+    """
+    Function that writes an archive member under a temporary name and renames it into place,
+    so a member cut short by a crash is never taken for an extracted one
+
+    Parameters
+    ----------
+        - source : file object
+            Stream of the member's data
+        - targetPath : str
+            Path the member is extracted to
+        - mtime : int
+            Modify time given to the file, e.g. the tar member's, the current time if None
+        - mode : int
+            Permission bits of the member, only the read, write and execute bits are kept
+    """
+    import shutil
+    partPath = targetPath + '.part'
+    try:
+        with open(partPath, 'wb') as target:
+            shutil.copyfileobj(source, target, EXTRACTION_BLOCK_SIZE)
+        if mode is not None:
+            os.chmod(partPath, mode & 0o777)
+        if mtime is not None:
+            os.utime(partPath, (mtime, mtime))
+        os.replace(partPath, targetPath)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(partPath)
+        raise
+
+def decompressFile(archivePath, destination):
+    """
+    Function that decompresses a gzip, bz2 or xz file next to it, without its extension, a block at a time.
+    The decompressed file gets the modify time of the compressed one, so an unchanged file is skipped the next time.
+
+    Returns
+    -------
+        - skipped : int
+            1 if the file was already decompressed, 0 otherwise
+    """
+    import shutil
+    extension = os.path.splitext(archivePath)[1].lower()
+    targetPath = os.path.join(destination, os.path.splitext(os.path.basename(archivePath))[0])
+    archiveStat = os.stat(archivePath)
+    size = None
+    if extension == '.gz':
+        # The last 4 bytes of a gzip file hold the decompressed size (modulo 4 GiB)
+        with open(archivePath, 'rb') as stream:
+            stream.seek(-4, os.SEEK_END)
+            size = int.from_bytes(stream.read(4), 'little')
+    if isExtractedFileCurrent(targetPath, size, mtime=int(archiveStat.st_mtime), sizeModulo=2 ** 32):
+        return 1
+
+    module = importlib.import_module(COMPRESSED_FILE_MODULES[extension])
+    partPath = targetPath + '.part'
+    with module.open(archivePath, 'rb') as source, open(partPath, 'wb') as target:
+        shutil.copyfileobj(source, target, EXTRACTION_BLOCK_SIZE)
+    os.utime(partPath, (archiveStat.st_atime, int(archiveStat.st_mtime)))
+    os.replace(partPath, targetPath)
+    return 0
+
+def isExtractedFileCurrent(path, size=None, crc=None, mtime=None, sizeModulo=None):
+    """
+    Function that tells whether a file extracted before matches an archive member, so it doesn't need extracting again
+
+    Parameters
+    ----------
+        - path : str
+            Path the member is extracted to
+        - size : int
+            Size of the member, not checked if None
+        - crc : int
+            CRC32 of the member, the file is read to check it
+        - mtime : int
+            Modify time of the member, in seconds
+        - sizeModulo : int
+            Only compare the size modulo this, e.g. for the 32 bit size of gzip
+
+    Returns
+    -------
+        - current : bool
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    fileSize = stat.st_size % sizeModulo if sizeModulo else stat.st_size
+    if size is not None and fileSize != size:
+        return False
+    if mtime is not None and int(stat.st_mtime) != int(mtime):
+        return False
+    if crc is not None:
+        checksum = 0
+        with open(path, 'rb') as stream:
+            for block in iter(lambda: stream.read(EXTRACTION_BLOCK_SIZE), b''):
+                checksum = zlib.crc32(block, checksum)
+        return checksum == crc
+    return True
+
+def getMemberPath(destination, name):
+    """
+    Function that maps the name of a zip member to the path it is extracted to. Like zipfile does,
+    drive letters and '..' are dropped, so the path never leaves the destination.
+
+    Returns
+    -------
+        - path : str
+            None if nothing is left of the name
+    """
+    names = re.split(r'[\\/]', name) if os.sep == '\\' else name.split('/')
+    parts = [os.path.splitdrive(part)[1] for part in names]
+    parts = [part for part in parts if part not in ('', os.curdir, os.pardir)]
+    if not parts:
+        return None
+    return os.path.join(destination, *parts)
+
+def shareZipMembers(members, parts):
+    """
+    Function that shares the members of a zip file between extraction processes, so that each gets about the
+    same amount of data. Every process computes the same shares and extracts its own.
+
+    Returns
+    -------
+        - shares : list
+            A list of members for each part
+    """
+    shares = [[] for part in range(parts)]
+    loads = [0] * parts
+    # Largest first, each to the least loaded share
+    for member in sorted(members, key=lambda member: (-member.file_size, member.filename)):
+        part = loads.index(min(loads))
+        shares[part].append(member)
+        loads[part] += member.file_size
+    return shares
+
+def getExtractionParts(archivePath, workers):
+    """
+    Function that decides how many processes extract an archive: a large zip file is shared between
+    all the workers, anything else is extracted by one.
+    """
+    import zipfile
+    try:
+        if os.path.getsize(archivePath) < PARALLEL_EXTRACTION_SIZE or not zipfile.is_zipfile(archivePath):
+            return 1
+        with zipfile.ZipFile(archivePath, 'r') as zipObj:
+            files = sum(1 for member in zipObj.infolist() if not member.is_dir())
+    except (OSError, zipfile.BadZipFile):
+        return 1
+    return max(1, min(workers, files))
+
+def mergeTimings(timings):
+    """ Function that combines the timings of the parts of an archive extracted by several processes into one. """
+    timings = [timing for timing in timings if timing is not None]
+    if not timings:
+        return None
+    return {
+        'archive': timings[0]['archive'],
+        'kind': timings[0]['kind'],
+        'members': sum(timing['members'] for timing in timings),
+        'skipped': sum(timing['skipped'] for timing in timings),
+        'seconds': max(timing['seconds'] for timing in timings),
+        'parts': len(timings),
+    }
+
+def startExtractionProcess():
+    """ Function that does nothing, it is run once to start the extraction processes. """
+    return None
+
+class ExtractionPipeline(object):
+    """ Extracts downloaded archives in a pool of processes while the downloads go on. """
+    def __init__(self, workers=None):
+        """
+        Parameters
+        ----------
+            - workers : int
+                Number of extraction processes, the number of CPUs by default
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        import multiprocessing
+        self.workers = workers or os.cpu_count() or 1
+        # Not forked: the logger's writer thread is already running, and a fork copies its locks
+        # as they are, held or not, so a process could hang on one forever
+        startMethod = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(startMethod))
+        # Start the processes now, so the first archive doesn't wait for them
+        self.executor.submit(startExtractionProcess).result()
+        self.extractions = []
+        self.lock = threading.Lock()
+
+    def submit(self, archivePath, destination, siteName=None):
+        """
+        Function that queues a downloaded file for extraction, it is skipped if it isn't an archive.
+        The members of a large zip file are shared between the processes.
+
+        Parameters
+        ----------
+            - archivePath : str
+                Path to the downloaded file
+            - destination : str
+                Directory to extract the archive into
+            - siteName : str
+                Name of the site the extraction timing is recorded under
+        """
+        parts = getExtractionParts(archivePath, self.workers)
+        extraction = {
+            'archive': archivePath,
+            'siteName': siteName,
+            'futures': [self.executor.submit(extractArchive, archivePath, destination, part, parts) for part in range(parts)],
+            'pending': parts,
+        }
+        with self.lock:
+            self.extractions.append(extraction)
+        for future in extraction['futures']:
+            future.add_done_callback(lambda future: self.logResult(extraction))
+
+    def logResult(self, extraction):
+        """ Function called as the parts of an extraction finish, it records the extraction or its failure once every part is done. """
+        with self.lock:
+            extraction['pending'] -= 1
+            if extraction['pending']:
+                return
+        errors = [future.exception() for future in extraction['futures'] if future.exception() is not None]
+        if errors:
+            LOGGER.writeLog("Extracting {} failed: {}".format(extraction['archive'], errors[0]), severity='error')
+            return
+        timing = mergeTimings([future.result() for future in extraction['futures']])
+        if timing is not None:
+            METRICS.addSpan(extraction['siteName'], 'extraction', timing['seconds'], file=timing['archive'], kind=timing['kind'], members=timing['members'], skipped=timing['skipped'], parts=timing['parts'])
+            LOGGER.writeLog("Unzipped {} in {} milliseconds ({} of {} members were already extracted).".format(timing['archive'], int(timing['seconds'] * 1000), timing['skipped'], timing['members']), severity='normal')
+
+    def collect(self):
+        """ Function that forgets the extractions that are done, so a long running daemon doesn't hold on to all of them. """
+        with self.lock:
+            self.extractions = [extraction for extraction in self.extractions if extraction['pending']]
+
+    def finish(self):
+        """
+        Function that waits for the queued extractions and stops the processes
+
+        Returns
+        -------
+            - extractionTimings : list
+                Timing of every extracted archive, see extractArchive()
+        """
+        extractionTimings = []
+        with self.lock:
+            extractions = list(self.extractions)
+        for extraction in extractions:
+            try:
+                timing = mergeTimings([future.result() for future in extraction['futures']])
+            except Exception:
+                # Logged by logResult()
+                continue
+            if timing is not None:
+                extractionTimings.append(timing)
+        self.executor.shutdown()
+        return extractionTimings
+
+""" Listing filters starts """
+class ListingFilter(object):
+    """ Rules of a site picking the files of a listing worth downloading, applied before any data connection is opened. """
+    def __init__(self, include=None, exclude=None, minSize=None, maxSize=None, modifiedSince=None, newestPerPattern=None):
+        """
+        Parameters
+        ----------
+            - include : list
+                Patterns of the files to download, every file if empty. See compileNamePattern().
+            - exclude : list
+                Patterns of the files not to download, even if included
+            - minSize, maxSize : int
+                Bounds of the size of the files to download, in bytes
+            - modifiedSince : str
+                Modify time (YYYYMMDDHHMMSS, UTC) files must be as recent as to be downloaded
+            - newestPerPattern : int
+                Only download this many of the latest files of every name pattern (e.g. 'export_#.csv') in a directory
+        """
+        self.include = [compileNamePattern(pattern) for pattern in include or []]
+        self.exclude = [compileNamePattern(pattern) for pattern in exclude or []]
+        self.minSize = minSize
+        self.maxSize = maxSize
+        self.modifiedSince = modifiedSince
+        self.newestPerPattern = newestPerPattern
+
+    def matches(self, entry):
+        """ Function that tells if a file passes the rules that don't depend on the other files. A size or modify time the listing didn't give passes. """
+        if self.include and not any(matchNamePattern(pattern, entry.name) for pattern in self.include):
+            return False
+        if any(matchNamePattern(pattern, entry.name) for pattern in self.exclude):
+            return False
+        if entry.size is not None:
+            if (self.minSize is not None and entry.size < self.minSize) or (self.maxSize is not None and entry.size > self.maxSize):
+                return False
+        if self.modifiedSince is not None and entry.modify is not None and entry.modify < self.modifiedSince:
+            return False
+        return True
+
+    def apply(self, entries):
+        """
+        Function that filters the files of one listing, directories are kept
+
+        Returns
+        -------
+            - kept : list
+                Entries to download or walk
+            - excluded : list
+                Entries of the files the rules exclude
+        """
+        kept = []
+        excluded = []
+        for entry in entries:
+            if entry.type == 'dir' or self.matches(entry):
+                kept.append(entry)
+            else:
+                excluded.append(entry)
+        if self.newestPerPattern is not None:
+            groups = {}
+            for entry in kept:
+                if entry.type != 'dir':
+                    groups.setdefault((posixpath.dirname(entry.name), getNamePattern(entry.name)), []).append(entry)
+            older = set()
+            for group in groups.values():
+                # Files without a modify time count as the oldest
+                group.sort(key=lambda entry: entry.modify or '', reverse=True)
+                older.update(entry.name for entry in group[self.newestPerPattern:])
+            excluded.extend(entry for entry in kept if entry.name in older)
+            kept = [entry for entry in kept if entry.name not in older]
+        return kept, excluded
+
+def compileNamePattern(pattern):
+    """
+    Function that compiles a file name pattern of the filters
+
+    Parameters
+    ----------
+        - pattern : str
+            A glob, e.g. '*.csv', or a regular expression prefixed by 're:', e.g. 're:^export_\\d{8}\\.csv$'.
+            A glob is matched against the file name, or the path relative to the remote path if it has a '/' in it.
+            A regular expression is searched for in the path relative to the remote path.
+
+    Returns
+    -------
+        - pattern : tuple
+            (compiled regular expression, whether the whole path is matched)
+    """
+    pattern = str(pattern)
+    if pattern.startswith('re:'):
+        return re.compile(pattern[3:]), True
+    import fnmatch
+    return re.compile(fnmatch.translate(pattern)), '/' in pattern
+
+def matchNamePattern(pattern, name):
+    """ Function that tells if a file, named by its path relative to the remote path, matches a compiled pattern. """
+    regex, wholePath = pattern
+    if wholePath:
+        return regex.search(name) is not None
+    return regex.match(posixpath.basename(name)) is not None
+
+def parseModifiedSince(value, now=None):
+    """
+    Function that reads the 'modified_since' filter from the config
+
+    Parameters
+    ----------
+        - value : str
+            A duration before now, e.g. '24h' or 'last 7d', or a UTC date and time, e.g. '2024-01-31' or '2024-01-31 06:00'
+        - now : float
+            Current time, time.time() by default
+
+    Returns
+    -------
+        - modifiedSince : str
+            The time as YYYYMMDDHHMMSS, comparable with the listings' modify times. None if no value is given.
+
+    Raises
+    ------
+        - ValueError
+            If the value is neither a duration nor a date
+    """
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.strftime('%Y%m%d%H%M%S')
+    if hasattr(value, 'strftime'):
+        # YAML reads an unquoted date as a date
+        return value.strftime('%Y%m%d000000')
+    text = str(value).strip()
+    if text.lower().startswith('last '):
+        text = text[5:]
+    try:
+        seconds = parseDuration(text)
+    except ValueError:
+        pass
+    else:
+        now = time.time() if now is None else now
+        return datetime.utcfromtimestamp(now - seconds).strftime('%Y%m%d%H%M%S')
+    for dateFormat in MODIFIED_SINCE_FORMATS:
+        try:
+            return datetime.strptime(text, dateFormat).strftime('%Y%m%d%H%M%S')
+        except ValueError:
+            pass
+    raise ValueError("invalid modified_since: {!r}".format(value))
+
+def getListingFilter(siteConfig):
+    """
+    Function that reads the filters of a site from its config. A relative 'modified_since' is taken from now,
+    so it is read again for every run.
+
+    Parameters
+    ----------
+        - siteConfig : dict
+            Config of the site, optionally with a `filters` dict of `include` and `exclude` patterns,
+            `min_size`, `max_size`, `modified_since` and `newest_per_pattern`
+
+    Returns
+    -------
+        - listingFilter : ListingFilter
+            None if the site downloads every file
+    """
+    filters = (siteConfig or {}).get('filters')
+    if not filters:
+        return None
+    def getPatterns(key):
+        patterns = filters.get(key) or []
+        return [patterns] if isinstance(patterns, str) else list(patterns)
+    try:
+        return ListingFilter(
+            include=getPatterns('include'),
+            exclude=getPatterns('exclude'),
+            minSize=parseSize(filters.get('min_size')),
+            maxSize=parseSize(filters.get('max_size')),
+            modifiedSince=parseModifiedSince(filters.get('modified_since')),
+            newestPerPattern=None if filters.get('newest_per_pattern') is None else int(filters['newest_per_pattern']),
+        )
+    except (AttributeError, TypeError, ValueError, re.error) as filterError:
+        LOGGER.writeLog("Invalid filters for {}, downloading every file: {}".format(siteConfig['site'], filterError), severity='warning')
+        return None
+
+def filterEntries(entries, listingFilter, siteName):
+    """
+    Function that drops the files of a listing the site's filters exclude, and counts them
+
+    Parameters
+    ----------
+        - entries : list
+            RemoteEntry of every file and directory of the listing
+        - listingFilter : ListingFilter
+            Filters of the site, None to keep every entry
+        - siteName : str
+            Name of the site the excluded files are counted under
+
+    Returns
+    -------
+        - entries : list
+            The entries to download or walk
+    """
+    if listingFilter is None:
+        return entries
+    kept, excluded = listingFilter.apply(entries)
+    if excluded:
+        excludedBytes = sum(entry.size or 0 for entry in excluded)
+        METRICS.increment(siteName, 'excludedFiles', len(excluded))
+        METRICS.increment(siteName, 'excludedBytes', excludedBytes)
+        LOGGER.writeLog("{} files ({} bytes) excluded by the filters of {}.".format(len(excluded), excludedBytes, siteName), severity='normal')
+    return kept
+""" Listing filters ends """
+
+""" Retention starts """
+class DownloadIndex(object):
+    """
+    A persistent record of the files downloaded from a site, with their size and the time they were downloaded,
+    so that old files can be found without walking the download directory.
+    """
+    def __init__(self, siteName):
+        """
+        Parameters
+        ----------
+            - siteName : str
+                Name of the site in the config file, the index is stored under this name
+        """
+        self.siteName = siteName
+        indexDirectory = os.path.join(getStateDirectory(), 'downloads')
+        os.makedirs(indexDirectory, exist_ok=True)
+        self.path = os.path.join(indexDirectory, re.sub(r'[^\w.-]', '_', siteName) + '.json')
+        self.lock = threading.Lock()
+        # Local path to [size, download time]
+        self.files = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as stream:
+                    self.files = json.load(stream)
+            except (ValueError, OSError) as indexError:
+                LOGGER.writeLog("Download index {} couldn't be read ({}), files downloaded before won't be purged.".format(self.path, indexError), severity='warning')
+
+    def add(self, localPath, size):
+        """ Function that records a file that was just downloaded. """
+        with self.lock:
+            self.files[localPath] = [size, time.time()]
+
+    def remove(self, localPaths):
+        """ Function that forgets files, e.g. once they are purged. """
+        with self.lock:
+            for localPath in localPaths:
+                self.files.pop(localPath, None)
+
+    def getFiles(self):
+        """
+        Function that lists the indexed files
+
+        Returns
+        -------
+            - files : list
+                (localPath, size, downloadTime) of every file, the most recently downloaded first
+        """
+        with self.lock:
+            files = [(localPath, size, downloadTime) for localPath, (size, downloadTime) in self.files.items()]
+        return sorted(files, key=lambda file: file[2], reverse=True)
+
+    def save(self):
+        """ Function that writes the index to disk, replacing the previous one in one step. """
+        with self.lock:
+            content = json.dumps(self.files, indent=1, sort_keys=True)
+        writeFileAtomically(self.path, content)
+
+def parseDuration(value):
+    """
+    Function that reads a duration from the config, e.g. 90, '36h' or '7d'
+
+    Returns
+    -------
+        - seconds : float
+            None if no value is given
+
+    Raises
+    ------
+        - ValueError
+            If the value isn't a number with an optional s, m, h, d or w unit
+    """
+    if value is None:
+        return None
+    match = re.match(r'^([\d.]+)\s*([smhdw]?)$', str(value).strip().lower())
+    if not match:
+        raise ValueError("invalid duration: {!r}".format(value))
+    return float(match.group(1)) * DURATION_UNITS[match.group(2) or 's']
+
+def parseSize(value):
+    """
+    Function that reads a size from the config, e.g. 1048576, '500M' or '20G'
+
+    Returns
+    -------
+        - bytes : int
+            None if no value is given
+
+    Raises
+    ------
+        - ValueError
+            If the value isn't a number with an optional K, M, G or T unit (KB, KiB etc. work too)
+    """
+    if value is None:
+        return None
+    match = re.match(r'^([\d.]+)\s*([kmgt]?)i?b?$', str(value).strip().lower())
+    if not match:
+        raise ValueError("invalid size: {!r}".format(value))
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2) or 'b'])
+
+def getRetentionPolicy(siteConfig):
+    """
+    Function that reads the retention policy of a site from its config
+
+    Parameters
+    ----------
+        - siteConfig : dict
+            Config of the site, optionally with a `retention` dict of
+            `max_age` (keep files downloaded within this duration), `max_files` (keep this many of the latest files)
+            and `max_size` (keep the latest files up to this total size)
+
+    Returns
+    -------
+        - policy : dict
+            'maxAge' in seconds, 'maxFiles' and 'maxSize' in bytes, each None if not limited.
+            None if the site keeps every file.
+    """
+    retention = (siteConfig or {}).get('retention')
+    if not retention:
+        return None
+    try:
+        policy = {
+            'maxAge': parseDuration(retention.get('max_age')),
+            'maxFiles': None if retention.get('max_files') is None else int(retention['max_files']),
+            'maxSize': parseSize(retention.get('max_size')),
+        }
+    except (AttributeError, TypeError, ValueError) as policyError:
+        LOGGER.writeLog("Invalid retention policy for {}, keeping every file: {}".format(siteConfig['site'], policyError), severity='warning')
+        return None
+    if all(limit is None for limit in policy.values()):
+        return None
+    return policy
+
+def selectExpiredFiles(files, policy, now=None, keep=()):
+    """
+    Function that picks the files a retention policy doesn't keep. The oldest files go first: once a file
+    doesn't fit in the limits, every file downloaded before it is expired too.
+
+    Parameters
+    ----------
+        - files : list
+            (localPath, size, downloadTime) of the files, the most recently downloaded first, see DownloadIndex.getFiles()
+        - policy : dict
+            Retention policy, see getRetentionPolicy()
+        - now : float
+            Current time, time.time() by default
+        - keep : set
+            Local paths of the files that are never expired, e.g. those downloaded by the current run.
+            They still count towards the limits.
+
+    Returns
+    -------
+        - expired : list
+            (localPath, size) of the files to delete
+    """
+    now = time.time() if now is None else now
+    expired = []
+    keptFiles = 0
+    keptSize = 0
+    full = False
+    for localPath, size, downloadTime in files:
+        size = size or 0
+        if localPath not in keep:
+            full = full or (policy['maxFiles'] is not None and keptFiles >= policy['maxFiles']) or \
+                (policy['maxSize'] is not None and keptSize + size > policy['maxSize'])
+            if full or (policy['maxAge'] is not None and now - downloadTime > policy['maxAge']):
+                expired.append((localPath, size))
+                continue
+        keptFiles += 1
+        keptSize += size
+    return expired
+
+def applyRetention(siteName, siteConfig, index, manifest=None, keep=()):
+    """
+    Function that purges the files of a site its retention policy doesn't keep. The files are picked from the
+    download index and deleted in the background. Their manifest entries are kept and marked as purged, so a
+    purged file is only downloaded again if it changes on the server.
+
+    Parameters
+    ----------
+        - siteName : str
+            Name of the site in the config file
+        - siteConfig : dict
+            Config of the site, see getRetentionPolicy()
+        - index : DownloadIndex
+            Index of the files downloaded from the site
+        - manifest : SiteManifest
+            Manifest of the site, if the site is downloaded incrementally
+        - keep : list
+            Local paths of the files downloaded by the current run. They are never purged, they may still be
+            reported or waiting to be extracted.
+
+    Returns
+    -------
+        - purged : int
+            Number of files handed over for deletion
+    """
+    policy = getRetentionPolicy(siteConfig)
+    if policy is None:
+        return 0
+    expired = selectExpiredFiles(index.getFiles(), policy, keep=set(keep))
+    if not expired:
+        return 0
+    localPaths = [localPath for localPath, size in expired]
+    purgedBytes = sum(size for localPath, size in expired)
+    index.remove(localPaths)
+    if manifest is not None:
+        manifest.markPurged(localPaths)
+    DELETER.submit(localPaths)
+    METRICS.increment(siteName, 'purgedFiles', len(localPaths))
+    METRICS.increment(siteName, 'purgedBytes', purgedBytes)
+    LOGGER.writeLog("Purging {} files ({} bytes) of {} kept longer than its retention policy allows...".format(len(localPaths), purgedBytes, siteName), severity='normal')
+    return len(localPaths)
+
+def purge(directory, prefix):
+    """
+    Function that deletes, in the background, the files directly in a directory whose name starts with a prefix.
+    Only the directory itself is read, nothing under it is walked.
+
+    Parameters
+    ----------
+        - directory : str
+            Path of the download directory
+        - prefix : str
+            Start of the names of the files to delete
+
+    Returns
+    -------
+        - count : int
+            The number of files handed over for deletion
+    """
+    paths = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.startswith(prefix) and not entry.name.endswith('.py') and entry.is_file(follow_symlinks=False):
+                    paths.append(entry.path)
+    except OSError as scanError:
+        LOGGER.writeLog("{} couldn't be read for purging: {}".format(directory, scanError), severity='warning')
+    DELETER.submit(paths)
+    return len(paths)
+
+class BackgroundDeleter(object):
+    """ Deletes files in a background thread, so that purging many files doesn't hold up the downloads. """
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, paths):
+        """
+        Function that queues files for deletion. A file written again after it was queued, e.g. downloaded
+        anew under the same name, is left alone.
+
+        Parameters
+        ----------
+            - paths : list
+                Paths of the files to delete
+        """
+        if not paths:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.work, name='deleter', daemon=True)
+                self.thread.start()
+        self.queue.put((list(paths), time.time()))
+
+    def work(self):
+        while True:
+            paths, queuedTime = self.queue.get()
+            try:
+                for path in paths:
+                    self.delete(path, queuedTime)
+            finally:
+                self.queue.task_done()
+
+    def delete(self, path, queuedTime):
+        try:
+            if os.stat(path).st_mtime > queuedTime:
+                return
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as deleteError:
+            LOGGER.writeLog("{} couldn't be purged: {}".format(path, deleteError), severity='warning')
+
+    def join(self):
+        """ Function that waits until every queued file has been deleted. """
+        self.queue.join()
+""" Retention ends """
+
+""" Content store starts """
+class ContentStore(object):
+    """
+    Every file downloaded from the sites that use it, kept once by content (SHA-256) as a 'blob'.
+    The downloaded files are hardlinks to the blobs, so identical files from different sites or days take the space of one.
+    """
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+            - path : str
+                Directory of the store, it must be on the same file system as the download directory
+        """
+        self.path = path
+        self.indexPath = os.path.join(path, 'index.json')
+        self.lock = threading.Lock()
+        # Digest to the 'size', other digests and name 'patterns' of the blob
+        self.blobs = {}
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(self.indexPath):
+            try:
+                with open(self.indexPath, 'r') as stream:
+                    self.blobs = json.load(stream)
+            except (ValueError, OSError) as indexError:
+                LOGGER.writeLog("Content store index {} couldn't be read ({}), starting a new one.".format(self.indexPath, indexError), severity='warning')
+        # (name pattern, size) to the digests of the blobs, see findCandidates()
+        self.candidates = {}
+        for digest, blob in self.blobs.items():
+            for pattern in blob['patterns']:
+                self.candidates.setdefault((pattern, blob['size']), set()).add(digest)
+
+    def getBlobPath(self, digest):
+        return os.path.join(self.path, 'blobs', digest[:2], digest)
+
+    def add(self, localPath, name, digests):
+        """
+        Function that stores a file that was just downloaded: a duplicate of a blob is replaced by a hardlink to it,
+        anything else becomes a new blob
+
+        Parameters
+        ----------
+            - localPath : str
+                Path of the downloaded file
+            - name : str
+                Remote name of the file
+            - digests : dict
+                Hex digest of the file by algorithm, with at least the STORE_ALGORITHMS, see PartFile.getDigests()
+
+        Returns
+        -------
+            - duplicate : bool
+                True if the file was replaced by a hardlink to a blob
+        """
+        digest = digests['sha256']
+        size = os.path.getsize(localPath)
+        blobPath = self.getBlobPath(digest)
+        pattern = getNamePattern(name)
+        with self.lock:
+            try:
+                duplicate = os.path.isfile(blobPath) and os.path.getsize(blobPath) == size
+                if not duplicate:
+                    os.makedirs(os.path.dirname(blobPath), exist_ok=True)
+                    linkFile(localPath, blobPath)
+                elif not os.path.samefile(blobPath, localPath):
+                    linkFile(blobPath, localPath)
+            except OSError as linkError:
+                LOGGER.writeLog("{} couldn't be linked with the content store at {}, keeping a separate copy: {}".format(localPath, self.path, linkError), severity='warning')
+                return False
+            blob = self.blobs.setdefault(digest, {'size': size, 'patterns': []})
+            blob.update((algorithm, digests[algorithm]) for algorithm in STORE_ALGORITHMS if algorithm in digests)
+            if pattern not in blob['patterns']:
+                blob['patterns'].append(pattern)
+            self.candidates.setdefault((pattern, size), set()).add(digest)
+        return duplicate
+
+    def findCandidates(self, entry):
+        """
+        Function that finds the blobs a remote file may be a copy of, by its size and the pattern of its name
+
+        Returns
+        -------
+            - candidates : list
+                (digest, blob) of the blobs
+        """
+        if entry.size is None:
+            return []
+        with self.lock:
+            digests = self.candidates.get((getNamePattern(entry.name), entry.size), ())
+            return [(digest, dict(self.blobs[digest])) for digest in digests]
+
+    def link(self, digest, localPath):
+        """ Function that puts a hardlink to a blob at a local path. """
+        os.makedirs(os.path.dirname(localPath), exist_ok=True)
+        with self.lock:
+            linkFile(self.getBlobPath(digest), localPath)
+
+    def save(self):
+        """ Function that writes the index of the store to disk, replacing the previous one in one step. """
+        with self.lock:
+            content = json.dumps(self.blobs, indent=1, sort_keys=True)
+        writeFileAtomically(self.indexPath, content)
+
+def getContentStore(siteConfig):
+    """
+    Function that returns the content store a site uses, if `dedup: true` is in its config.
+    An optional `dedup_store` sets the directory of the store, 'store' in the state directory by default.
+    Sites using the same directory share the store.
+
+    Returns
+    -------
+        - store : ContentStore
+            None if the site doesn't deduplicate its downloads
+    """
+    if not (siteConfig or {}).get('dedup'):
+        return None
+    path = os.path.abspath(expanduser(siteConfig.get('dedup_store') or os.path.join(getStateDirectory(), 'store')))
+    with CONTENT_STORES_LOCK:
+        if path not in CONTENT_STORES:
+            CONTENT_STORES[path] = ContentStore(path)
+        return CONTENT_STORES[path]
+
+def getNamePattern(name):
+    """ Function that turns a file name into the pattern files republished under a new name share, e.g. 'catalog_#-#-#.csv'. """
+    return re.sub(r'\d+', '#', posixpath.basename(name))
+
+def linkFile(sourcePath, targetPath):
+    """ Function that replaces a file by a hardlink to another one, in one step. """
+    temporaryPath = '{}.{}.link'.format(targetPath, os.getpid())
+    os.link(sourcePath, temporaryPath)
+    try:
+        os.replace(temporaryPath, targetPath)
+    except OSError:
+        os.remove(temporaryPath)
+        raise
+
+def storeDownload(store, entry, localPath, digests, siteName):
+    """ Function that hands a completed download to the content store and counts it if it was a duplicate. """
+    if store is None or not store.add(localPath, entry.name, digests):
+        return
+    METRICS.increment(siteName, 'linkedFiles')
+    METRICS.increment(siteName, 'linkedBytes', os.path.getsize(localPath))
+    LOGGER.writeLog("{} is identical to a file downloaded before, it is stored once.".format(entry.name), severity='normal')
+
+def getHashCommands(features):
+    """
+    Function that lists the commands a server may hash a file with, from its features
+
+    Returns
+    -------
+        - commands : list
+            (command, algorithm) in order of preference, see HASH_COMMANDS
+    """
+    hashNames = [hashName.strip().rstrip('*').upper() for hashName in features.get('HASH', '').split(';')]
+    commands = []
+    for command, algorithm in HASH_COMMANDS:
+        # Servers often answer XMD5 and XCRC without listing them, they are tried anyway
+        if command != 'HASH' or HASH_NAMES[algorithm] in hashNames:
+            commands.append((command, algorithm))
+    return commands
+
+def parseHashReply(command, algorithm, reply):
+    """
+    Function that reads the digest out of the reply to a hash command:
+    '213 SHA-256 0-49 <digest> name' for HASH, '250 <digest>' for XMD5 and XCRC
+
+    Returns
+    -------
+        - digest : str
+            Lowercase hex digest, None if there is none
+    """
+    tokens = reply[4:].split()
+    for token in (tokens[2:3] if command == 'HASH' else tokens):
+        if re.match(r'^[0-9a-fA-F]+$', token):
+            return token.lower().zfill(8) if algorithm == 'crc32' else token.lower()
+    return None
+
+def isUnsupportedCommand(permanentError):
+    """ Function that tells whether a 5xx reply means the command isn't supported, rather than that the file can't be hashed. """
+    return str(permanentError)[:3] in ('500', '501', '502', '504')
+
+def getRemoteHash(ftp, pool, name):
+    """
+    Function that asks the server for the digest of a file, with the first hash command it supports.
+    What the server supports is found out once per pool.
+
+    Parameters
+    ----------
+        - ftp : FTP Object
+            Connection of the pool in the directory of the file
+        - pool : FTPConnectionPool
+            Pool of the connection, keeps the hash commands of the server
+        - name : str
+            Path of the file, relative to the pool's directory
+
+    Returns
+    -------
+        - remoteHash : tuple
+            (algorithm, hex digest), None if the server can't hash the file
+    """
+    if pool.hashCommands is None:
+        pool.hashCommands = getHashCommands(getServerFeatures(ftp, pool))
+    for command, algorithm in list(pool.hashCommands):
+        try:
+            if command == 'HASH':
+                ftp.sendcmd('OPTS HASH ' + HASH_NAMES[algorithm])
+            reply = ftp.sendcmd('{} {}'.format(command, name))
+        except ftplib.error_perm as permanentError:
+            if not isUnsupportedCommand(permanentError):
+                return None
+            if (command, algorithm) in pool.hashCommands:
+                pool.hashCommands.remove((command, algorithm))
+            continue
+        digest = parseHashReply(command, algorithm, reply)
+        if digest:
+            return algorithm, digest
+    return None
+
+def linkKnownFile(store, candidates, remoteHash, entry, localPath, partPath, manifest, siteName):
+    """
+    Function that puts a blob of the content store in place of a remote file, instead of downloading it,
+    if the server's digest of the file is the digest of the blob
+
+    Parameters
+    ----------
+        - store : ContentStore
+            Content store of the site
+        - candidates : list
+            Blobs the file may be a copy of, see ContentStore.findCandidates()
+        - remoteHash : tuple
+            (algorithm, hex digest) of the remote file, see getRemoteHash()
+        - entry : RemoteEntry
+            Listing entry of the remote file, with its size and modify time
+        - localPath : str
+            Path the file is downloaded to
+        - partPath : str
+            Path of the '.part' file of the download, removed if any
+        - manifest : SiteManifest
+            Manifest of the site, records the file as downloaded
+        - siteName : str
+            Name of the site the skipped transfer is counted under
+
+    Returns
+    -------
+        - linked : bool
+    """
+    if remoteHash is None:
+        return False
+    algorithm, remoteDigest = remoteHash
+    for digest, blob in candidates:
+        if blob.get(algorithm) != remoteDigest:
+            continue
+        store.link(digest, localPath)
+        if os.path.exists(partPath):
+            os.remove(partPath)
+        if manifest is not None:
+            manifest.update(entry, localPath)
+        METRICS.increment(siteName, 'dedupFiles')
+        METRICS.increment(siteName, 'dedupBytes', entry.size)
+        METRICS.skip(siteName, entry, 'dedup')
+        LOGGER.writeLog("{} has the {} digest of a file downloaded before, linked it instead of downloading it.".format(entry.name, algorithm), severity='normal')
+        return True
+    return False
+""" Content store ends """
+
+""" Transfer plan starts """
+def runPlan(targetFTPSite, ftpConfigs, outputDIRPath, runOptions, history):
+    """
+    Function that plans the transfers of every target site without downloading anything, up to `workers` sites at the same time
+
+    Parameters
+    ----------
+        - targetFTPSite : list
+            Names of the sites to plan, in the order they would be started, see scheduleSites()
+        - ftpConfigs : dict
+            Dictionary of all the site configs loaded from the YAML file
+        - outputDIRPath : str
+            Local machine's download path, compared with the listings to find the unchanged files
+        - runOptions : dict
+            Behavioral options from parseArgs()
+        - history : RunDatabase
+            Throughput of the previous runs, used to estimate how long each site would take
+
+    Returns
+    -------
+        - plan : dict
+            'sites' maps every site name to its planSite() result, 'totals' sums them up with the
+            'estimatedSeconds' of the whole run given the number of workers, None if a site has no history
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    workers = runOptions['workers']
+    recursive = runOptions.get('recursive', False)
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(targetFTPSite))), thread_name_prefix='plan') as executor:
+        futures = [(site, executor.submit(planSite, ftpConfigs[site], site, outputDIRPath, recursive, history)) for site in targetFTPSite]
+        sites = dict((site, future.result()) for site, future in futures)
+
+    totals = dict((key, sum(sites[site][key] for site in targetFTPSite)) for key in PLAN_COUNTERS)
+    totals['sites'] = len(targetFTPSite)
+    totals['failedSites'] = [site for site in targetFTPSite if sites[site]['error']]
+    totals['unestimatedSites'] = [site for site in targetFTPSite if sites[site]['estimatedSeconds'] is None and not sites[site]['error']]
+    totals['estimatedSeconds'] = None
+    if not totals['unestimatedSites']:
+        totals['estimatedSeconds'] = estimateRunSeconds([sites[site]['estimatedSeconds'] or 0.0 for site in targetFTPSite], workers)
+    return {
+        'created': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'workers': workers,
+        'sites': sites,
+        'totals': totals,
+    }
+
+def planSite(siteConfig, siteName, outputDIRPath, recursive=False, history=None):
+    """
+    Function that works out what a run would transfer from a site. The site is walked with the same RemoteWalk as
+    downloadFiles(), and every file gets the same getTransferDecision(), but nothing is downloaded and
+    the manifest and history of the site are left untouched.
+
+    Parameters
+    ----------
+        - siteConfig : dict
+            Dictionary that contains host, name, password, and path.
+        - siteName : str
+            Name of the site in the config file
+        - outputDIRPath : str
+            Local machine's download path
+        - recursive : bool
+            Walk the whole directory tree under the remote path, whatever the site config says
+        - history : RunDatabase
+            Throughput of the previous runs, no estimate is made without it
+
+    Returns
+    -------
+        - plan : dict
+            Counts and bytes of the listed 'files', the files to 'transfer', those skipped as 'unchanged' and
+            those 'excluded' by the filters, the 'resumeBytes' already in '.part' files, the 'throughput' the
+            estimate is based on and the 'estimatedSeconds' of the transfers. 'error' is set if the site couldn't be listed.
+    """
+    plan = dict((key, 0) for key in PLAN_COUNTERS)
+    plan.update({'throughput': None, 'estimatedSeconds': None, 'error': None})
+    recursive = recursive or bool(siteConfig.get('recursive', False))
+    sourceDirectory = siteConfig['remote_path']
+    manifest = SiteManifest(siteName) if siteConfig.get('incremental', True) else None
+
+    try:
+        ftp = callWithRetries(lambda: openFtpConnection(siteConfig, sourceDirectory, siteName=siteName), siteConfig, "Connecting to {}".format(siteName), siteName)
+    except Exception as connectError:
+        LOGGER.writeLog("Planning {} failed, couldn't connect: {}".format(siteName, connectError), severity='error')
+        plan['error'] = str(connectError)
+        return plan
+    connections = getConnectionCount(siteConfig)
+    pool = FTPConnectionPool(siteConfig, sourceDirectory, size=connections, connection=ftp, siteName=siteName)
+    lock = threading.Lock()
+
+    def planFile(entry):
+        decision = getTransferDecision(entry, outputDIRPath, manifest)
+        if decision.localPath is None:
+            return
+        size = entry.size or 0
+        with lock:
+            plan['files'] += 1
+            plan['bytes'] += size
+            if decision.unchanged:
+                plan['unchangedFiles'] += 1
+                plan['unchangedBytes'] += size
+                return
+            plan['transferFiles'] += 1
+            plan['transferBytes'] += size - decision.offset
+            plan['resumeBytes'] += decision.offset
+            if entry.size is None:
+                plan['unknownSizes'] += 1
+
+    # The same walk as downloadFiles(), only handing the files to planFile() instead of downloading them
+    walk = RemoteWalk(pool, siteConfig, recursive, planFile)
+    workQueue = WorkQueue(connections, name='plan')
+    try:
+        walk.start(workQueue, *walk.addListing('', listRemoteEntries(pool, '')))
+        workQueue.join()
+    except Exception as listingError:
+        LOGGER.writeLog("Listing {} of {} failed: {}".format(sourceDirectory, siteName, listingError), severity='error')
+        plan['error'] = str(listingError)
+    finally:
+        workQueue.close()
+        pool.closeAll(keep=ftp)
+        disconnectFtp(ftp, siteName)
+    if walk.failed:
+        # Without the whole tree the plan would understate the run
+        plan['error'] = "some directories couldn't be listed, see the log"
+    plan['excludedFiles'] = walk.excludedFiles
+    plan['excludedBytes'] = walk.excludedBytes
+
+    if history is not None:
+        plan['throughput'] = history.getThroughput(siteName)
+    if plan['throughput']:
+        # The throughput is the average of single transfers, the site's connections run side by side
+        connections = max(1, min(getConnectionCount(siteConfig), plan['transferFiles']))
+        plan['estimatedSeconds'] = plan['transferBytes'] / (plan['throughput'] * connections)
+    elif not plan['transferBytes']:
+        plan['estimatedSeconds'] = 0.0
+    LOGGER.writeLog("Plan of {}: {} of {} files to transfer ({} bytes), {} unchanged ({} bytes).".format(siteName, plan['transferFiles'], plan['files'], plan['transferBytes'], plan['unchangedFiles'], plan['unchangedBytes']), severity='normal')
+    return plan
+
+def estimateRunSeconds(siteSeconds, workers):
+    """
+    Function that estimates how long the sites take when `workers` of them run at the same time,
+    each started as soon as a worker is free, in the given order
+
+    Parameters
+    ----------
+        - siteSeconds : list
+            Expected duration of every site, in the order they are started
+        - workers : int
+            Number of sites processed concurrently
+
+    Returns
+    -------
+        - seconds : float
+    """
+    finishTimes = [0.0] * max(1, workers)
+    for seconds in siteSeconds:
+        finishTimes[finishTimes.index(min(finishTimes))] += seconds
+    return max(finishTimes)
+
+def printPlan(plan):
+    """ Function that prints the transfer plan as a table on the console, with or without -v. """
+    def formatSeconds(seconds):
+        return 'unknown' if seconds is None else '{:.1f} s'.format(seconds)
+
+    lines = [
+        "=================================================================",
+        "TRANSFER PLAN (nothing was downloaded)",
+    ]
+    for site, sitePlan in plan['sites'].items():
+        if sitePlan['error']:
+            lines.append("\tSite: {}\t\tFAILED: {}".format(site, sitePlan['error']))
+            continue
+        lines.append("\tSite: {}\t\tFiles: {} ({} bytes)\t\tTo transfer: {} ({} bytes)\t\tUnchanged: {} ({} bytes)\t\tExcluded: {}\t\tEstimate: {}".format(
+            site, sitePlan['files'], sitePlan['bytes'], sitePlan['transferFiles'], sitePlan['transferBytes'],
+            sitePlan['unchangedFiles'], sitePlan['unchangedBytes'], sitePlan['excludedFiles'], formatSeconds(sitePlan['estimatedSeconds'])))
+    totals = plan['totals']
+    lines.append("Files to transfer: {} of {} ({} of {} bytes)".format(totals['transferFiles'], totals['files'], totals['transferBytes'], totals['bytes']))
+    lines.append("Unchanged files skipped: {} ({} bytes)".format(totals['unchangedFiles'], totals['unchangedBytes']))
+    lines.append("Estimated duration with {} workers: {}".format(plan['workers'], formatSeconds(totals['estimatedSeconds'])))
+    if totals['unestimatedSites']:
+        lines.append("Sites without a throughput history, no estimate can be made: {}".format(', '.join(totals['unestimatedSites'])))
+    if totals['failedSites']:
+        lines.append("Sites that couldn't be listed: {}".format(', '.join(totals['failedSites'])))
+    lines.append("=================================================================")
+    # Straight to the console, print() only goes there with -v
+    sys.__stdout__.write('\n'.join(lines) + '\n')
+    sys.__stdout__.flush()
+
+def writePlan(plan, path):
+    """ Function that writes the transfer plan as JSON to a file, or to the standard output if the path is '-'. """
+    content = json.dumps(plan, indent=1)
+    if path == '-':
+        # Straight to the console, print() only goes there with -v
+        sys.__stdout__.write(content + '\n')
+        sys.__stdout__.flush()
+    else:
+        writeFileAtomically(path, content)
+""" Transfer plan ends """
+
+""" Daemon mode starts """
+class SiteSession(object):
+    """ A site watched in daemon mode: when it is due to be polled and its pool of logged-in connections, kept open between polls. """
+    def __init__(self, siteName, siteConfig, pollInterval=DEFAULT_POLL_INTERVAL):
+        """
+        Parameters
+        ----------
+            - siteName : str
+                Name of the site in the config file
+            - siteConfig : dict
+                Config of the site. `poll_interval` and `keepalive` (seconds) override the defaults.
+            - pollInterval : float
+                Seconds between two polls when the site doesn't set `poll_interval`
+        """
+        self.siteName = siteName
+        self.siteConfig = siteConfig
+        self.pollInterval = self.readSeconds('poll_interval', pollInterval)
+        self.keepAliveInterval = self.readSeconds('keepalive', DEFAULT_KEEPALIVE)
+        self.pool = None
+        self.lastUsed = time.monotonic()
+        # Due at once
+        self.nextPoll = self.lastUsed
+        # A poll (in a worker thread) and a keepalive (in the main thread) never share the connections
+        self.lock = threading.Lock()
+
+    def readSeconds(self, key, default):
+        try:
+            return max(1.0, float(self.siteConfig.get(key, default)))
+        except (TypeError, ValueError):
+            LOGGER.writeLog("Invalid {} for {}. Using {} seconds.".format(key, self.siteName, default), severity='warning')
+            return default
+
+    def poll(self, outputDIRPath, runOptions, extractor=None):
+        """
+        Function that downloads the new and changed files of the site over the kept connections.
+        A connection that was lost is replaced, any other error is logged and the connections are dropped,
+        the next poll logs in again.
+
+        Returns
+        -------
+            - downloadedFiles : list
+                Names of the files downloaded, empty if the poll failed
+        """
+        with self.lock:
+            try:
+                with METRICS.span(self.siteName, 'site'):
+                    if self.pool is None:
+                        self.pool = FTPConnectionPool(self.siteConfig, self.siteConfig['remote_path'], size=getConnectionCount(self.siteConfig), siteName=self.siteName)
+                    ftp = self.pool.acquire()
+                    recursive = runOptions.get('recursive') or self.siteConfig.get('recursive')
+                    # Polling only makes sense for new and changed files
+                    siteConfig = dict(self.siteConfig, incremental=True)
+                    return downloadFiles(ftp, siteConfig['site'], siteConfig['remote_path'], outputDIRPath, siteConfig, self.siteName, recursive=recursive, extractor=extractor, disconnect=False, pool=self.pool)
+            except Exception as siteError:
+                LOGGER.writeLog("Polling {} failed, it will be retried at the next poll: {!r}".format(self.siteName, siteError), severity='error')
+                self.dropConnections()
+                return []
+            finally:
+                self.lastUsed = time.monotonic()
+
+    def keepAlive(self):
+        """ Function that sends a NOOP over every connection if they have been idle for the keepalive interval. A polling site is left alone. """
+        if self.pool is None or time.monotonic() - self.lastUsed < self.keepAliveInterval:
+            return
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            lost = self.pool.keepAlive()
+            if lost:
+                LOGGER.writeLog("{} sessions to {} were lost, they are opened again when needed.".format(lost, self.siteName), severity='warning')
+        finally:
+            self.lastUsed = time.monotonic()
+            self.lock.release()
+
+    def dropConnections(self):
+        if self.pool is not None:
+            self.pool.closeAll()
+            self.pool = None
+
+    def close(self):
+        """ Function that logs out of the sessions. """
+        with self.lock:
+            if self.pool is not None:
+                LOGGER.writeLog("Disconnecting from {}...".format(self.siteConfig['site']), severity='normal')
+                self.dropConnections()
+
+def runDaemon(ftpYAMLPath, ftpConfigs, targetFTPSite, outputDIRPath, runOptions, extractor=None, history=None):
+    """
+    Function that keeps running until it is stopped with SIGINT or SIGTERM, polling every site on its own interval
+    over sessions that stay logged in. Only new and changed files are downloaded, whatever the site's `incremental`.
+    Edits of the config file are picked up at once: sites that were added, changed or removed get new sessions.
+    Once every running poll has finished, the history, the report and the Prometheus file are updated.
+
+    Parameters
+    ----------
+        - ftpYAMLPath : str
+            Path of the config file, watched for edits
+        - ftpConfigs : dict
+            Site configs already loaded from the config file
+        - targetFTPSite : list
+            Names of the sites to watch, None to watch every site in the config file
+        - outputDIRPath : str
+            Local machine's download path
+        - runOptions : dict
+            Behavioral options from parseArgs(). `workers` is the number of sites polled at the same time
+            and `interval` the default number of seconds between two polls of a site.
+        - extractor : ExtractionPipeline
+            If provided, archives are handed to it as soon as they are downloaded
+        - history : RunDatabase
+            Run history, updated with every poll
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    stopping = threading.Event()
+    def stop(signalNumber, frame):
+        # Nothing else here: the logger's queue takes a lock the interrupted main thread may be holding
+        stopping.set()
+    for signalName in ('SIGINT', 'SIGTERM'):
+        signal.signal(getattr(signal, signalName), stop)
+
+    history = history or RunDatabase()
+    sessions = {}
+    running = {}
+    config = {'modified': getModifiedTime(ftpYAMLPath), 'sites': {}}
+    applyDaemonConfig(sessions, config, ftpConfigs, targetFTPSite, runOptions)
+    reportDue = False
+    LOGGER.writeLog("Daemon started, watching {}.".format(sorted(sessions)), severity='normal')
+
+    with ThreadPoolExecutor(max_workers=max(1, runOptions['workers']), thread_name_prefix='site') as executor:
+        while not stopping.is_set():
+            reloadDaemonConfig(sessions, running, config, ftpYAMLPath, targetFTPSite, runOptions)
+
+            for siteName, future in list(running.items()):
+                if future.done():
+                    del running[siteName]
+                    reportDue = True
+            if reportDue and not running:
+                writeDaemonReport(history, runOptions, extractor)
+                reportDue = False
+
+            now = time.monotonic()
+            dueSites = [siteName for siteName, session in sessions.items() if siteName not in running and session.nextPoll <= now]
+            for siteName in scheduleSites(dueSites, config['sites'], history):
+                sessions[siteName].nextPoll = now + sessions[siteName].pollInterval
+                running[siteName] = executor.submit(sessions[siteName].poll, outputDIRPath, runOptions, extractor)
+            for siteName, session in sessions.items():
+                if siteName not in running:
+                    session.keepAlive()
+
+            stopping.wait(1)
+
+        LOGGER.writeLog("Stopping the daemon...", severity='normal')
+        for future in running.values():
+            future.result()
+    for session in sessions.values():
+        session.close()
+    writeDaemonReport(history, runOptions, extractor)
+    LOGGER.writeLog("Daemon stopped.", severity='normal')
+
+def getModifiedTime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+def applyDaemonConfig(sessions, config, ftpConfigs, targetFTPSite, runOptions):
+    """ Function that creates the sessions of new and changed sites and closes those of changed and removed ones. """
+    siteConfigs = dict((siteName, siteConfig) for siteName, siteConfig in ftpConfigs.items() if targetFTPSite is None or siteName in targetFTPSite)
+    for siteName in list(sessions):
+        if siteConfigs.get(siteName) != sessions[siteName].siteConfig:
+            sessions.pop(siteName).close()
+    for siteName, siteConfig in siteConfigs.items():
+        if siteName not in sessions:
+            sessions[siteName] = SiteSession(siteName, siteConfig, runOptions['interval'])
+    config['sites'] = siteConfigs
+
+def reloadDaemonConfig(sessions, running, config, ftpYAMLPath, targetFTPSite, runOptions):
+    """ Function that reloads the config file if it was edited. Sites being polled are only changed once their poll is over. """
+    modified = getModifiedTime(ftpYAMLPath)
+    if modified == config['modified']:
+        return
+    try:
+        ftpConfigs = loadCredentials(ftpYAMLPath)
+    except Exception as configError:
+        LOGGER.writeLog("Reloading {} failed, keeping the current config: {!r}".format(ftpYAMLPath, configError), severity='error')
+        config['modified'] = modified
+        return
+    if not isinstance(ftpConfigs, dict):
+        LOGGER.writeLog("Reloading {} failed, keeping the current config.".format(ftpYAMLPath), severity='error')
+        config['modified'] = modified
+        return
+    if any(ftpConfigs.get(siteName) != sessions[siteName].siteConfig for siteName in running):
+        # Try again at the next tick
+        return
+    LOGGER.writeLog("{} was edited, reloading it.".format(ftpYAMLPath), severity='normal')
+    config['modified'] = modified
+    applyDaemonConfig(sessions, config, ftpConfigs, targetFTPSite, runOptions)
+
+def writeDaemonReport(history, runOptions, extractor=None):
+    """ Function that records the polls since the last report in the run database, report and Prometheus file, and starts new metrics. """
+    if extractor is not None:
+        extractor.collect()
+    history.record(METRICS, runOptions)
+    if runOptions['report']:
+        METRICS.writeReport(runOptions['report'])
+    if runOptions['prometheus']:
+        METRICS.writePrometheus(runOptions['prometheus'])
+    METRICS.reset()
+""" Daemon mode ends """
+
+""" Run metrics starts """
+class RunMetrics(object):
+    """ Collects the timing of every phase of the run (connect, login, listing, transfer, extraction) per site. """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Function that forgets everything recorded so far and starts a new run. """
+        with self.lock:
+            self.spans = []
+            self.counters = {}
+            self.skips = []
+            self.startTime = time.time()
+
+    @contextlib.contextmanager
+    def span(self, site, phase, **attributes):
+        """
+        Context manager that records how long its block took.
+        The yielded dict can be updated with attributes of the span, 'bytes' gives it a throughput.
+
+        Parameters
+        ----------
+            - site : str
+                Name of the site the span belongs to
+            - phase : str
+                'site' (the whole site), 'connect', 'login', 'listing', 'transfer', 'checksum' or 'extraction'
+            - attributes : dict
+                Attributes of the span, e.g. the file name
+        """
+        record = dict(attributes, start=time.time())
+        startTime = time.perf_counter()
+        try:
+            yield record
+        except BaseException as error:
+            record['error'] = repr(error)
+            raise
+        finally:
+            self.addSpan(site, phase, time.perf_counter() - startTime, **record)
+
+    def addSpan(self, site, phase, seconds, **attributes):
+        """ Function that records a span that was timed elsewhere, see span(). """
+        record = dict(attributes)
+        record.update({'site': site, 'phase': phase, 'seconds': seconds})
+        record.setdefault('start', time.time() - seconds)
+        if 'bytes' in record:
+            record['throughput'] = record['bytes'] / seconds if seconds > 0 else 0.0
+        with self.lock:
+            self.spans.append(record)
+
+    def increment(self, site, counter, value=1):
+        """ Function that adds to a per-site counter, e.g. 'skippedFiles'. """
+        with self.lock:
+            key = (site, counter)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def skip(self, site, entry, reason):
+        """ Function that records a file that wasn't transferred, 'unchanged' since the last run or linked from the content store ('dedup'). """
+        with self.lock:
+            self.skips.append({'site': site, 'file': entry.name, 'size': entry.size, 'modify': entry.modify, 'reason': reason, 'start': time.time()})
+
+    def getSiteSummaries(self):
+        """
+        Function that sums up the spans of every site
+
+        Returns
+        -------
+            - summaries : dict
+                Site name to a dict of the 'seconds' spent in each phase, transferred 'bytes' and 'files',
+                average 'throughput' of the transfers (bytes/second), transfer 'errors' and the counters,
+                e.g. 'retries' after transient errors
+        """
+        with self.lock:
+            spans = list(self.spans)
+            counters = dict(self.counters)
+        summaries = {}
+        def getSummary(site):
+            if site not in summaries:
+                summaries[site] = {'seconds': {}, 'bytes': 0, 'wireBytes': 0, 'files': 0, 'transferSeconds': 0.0, 'throughput': 0.0, 'errors': 0, 'retries': 0, 'skippedFiles': 0, 'skippedBytes': 0, 'excludedFiles': 0, 'excludedBytes': 0}
+            return summaries[site]
+        for record in spans:
+            summary = getSummary(record['site'])
+            summary['seconds'][record['phase']] = summary['seconds'].get(record['phase'], 0.0) + record['seconds']
+            if record['phase'] == 'transfer':
+                summary['bytes'] += record.get('bytes', 0)
+                summary['wireBytes'] += record.get('wireBytes', record.get('bytes', 0))
+                summary['transferSeconds'] += record['seconds']
+                if 'error' in record:
+                    summary['errors'] += 1
+                else:
+                    summary['files'] += 1
+        for (site, counter), value in counters.items():
+            getSummary(site)[counter] = value
+        for summary in summaries.values():
+            if summary['transferSeconds'] > 0:
+                summary['throughput'] = summary['bytes'] / summary['transferSeconds']
+        return summaries
+
+    def getTotals(self):
+        """ Function that sums up the counters of all the sites. """
+        totals = {'retries': 0, 'skippedFiles': 0, 'skippedBytes': 0, 'purgedFiles': 0, 'purgedBytes': 0, 'dedupFiles': 0, 'dedupBytes': 0, 'linkedFiles': 0, 'linkedBytes': 0, 'excludedFiles': 0, 'excludedBytes': 0}
+        with self.lock:
+            for (site, counter), value in self.counters.items():
+                totals[counter] = totals.get(counter, 0) + value
+        return totals
+
+    def getReport(self):
+        """ Function that builds the machine-readable report of the run. """
+        endTime = time.time()
+        with self.lock:
+            spans = sorted(self.spans, key=lambda record: record['start'])
+            skips = list(self.skips)
+        return {
+            'start': datetime.utcfromtimestamp(self.startTime).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'end': datetime.utcfromtimestamp(endTime).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'seconds': endTime - self.startTime,
+            'sites': self.getSiteSummaries(),
+            'spans': spans,
+            'skips': skips,
+        }
+
+    def writeReport(self, path):
+        """ Function that writes the report of the run to a JSON file. """
+        writeFileAtomically(path, json.dumps(self.getReport(), indent=2, sort_keys=True, default=str))
+
+    def writePrometheus(self, path):
+        """
+        Function that writes the per-site metrics of the run in the Prometheus textfile collector format.
+        The file is replaced in one step so the collector never reads half of it.
+        """
+        endTime = time.time()
+        summaries = self.getSiteSummaries()
+        lines = [
+            '# HELP ftp_download_last_run_timestamp_seconds Time the last run finished.',
+            '# TYPE ftp_download_last_run_timestamp_seconds gauge',
+            'ftp_download_last_run_timestamp_seconds {:.3f}'.format(endTime),
+            '# HELP ftp_download_run_duration_seconds Duration of the last run.',
+            '# TYPE ftp_download_run_duration_seconds gauge',
+            'ftp_download_run_duration_seconds {:.3f}'.format(endTime - self.startTime),
+        ]
+        siteMetrics = [
+            ('ftp_download_bytes', 'Bytes transferred from the site in the last run.', 'bytes'),
+            ('ftp_download_wire_bytes', 'Bytes received from the site in the last run, fewer than transferred with MODE Z.', 'wireBytes'),
+            ('ftp_download_files', 'Files downloaded from the site in the last run.', 'files'),
+            ('ftp_download_throughput_bytes_per_second', 'Average transfer throughput of the site in the last run.', 'throughput'),
+            ('ftp_download_transfer_errors', 'Failed transfers from the site in the last run.', 'errors'),
+            ('ftp_download_retries', 'Operations retried after a transient error in the last run.', 'retries'),
+            ('ftp_download_skipped_files', 'Unchanged files skipped in the last run.', 'skippedFiles'),
+            ('ftp_download_skipped_bytes', 'Bytes of the unchanged files skipped in the last run.', 'skippedBytes'),
+            ('ftp_download_excluded_files', 'Files the filters excluded from the listings in the last run.', 'excludedFiles'),
+            ('ftp_download_excluded_bytes', 'Bytes of the files the filters excluded in the last run.', 'excludedBytes'),
+        ]
+        for name, description, key in siteMetrics:
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} gauge'.format(name))
+            for site, summary in sorted(summaries.items()):
+                lines.append('{}{{site="{}"}} {}'.format(name, escapePrometheusLabel(site), summary[key]))
+        lines.append('# HELP ftp_download_phase_seconds Time spent in each phase for the site in the last run, summed over connections.')
+        lines.append('# TYPE ftp_download_phase_seconds gauge')
+        for site, summary in sorted(summaries.items()):
+            for phase, seconds in sorted(summary['seconds'].items()):
+                lines.append('ftp_download_phase_seconds{{site="{}",phase="{}"}} {:.6f}'.format(escapePrometheusLabel(site), phase, seconds))
+        writeFileAtomically(path, '\n'.join(lines) + '\n')
+
+def escapePrometheusLabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def writeFileAtomically(path, content):
+    """ Function that writes a text file under a temporary name and renames it, so readers never see half of it. """
+    temporaryPath = path + '.tmp'
+    with open(temporaryPath, 'w') as stream:
+        stream.write(content)
+    os.replace(temporaryPath, path)
+""" Run metrics ends """
+
+""" Run database starts """
+class RunDatabase(object):
+    """
+    A SQLite database of every run, with one row per run, per site of a run and per transfer attempt or skipped file of a site.
+    The scheduler and the transfer plan estimate the next run of each site from it.
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            start REAL NOT NULL,
+            seconds REAL NOT NULL,
+            engine TEXT,
+            workers INTEGER,
+            sites INTEGER NOT NULL,
+            files INTEGER NOT NULL,
+            bytes INTEGER NOT NULL,
+            retries INTEGER NOT NULL,
+            errors INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS sites (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_id INTEGER NOT NULL REFERENCES runs(id),
+            site TEXT NOT NULL,
+            start REAL NOT NULL,
+            seconds REAL,
+            files INTEGER NOT NULL,
+            bytes INTEGER NOT NULL,
+            wire_bytes INTEGER NOT NULL,
+            transfer_seconds REAL NOT NULL,
+            throughput REAL NOT NULL,
+            retries INTEGER NOT NULL,
+            errors INTEGER NOT NULL,
+            skipped_files INTEGER NOT NULL,
+            skipped_bytes INTEGER NOT NULL,
+            excluded_files INTEGER NOT NULL,
+            excluded_bytes INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_id INTEGER NOT NULL REFERENCES runs(id),
+            site TEXT NOT NULL,
+            name TEXT NOT NULL,
+            start REAL NOT NULL,
+            size INTEGER,
+            modify TEXT,
+            offset INTEGER NOT NULL,
+            bytes INTEGER NOT NULL,
+            seconds REAL NOT NULL,
+            throughput REAL NOT NULL,
+            error TEXT,
+            skipped TEXT
+        );
+        CREATE INDEX IF NOT EXISTS runs_start ON runs (start);
+        CREATE INDEX IF NOT EXISTS sites_start ON sites (start);
+        CREATE INDEX IF NOT EXISTS sites_site_start ON sites (site, start);
+        CREATE INDEX IF NOT EXISTS files_site_name ON files (site, name);
+        CREATE INDEX IF NOT EXISTS files_start ON files (start);
+    '''
+
+    def __init__(self, path=None):
+        """
+        Parameters
+        ----------
+            - path : str
+                SQLite file the runs are kept in, 'runs.sqlite' in the state directory by default
+        """
+        self.path = path or os.path.join(getStateDirectory(), 'runs.sqlite')
+
+    def connect(self):
+        """ Function that opens the database, creating its tables and indexes the first time. """
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        try:
+            connection.executescript(self.SCHEMA)
+        except BaseException:
+            connection.close()
+            raise
+        return connection
+
+    def record(self, metrics, runOptions=None):
+        """
+        Function that adds a run to the database. A database that can't be written is logged and the run goes on.
+
+        Parameters
+        ----------
+            - metrics : RunMetrics
+                Spans, counters and skipped files of the run
+            - runOptions : dict
+                Behavioral options from parseArgs(), the engine and number of workers are recorded
+        """
+        runOptions = runOptions or {}
+        report = metrics.getReport()
+        summaries = report['sites']
+        if not summaries:
+            return
+        siteStarts = {}
+        # One row per transfer attempt and per skipped file, a daemon window can hold several of the same file
+        files = []
+        for record in report['spans']:
+            siteStarts[record['site']] = min(siteStarts.get(record['site'], record['start']), record['start'])
+            if record['phase'] != 'transfer' or 'file' not in record:
+                continue
+            files.append((record['site'], record['file'], record['start'], record.get('size'), record.get('modify'), record.get('offset', 0),
+                          record.get('bytes', 0), record['seconds'], record.get('throughput', 0.0), record.get('error'), None))
+        for skip in report['skips']:
+            files.append((skip['site'], skip['file'], skip['start'], skip['size'], skip['modify'], 0, 0, 0.0, 0.0, None, skip['reason']))
+
+        try:
+            with contextlib.closing(self.connect()) as connection, connection:
+                cursor = connection.execute(
+                    'INSERT INTO runs (start, seconds, engine, workers, sites, files, bytes, retries, errors) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (metrics.startTime, report['seconds'], runOptions.get('engine'), runOptions.get('workers'), len(summaries),
+                     sum(summary['files'] for summary in summaries.values()), sum(summary['bytes'] for summary in summaries.values()),
+                     sum(summary['retries'] for summary in summaries.values()), sum(summary['errors'] for summary in summaries.values())))
+                runId = cursor.lastrowid
+                connection.executemany(
+                    'INSERT INTO sites (run_id, site, start, seconds, files, bytes, wire_bytes, transfer_seconds, throughput, retries, errors, skipped_files, skipped_bytes, excluded_files, excluded_bytes)'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(runId, site, siteStarts.get(site, metrics.startTime), summary['seconds'].get('site'), summary['files'], summary['bytes'], summary['wireBytes'],
+                      summary['transferSeconds'], summary['throughput'], summary['retries'], summary['errors'], summary['skippedFiles'], summary['skippedBytes'],
+                      summary['excludedFiles'], summary['excludedBytes']) for site, summary in summaries.items()])
+                connection.executemany(
+                    'INSERT INTO files (run_id, site, name, start, size, modify, offset, bytes, seconds, throughput, error, skipped) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(runId,) + row for row in files])
+        except sqlite3.Error as databaseError:
+            LOGGER.writeLog("The run couldn't be recorded in {}: {}".format(self.path, databaseError), severity='warning')
+
+    def query(self, sql, parameters=()):
+        with contextlib.closing(self.connect()) as connection:
+            return [dict(row) for row in connection.execute(sql, parameters)]
+
+    def getSlowestSites(self, since=None, limit=10):
+        """
+        Function that lists the sites that took longest on average
+
+        Parameters
+        ----------
+            - since : float
+                Only the runs started after this time (seconds since the epoch) are counted, all of them by default
+            - limit : int
+                Number of sites returned
+
+        Returns
+        -------
+            - sites : list
+                A dict per site with its number of 'runs', 'averageSeconds', 'maxSeconds', 'averageThroughput' and 'errors'
+        """
+        return self.query(
+            'SELECT site, COUNT(*) AS runs, AVG(seconds) AS averageSeconds, MAX(seconds) AS maxSeconds,'
+            ' AVG(NULLIF(throughput, 0)) AS averageThroughput, SUM(errors) AS errors'
+            ' FROM sites WHERE start >= ? AND seconds IS NOT NULL GROUP BY site ORDER BY averageSeconds DESC LIMIT ?',
+            (since or 0, limit))
+
+    def getThroughputTrend(self, siteName, since=None):
+        """
+        Function that lists the throughput of every run of a site, oldest first
+
+        Returns
+        -------
+            - runs : list
+                A dict per run with its 'start' (seconds since the epoch), 'seconds', 'files', 'bytes', 'throughput' and 'errors'
+        """
+        return self.query(
+            'SELECT start, seconds, files, bytes, throughput, errors FROM sites WHERE site = ? AND start >= ? ORDER BY start',
+            (siteName, since or 0))
+
+    def getMostChangedFiles(self, siteName=None, since=None, limit=10):
+        """
+        Function that lists the files downloaded again most often. Unchanged files are skipped,
+        so every version of a file that was downloaded is a change.
+
+        Returns
+        -------
+            - files : list
+                A dict per file with its 'site', 'name', number of 'versions' downloaded and 'bytes' transferred, failed attempts included
+        """
+        return self.query(
+            'SELECT site, name, COUNT(DISTINCT CASE WHEN error IS NULL THEN COALESCE(modify, id) END) AS versions, SUM(bytes) AS bytes FROM files'
+            ' WHERE skipped IS NULL AND start >= ? AND (? IS NULL OR site = ?)'
+            ' GROUP BY site, name HAVING versions > 0 ORDER BY versions DESC, bytes DESC LIMIT ?',
+            (since or 0, siteName, siteName, limit))
+
+    def getRecentAverage(self, siteName, column):
+        try:
+            rows = self.query(
+                'SELECT AVG({0}) AS average FROM (SELECT {0} FROM sites WHERE site = ? AND {0} > 0 ORDER BY start DESC LIMIT ?)'.format(column),
+                (siteName, RUN_DATABASE_RECENT_RUNS))
+        except sqlite3.Error as databaseError:
+            LOGGER.writeLog("The run history at {} couldn't be read: {}".format(self.path, databaseError), severity='warning')
+            return None
+        return rows[0]['average']
+
+    def getEstimatedSeconds(self, siteName):
+        """ Function that returns how long a run of the site is expected to take from its latest runs, None if it never ran. """
+        return self.getRecentAverage(siteName, 'seconds')
+
+    def getThroughput(self, siteName):
+        """ Function that returns the transfer throughput of the site's latest runs in bytes/second, None if unknown. """
+        return self.getRecentAverage(siteName, 'throughput')
+
+def writeRunStatistics(query, siteName=None, since=None):
+    """
+    Function that writes the answer of one of the run database's queries as JSON to the standard output
+
+    Parameters
+    ----------
+        - query : str
+            'slowest' sites, throughput 'trend' of a site or most 'changed' files
+        - siteName : str
+            The site the trend is of, or the changed files are limited to
+        - since : float
+            Only the runs started after this time (seconds since the epoch) are counted
+    """
+    database = RunDatabase()
+    if query == 'slowest':
+        result = database.getSlowestSites(since)
+    elif query == 'trend':
+        result = dict((site, database.getThroughputTrend(site, since)) for site in ([siteName] if siteName else sorted(row['site'] for row in database.query('SELECT DISTINCT site FROM sites'))))
+    else:
+        result = database.getMostChangedFiles(siteName, since)
+    # Straight to the console, print() only goes there with -v
+    sys.__stdout__.write(json.dumps(result, indent=1) + '\n')
+    sys.__stdout__.flush()
+""" Run database ends """
+
+""" Asyncio transfer engine starts """
+class AsyncFTP(object):
+    """
+    A small FTP client on asyncio streams, covering what the downloader needs: explicit FTPS, login, cwd, EPSV/PASV,
+    listing, SIZE/MDTM, and RETR with REST. Errors are raised as the same exceptions as ftplib raises.
+    """
+    def __init__(self, host, port=21, timeout=DEFAULT_TIMEOUT, encoding='utf-8', tlsContext=None, reuseSession=True):
+        """
+        Parameters
+        ----------
+            - host : str
+                Hostname of the FTP site
+            - port : int
+                Port of the FTP control connection
+            - timeout : float
+                Seconds to wait on any read or connect before giving up
+            - encoding : str
+                Encoding of the control connection and of the listings
+            - tlsContext : ssl.SSLContext
+                Context of the FTPS connections, see startTls(). An instance of getSessionReusingContextClass()
+                to have the data connections resume the TLS session of the control connection.
+            - reuseSession : bool
+                Resume the control connection's TLS session on the data connections
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.encoding = encoding
+        self.tlsContext = tlsContext
+        self.reuseSession = reuseSession
+        self.protectData = False
+        self.reader = None
+        self.writer = None
+        self.welcome = None
+        self.transferType = None
+        self.transferMode = 'S'
+
+    async def connect(self):
+        """ Function that opens the control connection and reads the welcome message. """
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        self.welcome = await self.getresp()
+        return self.welcome
+
+    def getwelcome(self):
+        return self.welcome
+
+    async def startTls(self):
+        """ Function that secures the control connection with AUTH TLS. """
+        reply = await self.sendcmd('AUTH TLS')
+        if reply[:3] != '234':
+            raise ftplib.error_reply(reply)
+        await self.writer.start_tls(self.tlsContext, server_hostname=self.host, ssl_handshake_timeout=self.timeout)
+
+    async def protectDataConnections(self):
+        """ Function that has the data connections encrypted too, once logged in over TLS. """
+        await self.voidcmd('PBSZ 0')
+        await self.voidcmd('PROT P')
+        self.protectData = True
+
+    async def readline(self, reader=None):
+        line = await asyncio.wait_for((reader or self.reader).readline(), self.timeout)
+        if not line:
+            raise EOFError("connection closed by the server")
+        return line.decode(self.encoding, 'replace').rstrip('\r\n')
+
+    async def getresp(self):
+        """ Function that reads a (possibly multi-line) reply and raises the matching ftplib error for 4xx/5xx replies. """
+        line = await self.readline()
+        reply = line
+        if line[3:4] == '-':
+            code = line[:3]
+            while True:
+                line = await self.readline()
+                reply = reply + '\n' + line
+                if line[:3] == code and line[3:4] != '-':
+                    break
+        if reply[:1] in ('1', '2', '3'):
+            return reply
+        if reply[:1] == '4':
+            raise ftplib.error_temp(reply)
+        if reply[:1] == '5':
+            raise ftplib.error_perm(reply)
+        raise ftplib.error_proto(reply)
+
+    async def sendcmd(self, command):
+        """ Function that sends a command and returns the reply. """
+        if self.writer is None:
+            raise EOFError("connection is closed")
+        self.writer.write((command + '\r\n').encode(self.encoding))
+        await self.writer.drain()
+        return await self.getresp()
+
+    async def voidcmd(self, command):
+        """ Function that sends a command and expects a 2xx reply. """
+        reply = await self.sendcmd(command)
+        if reply[:1] != '2':
+            raise ftplib.error_reply(reply)
+        return reply
+
+    async def login(self, user, password):
+        reply = await self.sendcmd('USER ' + user)
+        if reply[:1] == '3':
+            reply = await self.sendcmd('PASS ' + password)
+        if reply[:1] != '2':
+            raise ftplib.error_reply(reply)
+        return reply
+
+    async def cwd(self, path):
+        return await self.voidcmd('CWD ' + path)
+
+    async def setType(self, transferType):
+        if self.transferType != transferType:
+            await self.voidcmd('TYPE ' + transferType)
+            self.transferType = transferType
+
+    async def setMode(self, transferMode):
+        if self.transferMode != transferMode:
+            await self.voidcmd('MODE ' + transferMode)
+            self.transferMode = transferMode
+
+    async def size(self, name):
+        await self.setType('I')
+        reply = await self.sendcmd('SIZE ' + name)
+        return int(reply[3:].strip())
+
+    async def mdtm(self, name):
+        reply = await self.sendcmd('MDTM ' + name)
+        return reply[4:].strip().split('.')[0]
+
+    async def openDataConnection(self, blockSize=65536):
+        """ Function that opens a passive data connection, with EPSV or PASV if the server doesn't know EPSV. """
+        try:
+            reply = await self.sendcmd('EPSV')
+            port = int(reply[reply.index('(') + 1:reply.index(')')].strip('|').split('|')[-1])
+        except ftplib.error_perm:
+            reply = await self.sendcmd('PASV')
+            numbers = re.search(r'(\d+),(\d+),(\d+),(\d+),(\d+),(\d+)', reply).groups()
+            # Like ftplib, the address sent by the server is ignored in favour of the control connection's
+            port = int(numbers[4]) * 256 + int(numbers[5])
+        # Let the stream buffer a whole block, so reads aren't cut short by its default 64 KiB limit
+        if not self.protectData:
+            return await asyncio.wait_for(asyncio.open_connection(self.host, port, limit=max(blockSize, 65536)), self.timeout)
+        loop = asyncio.get_running_loop()
+        dataReader = asyncio.StreamReader(limit=max(blockSize, 65536), loop=loop)
+        protocol = getDataConnectionProtocolClass()(dataReader, loop=loop)
+        transport, _ = await asyncio.wait_for(loop.create_connection(lambda: protocol, self.host, port), self.timeout)
+        return dataReader, asyncio.StreamWriter(transport, protocol, dataReader, loop)
+
+    async def secureDataConnection(self, dataWriter):
+        """ Function that negotiates TLS on a data connection, once the server accepted the command using it. """
+        if self.reuseSession and hasattr(self.tlsContext, 'session'):
+            # The context is this connection's own, and it opens a data connection at a time
+            self.tlsContext.session = self.writer.get_extra_info('ssl_object').session
+        await dataWriter.start_tls(self.tlsContext, server_hostname=self.host, ssl_handshake_timeout=self.timeout)
+
+    async def transfer(self, command, consumer, transferType='I', rest=None, blockSize=65536):
+        """
+        Function that runs a command that sends its result over a data connection
+
+        Parameters
+        ----------
+            - command : str
+                Command such as 'RETR name' or 'MLSD'
+            - consumer : callable
+                Called with every block of data received. If it returns an awaitable, it is awaited before the next block is read.
+            - transferType : str
+                'I' for binary or 'A' for ASCII
+            - rest : int
+                Byte to start the transfer from, sent with REST
+            - blockSize : int
+                Maximum size of the blocks read from the data connection
+        """
+        await self.setType(transferType)
+        dataReader, dataWriter = await self.openDataConnection(blockSize)
+        try:
+            if rest:
+                reply = await self.sendcmd('REST {}'.format(rest))
+                if reply[:1] != '3':
+                    raise ftplib.error_reply(reply)
+            reply = await self.sendcmd(command)
+            if reply[:1] != '1':
+                raise ftplib.error_reply(reply)
+            if self.protectData:
+                await self.secureDataConnection(dataWriter)
+            while True:
+                block = await asyncio.wait_for(dataReader.read(blockSize), self.timeout)
+                if not block:
+                    break
+                consumed = consumer(block)
+                if consumed is not None:
+                    await consumed
+        finally:
+            dataWriter.close()
+        reply = await self.getresp()
+        if reply[:1] != '2':
+            raise ftplib.error_reply(reply)
+        return reply
+
+    async def retrlines(self, command):
+        """ Function that runs a listing command and returns the lines it produced. """
+        chunks = []
+        await self.transfer(command, chunks.append, transferType='A')
+        return [line for line in b''.join(chunks).decode(self.encoding, 'replace').splitlines() if line]
+
+    async def mlsd(self, path=''):
+        """ Function that lists a directory with MLSD, returning (name, facts) pairs like ftplib's mlsd(). """
+        entries = []
+        for line in await self.retrlines('MLSD ' + path if path else 'MLSD'):
+            factsFound, _, name = line.partition(' ')
+            facts = {}
+            for fact in factsFound[:-1].split(';'):
+                key, _, value = fact.partition('=')
+                facts[key.lower()] = value
+            entries.append((name, facts))
+        return entries
+
+    async def quit(self):
+        try:
+            await self.voidcmd('QUIT')
+        finally:
+            self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+async def openFtpConnectionAsync(siteConfig, sourceDirectory=None, siteName=None):
     """
-    Function that parses the configuration file and reads all the ftp credentials present in the file
+    Async counterpart of openFtpConnection()
 
-    Parameters
-    ----------
-        - ftpPath : str
-            Path to the ftp yaml file
-    
     Returns
     -------
-        - ftpConfigs : dict
-            A dictionary of all FTP credentials present in the YAML path
-            Each dictionary contains the host, name, password, and path to the directory to download from
+        - ftp : AsyncFTP
+            Logged-in FTP connection
     """
-    localFrame = inspect.currentframe()
-    with open(ftpPath, 'r') as stream:
-        try:
-            ftpConfigs = yaml.safe_load(stream)
-        except yaml.YAMLError as exc:
-            LOGGER.writeLog("Error while loading YAML.", localFrame.f_lineno, severity='code-breaker', data={'code':3, 'error':exc})
+    siteName = siteName or siteConfig['site']
+    tls = siteConfig.get('tls', False)
+    if tls and not hasattr(asyncio.StreamWriter, 'start_tls'):
+        raise RuntimeError("FTPS on the async engine needs Python 3.11 or higher (currently {}.{}), use the thread engine for {}.".format(PYTHON_VERSION[0], PYTHON_VERSION[1], siteName))
+    # Every connection has a context of its own, holding the session its data connections resume
+    tlsContext = getTlsContext(siteConfig, getSessionReusingContextClass()) if tls else None
+    ftp = AsyncFTP(siteConfig['site'], siteConfig.get('port', 21), timeout=siteConfig.get('timeout', DEFAULT_TIMEOUT),
+                   tlsContext=tlsContext, reuseSession=siteConfig.get('tls_session_reuse', True))
+    try:
+        with METRICS.span(siteName, 'connect'):
+            await ftp.connect()
+        if tls:
+            with METRICS.span(siteName, 'tls'):
+                await ftp.startTls()
+        with METRICS.span(siteName, 'login'):
+            await ftp.login(siteConfig['user'], str(siteConfig['password']))
+        if tls:
+            await ftp.protectDataConnections()
+        if sourceDirectory:
+            await ftp.cwd(sourceDirectory)
+    except BaseException:
+        ftp.close()
+        raise
+    return ftp
 
-    # Check if each config is in proper order or lese remove the faulty configs
-    for config in list(ftpConfigs.keys()):
-        site = ftpConfigs[config]
-        # Check if all four keys are present
-        if not all(item in site.keys() for item in ['site', 'user', 'password', 'remote_path']):
-            LOGGER.writeLog("Key missing from {} site info. Removing faulty config...".format(config), localFrame.f_lineno, severity='warning')
-            del ftpConfigs[config]
+@functools.lru_cache(maxsize=None)
+def getDataConnectionProtocolClass():
+    """
+    Function that defines, on first use, the protocol of FTPS data connections. They are upgraded to TLS once the
+    server accepted the command, and the server may close one as soon as the handshake is done: before the stream
+    knows it is over TLS, where keeping a half-closed connection open isn't possible, and asyncio warns about it.
+    """
+    class DataConnectionProtocol(asyncio.StreamReaderProtocol):
+        def eof_received(self):
+            # Nothing is ever sent on a data connection, it is done once the server closed it
+            asyncio.StreamReaderProtocol.eof_received(self)
+            return False
 
-        # Check if all four keys are not None
-        if not (site['site'] and site['user'] and site['password'] and site['remote_path']):
-            LOGGER.writeLog("A value in in {} site info is None (Not present). Removing faulty config...".format(config), localFrame.f_lineno, severity='warning')
-            del ftpConfigs[config]
-    return ftpConfigs
+    return DataConnectionProtocol
 
-def connectToFTP(siteConfig, siteName, downloadPath):
+@functools.lru_cache(maxsize=None)
+def getSessionReusingContextClass():
     """
-    Function that connects to the required FTP site, navigates to the specified path and hands over to the download function
+    Function that defines, on first use, an SSLContext that resumes a given TLS session on the connections it
+    opens. asyncio has no way to pass a session to the connections it wraps.
+    """
+    class SessionReusingContext(ssl.SSLContext):
+        # Session of the control connection, resumed by the data connections
+        session = None
 
-    Parameters
-    ----------
-        - siteConfig : dict
-            Dictionary that contains host, name, password, and path.
-        - downloadPath : str
-            Local machine's download path
+        def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+            return ssl.SSLContext.wrap_bio(self, incoming, outgoing, server_side, server_hostname, session or self.session)
+
+    return SessionReusingContext
+
+async def callWithRetriesAsync(function, siteConfig, description, siteName=None):
+    """ Async counterpart of callWithRetries(), function() returns a coroutine. """
+    siteName = siteName or siteConfig['site']
+    retries = getRetryCount(siteConfig)
+    attempt = 0
+    while True:
+        try:
+            return await function()
+        except Exception as error:
+            attempt += 1
+            if attempt > retries or not isTransientError(error):
+                raise
+            await asyncio.sleep(noteRetry(siteName, siteConfig, description, error, attempt))
+
+async def connectToFTPAsync(siteConfig, siteName, downloadPath, recursive=False, extractor=None):
+    """
+    Async counterpart of connectToFTP(), takes the same parameters and returns the same list of downloaded files.
     """
-    localFrame = inspect.currentframe()
 
     hostname = siteConfig['site']
-    username = siteConfig['user']
-    password = str(siteConfig['password'])
     sourceDirectory = siteConfig['remote_path'] # TODO: change to camel case
 
-    LOGGER.writeLog("Connecting to {} at host {}...".format(siteName, hostname), localFrame.f_lineno, severity='normal')
+    LOGGER.writeLog("Connecting to {} at host {}...".format(siteName, hostname), severity='normal')
+    ftp = await callWithRetriesAsync(lambda: openFtpConnectionAsync(siteConfig, siteName=siteName), siteConfig, "Connecting to {}".format(siteName), siteName)
+    LOGGER.writeLog("Welcome: ", severity='normal')
+    for line in ftp.getwelcome().split('\n'):
+        LOGGER.writeLog(line, severity='normal')
+    LOGGER.writeLog("Connected Successfully!", severity='normal')
 
-    # Attempt to connect        
-    ftp = FTP(hostname)
-    ftp.login(username, password)
+    recursive = recursive or bool(siteConfig.get('recursive', False))
+    return await downloadFilesAsync(ftp, hostname, sourceDirectory, downloadPath, siteConfig=siteConfig, siteName=siteName, recursive=recursive, extractor=extractor)
 
-    # Welcome could be multiple lines
-    ftpWelcome = ftp.getwelcome()
-    welcomeLines = []
-    while True:
-        try:
-            oneline = ftpWelcome[:ftpWelcome.index('\n')]
-            welcomeLines.append(oneline)
-            ftpWelcome = ftpWelcome[ftpWelcome.index('\n')+1:]
-        except ValueError:
-            welcomeLines.append(ftpWelcome)
-            break
-    
-    LOGGER.writeLog("Welcome: ", localFrame.f_lineno, severity='normal')
-    for i in welcomeLines:
-        LOGGER.writeLog(i, localFrame.f_lineno, severity='normal')
-    LOGGER.writeLog("Connected Successfully!", localFrame.f_lineno, severity='normal')
-    
-    return downloadFiles(ftp, hostname, sourceDirectory, downloadPath)
-    
-def downloadFiles(ftp, hostname, sourceDirectory, localDownloadPath):
+async def downloadFilesAsync(ftp, hostname, sourceDirectory, localDownloadPath, siteConfig=None, siteName=None, recursive=False, extractor=None):
     """
-    Function that downloads all the files present in the current working directory of the ftp connection to the local download path
-
-    Parameters
-    ----------
-        - ftp : FTP Object
-            FTP connection
-        - hostname : str
-            Hostname of the FTP site that the ftp object is connected to
-        - sourceDirectory : str
-            Path to the source directory in ftp server from where the files will be downloaded
-        - localDownloadPath : str
-            Local machine's path where the files need to be downloaded
+    Async counterpart of downloadFiles(), takes the same parameters (with an AsyncFTP connection)
+    and returns the same list of downloaded files.
+    The site's connections are coroutines on the event loop instead of threads.
     """
-    localFrame = inspect.currentframe()
 
-    ftp.cwd(sourceDirectory)
-    LOGGER.writeLog("This script will only download files, not directories.", localFrame.f_lineno, severity='normal')
-    LOGGER.writeLog("Files at {}:".format(sourceDirectory), localFrame.f_lineno, severity='normal')
+    await ftp.cwd(sourceDirectory)
+    if recursive:
+        LOGGER.writeLog("Mirroring the directory tree under {}.".format(sourceDirectory), severity='normal')
+    else:
+        LOGGER.writeLog("This script will only download files, not directories.", severity='normal')
 
-    fileList = []
-    ftp.retrlines("LIST", fileList.append)
-    for i in fileList:
-        LOGGER.writeLog(i, localFrame.f_lineno, severity='normal')
+    connections = getConnectionCount(siteConfig)
+    pool = AsyncFTPConnectionPool(siteConfig, sourceDirectory, size=connections, connection=ftp, siteName=siteName or hostname)
+    try:
+        entries = await listRemoteEntriesAsync(pool, '')
+    except BaseException:
+        await pool.closeAll(keep=ftp)
+        raise
+    # The files are handled by the tasks below, only the listing and filtering of the walk are shared
+    walk = RemoteWalk(pool, siteConfig, recursive, None)
+    fileEntries, directoryEntries = walk.addListing('', entries)
 
-    # Get file list
-    fileList = []
-    ftp.retrlines("NLST", fileList.append)
+    manifest = None
+    if siteName and (siteConfig or {}).get('incremental', True):
+        manifest = SiteManifest(siteName)
+    index = DownloadIndex(siteName) if siteName else None
 
-    # Download each file
+    if not recursive:
+        connections = min(connections, max(1, len(fileEntries)))
+        pool.size = min(pool.size, connections)
+    if connections > 1:
+        LOGGER.writeLog("Downloading with up to {} connections to {}".format(connections, hostname), severity='normal')
+    tasks = asyncio.PriorityQueue()
+    counter = [0]
     filesDownloaded = []
-    for filename in fileList:
-        if (filename != '.') and (filename != '..'):
-            LOGGER.writeLog("Downloading {}...".format(filename), localFrame.f_lineno, severity='normal')
+
+    def submit(priority, function, *args):
+        counter[0] += 1
+        tasks.put_nowait((priority, counter[0], function, args))
+
+    async def download(entry):
+        if await downloadFileAsync(pool, entry, localDownloadPath, manifest, sidecar=walk.sidecars.get(entry.name)):
+            filesDownloaded.append(entry.name)
+            recordDownload(entry, localDownloadPath, index, extractor, pool.siteName)
+
+    async def listDirectory(path):
+        # Directories are walked before any queued download so discovery keeps ahead of the transfers
+        try:
+            subEntries = await listRemoteEntriesAsync(pool, path)
+        except Exception as listingError:
+            walk.failed = True
+            LOGGER.writeLog("Listing {} failed, skipping it: {}".format(path, listingError), severity='error')
+            return
+        files, directories = walk.addListing(path, subEntries)
+        for entry in directories:
+            submit(LISTING_PRIORITY, listDirectory, entry.name)
+        for entry in files:
+            submit(getDownloadPriority(entry), download, entry)
+
+    async def worker():
+        while True:
+            priority, order, function, args = await tasks.get()
             try:
-                file = open(os.path.join(localDownloadPath, filename), "wb")
-                ftp.retrbinary("RETR " + filename, file.write)
-                filesDownloaded.append(filename)
-                file.close()
-            except Exception as directory_error:     # Could it be another error though?
-                LOGGER.writeLog("{} was actually a directory, skipping...".format(filename), localFrame.f_lineno, severity='normal')
+                await function(*args)
+            except Exception as taskError:
+                LOGGER.writeLog("A queued task failed: {!r}".format(taskError), severity='error')
+            finally:
+                tasks.task_done()
+
+    workers = [asyncio.ensure_future(worker()) for index in range(connections)]
+    try:
+        for entry in directoryEntries:
+            submit(LISTING_PRIORITY, listDirectory, entry.name)
+        for entry in fileEntries:
+            submit(getDownloadPriority(entry), download, entry)
+        await tasks.join()
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await pool.closeAll(keep=ftp)
+        if index is not None:
+            applyRetention(siteName, siteConfig, index, manifest, keep=[getLocalPath(localDownloadPath, name) for name in filesDownloaded])
+            index.save()
+        store = getContentStore(siteConfig)
+        if store is not None:
+            store.save()
+        if manifest is not None:
+            if not walk.failed:
+                manifest.prune([entry.name for entry in walk.files])
+            manifest.save()
 
-    LOGGER.writeLog("{} files successfully downloaded".format(len(filesDownloaded)), localFrame.f_lineno, severity='normal')
+    LOGGER.writeLog("{} files successfully downloaded".format(len(filesDownloaded)), severity='normal')
 
-    disconnectFtp(ftp, hostname)
+    LOGGER.writeLog("Disconnecting from {}...".format(hostname), severity='normal')
+    try:
+        await ftp.quit()
+    except (ftplib.all_errors + (asyncio.TimeoutError, AttributeError)):
+        # The connection was already dropped
+        ftp.close()
+    LOGGER.writeLog("Disconnected from {}.".format(hostname), severity='normal')
 
     return filesDownloaded
 
-def disconnectFtp(ftp, hostname):
+async def downloadFileAsync(pool, entry, localDownloadPath, manifest=None, sidecar=None):
     """
-    Function that disconnects from the ftp connection
+    Async counterpart of downloadFile(), with the same '.part' file, resume and retry behavior
+    """
+    filename = entry.name
+    decision = getTransferDecision(entry, localDownloadPath, manifest)
+    localPath = decision.localPath
+    if localPath is None:
+        LOGGER.writeLog("{} points outside of the download directory, skipping...".format(filename), severity='warning')
+        return False
+    partPath = localPath + '.part'
+    retries = getRetryCount(pool.siteConfig)
+    blockSize = getBlockSize(pool.siteConfig)
+    algorithms = getChecksumAlgorithms(pool.siteConfig, sidecar)
+    store = getContentStore(pool.siteConfig)
 
-    Parameters
-    ----------
-        - ftp : FTP Object
-            FTP connection
-        - hostname : str
-            Hostname of the FTP site that the ftp object is connected to
+    if decision.unchanged:
+        noteUnchangedFile(entry, manifest)
+        return False
+
+    attempt = 0
+    while True:
+        ftp = await pool.acquire()
+        offset = 0
+        try:
+            entry = await getRemoteMetadataAsync(ftp, entry, modify=manifest is not None)
+            if skipUnchangedFile(entry, localPath, manifest):
+                pool.release(ftp)
+                return False
+            candidates = store.findCandidates(entry) if store is not None else None
+            if candidates and linkKnownFile(store, candidates, await getRemoteHashAsync(ftp, pool, filename), entry, localPath, partPath, manifest, pool.siteName):
+                pool.release(ftp)
+                return True
+
+            offset = startDownload(entry, partPath, localPath, manifest)
+            compressed = await useModeZAsync(ftp, pool)
+            # Disk writes and hashing run in threads, a slow disk or a big file must not hold up the other transfers on the loop
+            loop = asyncio.get_running_loop()
+            file = await loop.run_in_executor(None, PartFile, partPath, offset, entry.size, algorithms, compressed)
+            writer = BlockWriter(loop, file.feed)
+            try:
+                with METRICS.span(pool.siteName, 'transfer', file=filename, offset=offset, size=entry.size, modify=entry.modify) as transfer:
+                    try:
+                        await ftp.transfer("RETR " + filename, writer.feed, rest=offset or None, blockSize=blockSize)
+                        await writer.drain()
+                        await loop.run_in_executor(None, file.finish)
+                    finally:
+                        transfer['bytes'] = file.position - offset
+                        transfer['wireBytes'] = file.received
+            finally:
+                # The write still running when the transfer failed has to end before the file is cut back
+                with contextlib.suppress(Exception):
+                    await writer.drain()
+                await loop.run_in_executor(None, file.close)
+            digests = file.getDigests()
+            if algorithms:
+                with METRICS.span(pool.siteName, 'checksum', file=filename) as check:
+                    sidecarText = await readRemoteFileAsync(ftp, sidecar[0]) if sidecar else None
+                    await loop.run_in_executor(None, verifyChecksum, entry, partPath, digests, pool.siteConfig, sidecar, sidecarText, check)
+
+            completeDownload(entry, partPath, localPath, manifest)
+            storeDownload(store, entry, localPath, digests, pool.siteName)
+            pool.release(ftp)
+            return True
+        except ftplib.error_perm as permanentError:
+            pool.release(ftp)
+            if offset and attempt < retries:
+                LOGGER.writeLog("{} can't be resumed ({}), downloading it again...".format(filename, permanentError), severity='warning')
+                os.remove(partPath)
+                attempt += 1
+                continue
+            rejectDownload(entry, partPath, permanentError)
+            return False
+        except Exception as transferError:
+            pool.discard(ftp)
+            attempt += 1
+            if attempt > retries or not isTransientError(transferError):
+                LOGGER.writeLog("Downloading {} failed, it will be resumed in the next run: {!r}".format(filename, transferError), severity='error')
+                return False
+            await asyncio.sleep(noteRetry(pool.siteName, pool.siteConfig, "Downloading {}".format(filename), transferError, attempt))
+
+class BlockWriter(object):
+    """ Writes the blocks of an async transfer in the default executor, one at a time and in order, while the next block is received. """
+    def __init__(self, loop, write):
+        """
+        Parameters
+        ----------
+            - loop : asyncio loop
+                Loop the transfer runs on
+            - write : callable
+                Called in the executor with every block, e.g. PartFile.feed
+        """
+        self.loop = loop
+        self.write = write
+        self.pending = None
+
+    async def feed(self, block):
+        """ Function that waits for the previous block to be written and starts writing this one. """
+        await self.drain()
+        self.pending = self.loop.run_in_executor(None, self.write, block)
+
+    async def drain(self):
+        """ Function that waits for the block being written, raising its error if the write failed. """
+        pending, self.pending = self.pending, None
+        if pending is not None:
+            await pending
+
+async def readRemoteFileAsync(ftp, path):
+    """ Function that downloads a small file into memory and returns its text, see readRemoteFile(). """
+    chunks = []
+    try:
+        await ftp.setMode('S')
+        await ftp.transfer("RETR " + path, chunks.append)
+    except ftplib.error_perm as permanentError:
+        LOGGER.writeLog("Reading {} failed: {}".format(path, permanentError), severity='warning')
+        return None
+    return b''.join(chunks).decode('utf-8', 'replace')
+
+async def getServerFeaturesAsync(ftp, pool):
+    """ Async counterpart of getServerFeatures() """
+    if pool.features is None:
+        try:
+            pool.features = parseFeatures(await ftp.sendcmd('FEAT'))
+        except ftplib.error_perm:
+            pool.features = {}
+    return pool.features
+
+async def useModeZAsync(ftp, pool):
+    """ Async counterpart of useModeZ() """
+    if pool.modeZ is None:
+        setting = getModeZSetting(pool.siteConfig)
+        pool.modeZ = setting == 'on' or (setting == 'auto' and 'Z' in (await getServerFeaturesAsync(ftp, pool)).get('MODE', '').upper().split(','))
+    if not pool.modeZ:
+        await ftp.setMode('S')
+        return False
+    try:
+        await ftp.setMode('Z')
+    except ftplib.error_perm as permanentError:
+        LOGGER.writeLog("{} refused MODE Z, transferring uncompressed: {}".format(pool.siteName, permanentError), severity='warning')
+        pool.modeZ = False
+        return False
+    return True
+
+async def getRemoteHashAsync(ftp, pool, name):
     """
-    localFrame = inspect.currentframe()
-    LOGGER.writeLog("Disconnecting from {}...".format(hostname), localFrame.f_lineno, severity='normal')
-    ftp.quit()
-    LOGGER.writeLog("Disconnected from {}.".format(hostname), localFrame.f_lineno, severity='normal')
-    time.sleep(1)
+    Async counterpart of getRemoteHash()
+    """
+    if pool.hashCommands is None:
+        pool.hashCommands = getHashCommands(await getServerFeaturesAsync(ftp, pool))
+    for command, algorithm in list(pool.hashCommands):
+        try:
+            if command == 'HASH':
+                await ftp.sendcmd('OPTS HASH ' + HASH_NAMES[algorithm])
+            reply = await ftp.sendcmd('{} {}'.format(command, name))
+        except ftplib.error_perm as permanentError:
+            if not isUnsupportedCommand(permanentError):
+                return None
+            if (command, algorithm) in pool.hashCommands:
+                pool.hashCommands.remove((command, algorithm))
+            continue
+        digest = parseHashReply(command, algorithm, reply)
+        if digest:
+            return algorithm, digest
+    return None
 
-def unzipZippedFiles(downloadPath, downloadedFiles):
+async def listRemoteDirectoryAsync(ftp, path=''):
+    """
+    Async counterpart of listRemoteDirectory()
+    """
+    entries = []
+    await ftp.setMode('S')
+    try:
+        for name, facts in await ftp.mlsd(path):
+            entry = parseMlsdFacts(name, facts)
+            if entry is not None:
+                entries.append(entry)
+        return entries
+    except ftplib.error_perm:
+        pass
+
+    unparsedLines = []
+    for line in await ftp.retrlines("LIST " + path if path else "LIST"):
+        entry = parseListLine(line)
+        if entry is None:
+            if line.strip() and not line.lower().startswith('total'):
+                unparsedLines.append(line)
+        elif entry.name not in ('.', '..'):
+            entries.append(entry)
+
+    if unparsedLines:
+        LOGGER.writeLog("{} lines of the LIST output couldn't be parsed, getting the names with NLST.".format(len(unparsedLines)), severity='warning')
+        knownNames = set(entry.name for entry in entries)
+        for name in await ftp.retrlines("NLST " + path if path else "NLST"):
+            name = name.rsplit('/', 1)[-1]
+            if name not in knownNames and name not in ('.', '..'):
+                entries.append(RemoteEntry(name, None, None, None))
+    return entries
+
+async def listRemoteEntriesAsync(pool, path):
     """
-    This function will read all the files that were downloaded, find the zip files, and unzip them
+    Async counterpart of listRemoteEntries()
+    """
+    async def listPath(ftp):
+        with METRICS.span(pool.siteName, 'listing', path=posixpath.join(pool.sourceDirectory, path) if path else pool.sourceDirectory) as listing:
+            entries = await listRemoteDirectoryAsync(ftp, path)
+            listing['entries'] = len(entries)
+        return entries
 
-    Parameters
-    ----------
-        - downloadPath : str
-            Local machine's path where the files were downloaded
-        - downloadedFiles : list
-            Name of the files that were downloaded
+    entries = await pool.run(listPath, "Listing {}".format(posixpath.join(pool.sourceDirectory, path)))
+    return [entry._replace(name=posixpath.join(path, entry.name)) for entry in entries]
 
+async def getRemoteMetadataAsync(ftp, entry, modify=True):
     """
-    localFrame = inspect.currentframe()
-    for i in downloadedFiles:
-        file = os.path.join(downloadPath, i)
-
-        # Check if file is zip file and unzip it
-        if zipfile.is_zipfile(file):
-            with zipfile.ZipFile(file, 'r') as zipObj:
-                zipObj.extractall(downloadPath)
-            LOGGER.writeLog("Unzipped {}.".format(file), localFrame.f_lineno, severity='normal')
-        # Check if tar file
-        elif tarfile.is_tarfile(file):
-            tarFile = tarfile.open(file)
-            tarFile.extractall(downloadPath) # specify which folder to extract to
-            tarFile.close()
-            LOGGER.writeLog("Unzipped {}.".format(file), localFrame.f_lineno, severity='normal')
+    Async counterpart of getRemoteMetadata()
+    """
+    if entry.size is None:
+        try:
+            entry = entry._replace(size=await ftp.size(entry.name))
+        except ftplib.error_perm:
+            pass
+    if modify and entry.modify is None:
+        try:
+            entry = entry._replace(modify=await ftp.mdtm(entry.name))
+        except ftplib.error_perm:
+            pass
+    return entry
+
+class AsyncFTPConnectionPool(object):
+    """ Async counterpart of FTPConnectionPool, for AsyncFTP connections on one event loop. """
+    def __init__(self, siteConfig, sourceDirectory, size=1, connection=None, siteName=None):
+        self.siteName = siteName
+        self.siteConfig = siteConfig
+        self.sourceDirectory = sourceDirectory
+        self.size = size
+        self.opened = 0
+        self.connections = []
+        self.idle = asyncio.Queue()
+        self.lostError = None
+        self.features = None
+        self.hashCommands = None
+        self.modeZ = None
+        if connection is not None:
+            self.connections.append(connection)
+            self.idle.put_nowait(connection)
+
+    async def acquire(self):
+        while True:
+            if self.lostError is not None:
+                self.idle.put_nowait(None)
+                raise self.lostError
+            if not self.idle.empty() or len(self.connections) + self.opened >= self.size:
+                ftp = await self.idle.get()
+            else:
+                ftp = await self.open()
+            if ftp is not None:
+                return ftp
+
+    async def open(self):
+        alone = not self.connections and not self.opened
+        # Reserve the slot before connecting so other coroutines don't open one too
+        self.opened += 1
+        try:
+            if alone:
+                ftp = await callWithRetriesAsync(lambda: openFtpConnectionAsync(self.siteConfig, self.sourceDirectory, siteName=self.siteName), self.siteConfig, "Reconnecting to {}".format(self.siteName), self.siteName)
+            else:
+                ftp = await openFtpConnectionAsync(self.siteConfig, self.sourceDirectory, siteName=self.siteName)
+        except Exception as connectionError:
+            if alone:
+                self.lostError = connectionError
+                return None
+            if not self.connections:
+                return None
+            # The server may cap the number of sessions, make do with what is open
+            self.size = len(self.connections)
+            LOGGER.writeLog("Could not open another connection to {} ({}), continuing with {}.".format(self.siteConfig['site'], connectionError, self.size), severity='warning')
+            return await self.idle.get()
+        finally:
+            self.opened -= 1
+        self.connections.append(ftp)
+        return ftp
+
+    async def run(self, function, description):
+        """ Async counterpart of FTPConnectionPool.run(), function(ftp) is a coroutine. """
+        retries = getRetryCount(self.siteConfig)
+        attempt = 0
+        while True:
+            ftp = await self.acquire()
+            try:
+                result = await function(ftp)
+            except ftplib.error_perm:
+                self.release(ftp)
+                raise
+            except Exception as error:
+                self.discard(ftp)
+                attempt += 1
+                if attempt > retries or not isTransientError(error):
+                    raise
+                await asyncio.sleep(noteRetry(self.siteName, self.siteConfig, description, error, attempt))
+                continue
+            self.release(ftp)
+            return result
+
+    def release(self, ftp):
+        self.idle.put_nowait(ftp)
+
+    def discard(self, ftp):
+        if ftp in self.connections:
+            self.connections.remove(ftp)
+        ftp.close()
+        self.idle.put_nowait(None)
+
+    async def closeAll(self, keep=None):
+        connections = [ftp for ftp in self.connections if ftp is not keep]
+        self.connections = [ftp for ftp in self.connections if ftp is keep]
+        for ftp in connections:
+            try:
+                await ftp.quit()
+            except (ftplib.all_errors + (asyncio.TimeoutError,)):
+                ftp.close()
+
+def runSitesAsync(targetFTPSite, ftpConfigs, outputDIRPath, unzipFiles, runOptions, extractor=None):
+    """
+    Function that downloads from every target site like runSites(), but with the asyncio engine:
+    every site and every connection runs on one event loop in the main thread.
+    At most `workers` sites are processed at the same time, each with at most its `connections`.
+
+    Returns
+    -------
+        - allFilesDownloaded : list
+            Names of the files downloaded from all the sites, in the order the sites finished
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(runSitesOnLoop(targetFTPSite, ftpConfigs, outputDIRPath, unzipFiles, runOptions, extractor))
+    finally:
+        loop.close()
+
+async def runSitesOnLoop(targetFTPSite, ftpConfigs, outputDIRPath, unzipFiles, runOptions, extractor=None):
+    semaphore = asyncio.Semaphore(max(1, runOptions['workers']))
+    allFilesDownloaded = []
+
+    async def limitedSite(site):
+        async with semaphore:
+            return await processSiteAsync(ftpConfigs[site], site, outputDIRPath, unzipFiles, runOptions, extractor)
+
+    for future in asyncio.as_completed([limitedSite(site) for site in targetFTPSite]):
+        allFilesDownloaded = allFilesDownloaded + await future
+    return allFilesDownloaded
+
+async def processSiteAsync(siteConfig, siteName, outputDIRPath, unzipFiles, runOptions=None, extractor=None):
+    """
+    Async counterpart of processSite()
+    """
+    runOptions = runOptions or {}
+    try:
+        with METRICS.span(siteName, 'site'):
+            downloadedFiles = await connectToFTPAsync(siteConfig, siteName, outputDIRPath, recursive=runOptions.get('recursive', False), extractor=extractor)
+    except Exception as siteError:
+        LOGGER.writeLog("Downloading from {} failed, skipping the site: {!r}".format(siteName, siteError), severity='error')
+        return []
+
+    if unzipFiles and extractor is None:
+        # Extracting blocks, keep it off the event loop
+        await asyncio.get_event_loop().run_in_executor(None, unzipZippedFiles, outputDIRPath, downloadedFiles)
+    return downloadedFiles
+""" Asyncio transfer engine ends """
 
 """ Argument parsing part starts """
+# Defining options in for command line arguments
+COMMAND_LINE_OPTIONS = "hf:o:vpus:w:re:d"
+COMMAND_LINE_LONG_OPTIONS = ["help", "file=", 'output=', 'verbose', 'preserve', 'unzip', "site=", "workers=", "recursive", "engine=", "report=", "prometheus=", "log-format=", "log-level=", "daemon", "interval=", "plan", "plan-json=", "stats=", "since="]
+
+def isHelpRequested(argv):
+    """ Function that tells if -h or --help is among the arguments, invalid arguments are left to parseArgs(). """
+    import getopt
+    try:
+        opts, args = getopt.getopt(argv, COMMAND_LINE_OPTIONS, COMMAND_LINE_LONG_OPTIONS)
+    except getopt.GetoptError:
+        return False
+    return any(option in ("-h", "--help") for option, value in opts)
+
 def parseArgs(argv):
     """
     Function that parses the arguments sent from the command line 
@@ -342,11 +5114,20 @@ def parseArgs(argv):
         - verbose : bool
         - preserveOldFiles : bool
             A boolean variable that will tell the script to keep or remove older downloaded files in the download path
+        - runOptions : dict
+            Behavioral options for the download run
+                - workers : int : number of sites to download from concurrently
+                - recursive : bool : mirror the remote directory trees instead of only their top level files
+                - engine : str : 'thread' for blocking ftplib connections in threads, 'async' for the asyncio engine
+                - report : str : path of the JSON run report, None to not write it
+                - prometheus : str : path of the Prometheus textfile, None to not write it
+                - daemon : bool : keep running and poll the sites instead of downloading once
+                - interval : float : default seconds between two polls of a site in daemon mode
+                - plan : bool : only list the sites and print what would be transferred
+                - planJson : str : path the transfer plan is written to as JSON, '-' for the standard output, None to not write it
+                - stats : str : only print the answer of a run database query, 'slowest', 'trend' or 'changed'
+                - since : str : how far back the query looks, e.g. '7d'
     """
-    localFrame = inspect.currentframe()
-    # Defining options in for command line arguments
-    options = "hf:o:vpus:"
-    long_options = ["help", "file=", 'output=', 'verbose', 'preserve', 'unzip', "site="]
     
     # Arguments
     ftpYAMLPath = 'ftp.yaml'
@@ -358,10 +5139,24 @@ def parseArgs(argv):
     unzipFiles = False
     targetSiteSpecified = False
     targetSite = '.*_.*'
+    runOptions = {
+        'workers': 1,
+        'recursive': False,
+        'engine': 'thread',
+        'report': None,
+        'prometheus': None,
+        'daemon': False,
+        'interval': DEFAULT_POLL_INTERVAL,
+        'plan': False,
+        'planJson': None,
+        'stats': None,
+        'since': DEFAULT_STATS_SINCE,
+    }
 
     # Extracting arguments
+    import getopt
     try:
-        opts, args = getopt.getopt(argv, options, long_options)
+        opts, args = getopt.getopt(argv, COMMAND_LINE_OPTIONS, COMMAND_LINE_LONG_OPTIONS)
     except getopt.GetoptError:
         # Not logging here since this is a command-line feature and must be printed on console
         LOGGER.verbose = True
@@ -370,7 +5165,7 @@ def parseArgs(argv):
         exit()
 
     for option, value in opts:
-        if option == '-h':
+        if option in ("-h", "--help"):
             # Turn on verbose, print help message, and exit
             LOGGER.verbose = True
             print (HELP_MESSAGE)
@@ -392,6 +5187,48 @@ def parseArgs(argv):
         elif option in ("-s", "--site"):
             targetSite = value
             targetSiteSpecified = True
+        elif option in ("-w", "--workers"):
+            try:
+                runOptions['workers'] = max(1, int(value))
+            except ValueError:
+                LOGGER.writeLog("Number of workers must be an integer, got '{}'. Using 1.".format(value), severity='warning')
+        elif option in ("-r", "--recursive"):
+            runOptions['recursive'] = True
+        elif option in ("-e", "--engine"):
+            if value in ('thread', 'async'):
+                runOptions['engine'] = value
+            else:
+                LOGGER.writeLog("Unknown engine '{}', must be 'thread' or 'async'. Using 'thread'.".format(value), severity='warning')
+        elif option in ("-d", "--daemon"):
+            runOptions['daemon'] = True
+        elif option == "--interval":
+            try:
+                runOptions['interval'] = max(1.0, float(value))
+            except ValueError:
+                LOGGER.writeLog("The poll interval must be a number of seconds, got '{}'. Using {}.".format(value, DEFAULT_POLL_INTERVAL), severity='warning')
+        elif option == "--report":
+            runOptions['report'] = value
+        elif option == "--prometheus":
+            runOptions['prometheus'] = value
+        elif option == "--plan":
+            runOptions['plan'] = True
+        elif option == "--plan-json":
+            runOptions['plan'] = True
+            runOptions['planJson'] = value
+        elif option == "--stats":
+            if value in STATS_QUERIES:
+                runOptions['stats'] = value
+            else:
+                LOGGER.writeLog("Unknown statistics '{}', must be one of {}.".format(value, ', '.join(STATS_QUERIES)), severity='warning')
+        elif option == "--since":
+            runOptions['since'] = value
+        elif option == "--log-format":
+            if value in ('text', 'json'):
+                LOGGER.logFormat = value
+            else:
+                LOGGER.writeLog("Unknown log format '{}', must be 'text' or 'json'. Using 'text'.".format(value), severity='warning')
+        elif option == "--log-level":
+            LOGGER.setLevels(parseLogLevels(value))
             
 
 
@@ -408,14 +5245,37 @@ def parseArgs(argv):
     # Validate the target site and make sure it is present in there
     if targetSiteSpecified:
         if not targetSite in ftpConfigs.keys():
-            LOGGER.writeLog("Credentials of the target ftp site ({}) were not present in the config.".format(targetSite), localFrame.f_lineno, severity='code-breaker', data={'code':1})
-            LOGGER.writeLog("Check the log to make sure that it wasn't removed due to incomplete infromation.", localFrame.f_lineno, severity='code-breaker', data={'code':1})
-            LOGGER.writeLog("Exiting...", localFrame.f_lineno, severity='code-breaker', data={'code':1})
+            LOGGER.writeLog("Credentials of the target ftp site ({}) were not present in the config.".format(targetSite), severity='code-breaker', data={'code':1})
+            LOGGER.writeLog("Check the log to make sure that it wasn't removed due to incomplete infromation.", severity='code-breaker', data={'code':1})
+            LOGGER.writeLog("Exiting...", severity='code-breaker', data={'code':1})
             exit()
     else:
         targetSite = ".*_.*"
 
-    return ftpYAMLPath, outputDIRPath, preserveOldFiles, verbose, unzipFiles, ftpConfigs, targetSite
+    return ftpYAMLPath, outputDIRPath, preserveOldFiles, verbose, unzipFiles, ftpConfigs, targetSite, runOptions
+
+def parseLogLevels(specification):
+    """
+    Function that parses the value of --log-level
+
+    Parameters
+    ----------
+        - specification : str
+            Comma separated severities, either alone (the default) or as name=severity
+
+    Returns
+    -------
+        - levels : dict
+            Severity per module or function name, '' for the default. Unknown severities are skipped.
+    """
+    levels = {}
+    for part in specification.split(','):
+        name, _, severity = part.strip().rpartition('=')
+        if severity in LOG_LEVELS:
+            levels[name.strip()] = severity
+        elif part.strip():
+            LOGGER.writeLog("Unknown log level '{}', must be one of: {}.".format(part.strip(), ', '.join(LOG_LEVELS)), severity='warning')
+    return levels
 
 def validateConfigPath(configPath):
     """
@@ -430,15 +5290,14 @@ def validateConfigPath(configPath):
         - validated : bool
             A True or False as a result of the validation of the path
     """
-    localFrame = inspect.currentframe()
     # Check extension, must be YAML
     if not configPath.endswith('yaml'):
-        LOGGER.writeLog("Configuration file must be .yaml extension. Looking for configuration file in default locations.", localFrame.f_lineno, severity='error')
+        LOGGER.writeLog("Configuration file must be .yaml extension. Looking for configuration file in default locations.", severity='error')
         return False
 
     # Check if file exists
     if not os.path.exists(configPath):
-        LOGGER.writeLog("Specified path to the configuration file is invalid. Looking for configuration file in default locations.", localFrame.f_lineno, severity='error')
+        LOGGER.writeLog("Specified path to the configuration file is invalid. Looking for configuration file in default locations.", severity='error')
         return False
     else:
         return True
@@ -452,7 +5311,6 @@ def getDefaultConfigPath():
         - configPath : str
             Path to the configuration file if found in the default locations
     """
-    localFrame = inspect.currentframe()
     fileName = 'ftp.yaml'
     
     # Check in current directory
@@ -473,10 +5331,10 @@ def getDefaultConfigPath():
         if os.path.exists(configPath):
             return configPath
     else:
-        LOGGER.writeLog("Platform couldn't be recognized. Are you sure you are running this script on Windows or Ubuntu Linux?", localFrame.f_lineno, severity='code-breaker', data={'code':1})
+        LOGGER.writeLog("Platform couldn't be recognized. Are you sure you are running this script on Windows or Ubuntu Linux?", severity='code-breaker', data={'code':1})
         exit()
 
-    LOGGER.writeLog("ftp.yaml config file wasn't found in default locations! Specify a path to FTP credentials YAML file using (-f --file) argument.", localFrame.f_lineno, severity='code-breaker', data={'code':1})
+    LOGGER.writeLog("ftp.yaml config file wasn't found in default locations! Specify a path to FTP credentials YAML file using (-f --file) argument.", severity='code-breaker', data={'code':1})
     exit()
 
 def validateDownloadPath(path):
@@ -492,14 +5350,13 @@ def validateDownloadPath(path):
         - validated : bool
             True or False based on whether the path was validated or not
     """
-    localFrame =  inspect.currentframe()
     # Check if path exists
     if not os.path.exists(path):
-        LOGGER.writeLog("The download path does not exist. Switching to default download location.", localFrame.f_lineno, severity='warning')
+        LOGGER.writeLog("The download path does not exist. Switching to default download location.", severity='warning')
         return False
     # Check if path is a directory
     if not os.path.isdir(path):
-        LOGGER.writeLog("The download path must be a directory, not a file. Switching to default download location.", localFrame.f_lineno, severity='warning')
+        LOGGER.writeLog("The download path must be a directory, not a file. Switching to default download location.", severity='warning')
         return False
     return True
 
@@ -508,72 +5365,122 @@ def getDefaultDownloadPath(preserve):
     Function to check the operating system and determine the appropriate 
     download path for the export file based on operating system.
 
-    This funciton also purges the whole directory with any previous export files.
+    This funciton also purges the previous export files directly in the directory, see purge().
     
     Returns
     -------
         - downloadPath : str
             A valid path that points to the diretory where the file should be downloaded
     """
-    localFrame = inspect.currentframe()
 
     # If the platform is windows, set the download path to the current user's Downloads folder
     if sys.platform == 'win32' or sys.platform == 'win64': # Windows
         downloadPath = os.path.expandvars(r'%USERPROFILE%')
         downloadPath = os.path.join(downloadPath, 'Downloads')
         if not preserve:
-            purge(downloadPath, 'SureDone_')
-            LOGGER.writeLog("Purged existing files.", localFrame.f_lineno, severity='normal')
+            count = purge(downloadPath, PURGE_PREFIX)
+            LOGGER.writeLog("Purging {} existing files in the background.".format(count), severity='normal')
         return downloadPath
 
     # If Linux, set the download path to the $HOME/ folder
     elif sys.platform == 'linux' or sys.platform == 'linux2': # Linux
         downloadPath = expanduser('~')
         if not preserve:
-            purge(downloadPath, 'SureDone_')
-            LOGGER.writeLog("Purged existing files.", localFrame.f_lineno, severity='normal')
+            count = purge(downloadPath, PURGE_PREFIX)
+            LOGGER.writeLog("Purging {} existing files in the background.".format(count), severity='normal')
         return downloadPath
-
-def purge(dir, pattern, inclusive=True):
-    """
-    A simple function to remove everything within a directory and it's subdirectories if the file name mathces a specific pattern.
-
-    Parameters
-    ----------
-        - dir : str
-            The top level path of the directory from where the searching will begin
-        - pattern : regex-like str
-            A regex-like string that defines the pattern that needs to be deleted
-        - inclusive : boolean
-            Currently only has a True implementation
-    
-    Returns
-    -------
-        - count : int
-            The number files that were removed by the function
-    """
-    count = 0
-    regexObj = re.compile(pattern)
-    for root, dirs, files in os.walk(dir, topdown=False):
-        for name in files:
-            path = os.path.join(root, name)
-            if bool(regexObj.search(path)) == bool(inclusive):
-                if not path.endswith('.py'):
-                    os.remove(path)
-                    count += 1
-    return count
 """ Argument parsing part ends """
 
 """ Custom logger class """
+# Severities in increasing order, messages below the level of their function or module are dropped
+LOG_LEVELS = {
+    'debug': 10,
+    'normal': 20,
+    'warning': 30,
+    'error': 40,
+    'code-breaker': 50,
+}
+LOG_INDICATORS = {
+    'debug': '[D]',
+    'normal': '[N]',
+    'warning': '[W]',
+    'error': '[X]',
+    'code-breaker': '[!]',
+}
+
 class Logger(object):
-    """ The logger class that will handle all outputs, may it be console or log file. """
-    def __init__(self, verbose=False):
+    """
+    The logger class that will handle all outputs, may it be console or log file.
+    Messages are queued by the calling thread and formatted and written in batches by a background thread,
+    so downloads never wait for the log file or the terminal.
+    """
+    def __init__(self, verbose=False, logFormat='text', levels=None, batchSize=256):
+        """
+        Parameters
+        ----------
+            - verbose : bool
+                Also print the messages in the terminal
+            - logFormat : str
+                'text' for the classic log, 'json' for one JSON object per line
+            - levels : dict
+                Lowest severity written per function or module, see setLevels()
+            - batchSize : int
+                Maximum number of queued messages written at once
+        """
         self.terminal = sys.stdout
         self.log = open(self.getLogPath(), "a")
-        # Write the header row
-        self.log.write(' Ind. |LineNo.| Time stamp  : Message')
-        self.log.write('\n=====================================\n')
         self.verbose = verbose
+        self.logFormat = logFormat
+        self.batchSize = batchSize
+        # Module name by source file, see getCallerName()
+        self.moduleNames = {}
+        self.setLevels(levels)
+        # Text printed to the logger (it replaces sys.stdout) that doesn't end with a new line yet
+        self.pendingOutput = ''
+        # Serializes writing when there is no background writer
+        self.lock = threading.Lock()
+        self.queue = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self.writeBatches, name='logger', daemon=True)
+        self.writer.start()
+        # The header row is written with the first message, once the format is settled
+        self.headerWritten = False
+        atexit.register(self.close)
+
+    def setLevels(self, levels):
+        """
+        Function that sets the lowest severity that is written
+
+        Parameters
+        ----------
+            - levels : dict
+                Severity per name. The key '' sets the default, other keys are module names
+                (e.g. 'automatedFTPDownloader') or functions in them (e.g. 'automatedFTPDownloader.downloadFile').
+                The longest matching name wins.
+        """
+        self.levels = {'': 'normal'}
+        self.levels.update(levels or {})
+        # Line numbers are only looked up when debug messages are written somewhere
+        self.debug = 'debug' in self.levels.values()
+        # The calling function is only looked up when a level is set per module or function, or for debug messages
+        self.perName = self.debug or len(self.levels) > 1
+        self.defaultLevel = LOG_LEVELS[self.levels['']]
+        self.levelCache = {}
+
+    def getLevel(self, name):
+        level = self.levelCache.get(name)
+        if level is None:
+            matches = [key for key in self.levels if key == '' or name == key or name.startswith(key + '.')]
+            level = LOG_LEVELS[self.levels[max(matches, key=len)]]
+            self.levelCache[name] = level
+        return level
+
+    def getCallerName(self, code):
+        """ Function that returns the name of the function of a code object, prefixed by its module, e.g. 'automatedFTPDownloader.downloadFile'. """
+        module = self.moduleNames.get(code.co_filename)
+        if module is None:
+            module = os.path.splitext(os.path.basename(code.co_filename))[0]
+            self.moduleNames[code.co_filename] = module
+        return module + '.' + code.co_name
 
     def getLogPath(self):
         """
@@ -613,15 +5520,13 @@ class Logger(object):
                 return os.path.join(logFilePath, logFileName)
 
     def write(self, message):
-        if self.verbose:
-            self.terminal.write(message)
-            self.terminal.flush()
-        self.log.write(message)
+        self.enqueue(('output', message, True))
     
-    def writeLog(self, message, lineNumber, severity='normal', data=None):
+    def writeLog(self, message, severity='normal', data=None):
         """
         Function that writes out to the log file and console based on verbose.
         The function will change behavior slightly based on severity of the message.
+        The message is only queued here, it is formatted and written by the background writer.
 
         Parameters
         ----------
@@ -629,6 +5534,7 @@ class Logger(object):
                 Message to write
             - severity : str
                 Defines what the message is related to. Is the message:
+                    - [D] : A 'debug' message, only written when enabled with --log-level
                     - [N] : A 'normal' notification
                     - [W] : A 'warning'
                     - [E] : An 'error'
@@ -642,68 +5548,137 @@ class Logger(object):
                     - error : str
                         String produced by exception if an exception occured
         """
-        # Get a timestamp
-        timestamp = self.getCurrentTimestamp()
+        # Without levels per module or function, the caller is only needed for the 'logger' field of the JSON log
+        if not self.perName:
+            if LOG_LEVELS[severity] < self.defaultLevel:
+                return
+            if self.logFormat != 'json':
+                self.enqueue(('record', time.time(), severity, None, None, message, data))
+                return
+        frame = sys._getframe(1)
+        name = self.getCallerName(frame.f_code)
+        if LOG_LEVELS[severity] < self.getLevel(name):
+            return
+        lineNumber = frame.f_lineno if self.debug else None
+        self.enqueue(('record', time.time(), severity, name, lineNumber, message, data))
 
-        # Format the message based on severity
-        lineNumber = str(lineNumber)
-        if severity == 'normal':
-            indicator = '[N]'
-            toWrite = ' ' + indicator + '  |  ' + lineNumber
-            if int(lineNumber) < 100:
-                toWrite += '   | '
-            else:
-                toWrite += '  | '
-            toWrite += timestamp + ': ' + message
-        elif severity == 'warning':
-            indicator = '[W]'
-            toWrite = ' ' + indicator + '  |  ' + lineNumber
-            if int(lineNumber) < 100:
-                toWrite += '   | '
-            else:
-                toWrite += '  | '
-            toWrite += timestamp + ': ' + message
-        elif severity == 'error':
-            indicator = '[X]'
-            toWrite = ' ' + indicator + '  |  ' + lineNumber
-            if int(lineNumber) < 100:
-                toWrite += '   | '
-            else:
-                toWrite += '  | '
-            toWrite += timestamp + ': ' + message
-        elif severity == 'code-breaker':
-            indicator = '[!]'
-            toWrite = ' ' + indicator + '  |  ' + lineNumber
-            if int(lineNumber) < 100:
-                toWrite += '   | '
+    def enqueue(self, item):
+        if self.writer is not None:
+            self.queue.put(item)
+        else:
+            with self.lock:
+                self.writeItems([item])
+
+    def writeBatches(self):
+        """ Function run by the background writer, it writes whatever is queued until the logger is closed. """
+        while True:
+            items = [self.queue.get()]
+            while len(items) < self.batchSize:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if self.writeItems(items):
+                return
+
+    def writeItems(self, items):
+        """
+        Function that formats queued items and writes them with one write per output
+
+        Returns
+        -------
+            - closed : bool
+                True if the logger was closed by one of the items
+        """
+        logText = []
+        terminalText = []
+        flushed = []
+        closed = False
+        for item in items:
+            if item is None:
+                closed = True
+            elif isinstance(item, threading.Event):
+                flushed.append(item)
             else:
-                toWrite += '  | '
-            toWrite += timestamp + ': ' + message
-            
+                # A message that can't be formatted is replaced by an error, the writer keeps going
+                try:
+                    if item[0] == 'output':
+                        self.formatOutput(item[1], item[2], logText, terminalText)
+                    else:
+                        self.formatRecord(item[1:], logText, terminalText)
+                except Exception as formatError:
+                    self.formatRecord((time.time(), 'error', 'Logger', None, "A log message couldn't be formatted: {!r}".format(formatError), None), logText, terminalText)
+        try:
+            if logText:
+                if not self.headerWritten and self.logFormat == 'text':
+                    logText.insert(0, ' Ind. |LineNo.| Time stamp  : Message\n=====================================\n')
+                self.headerWritten = True
+                self.log.write(''.join(logText))
+                self.log.flush()
+            if terminalText and self.verbose:
+                self.terminal.write(''.join(terminalText))
+                self.terminal.flush()
+        except Exception:
+            # e.g. a full disk or a closed terminal, the next batch is tried again
+            pass
+        for event in flushed:
+            event.set()
+        return closed
+
+    def formatOutput(self, message, toTerminal, logText, terminalText):
+        if toTerminal:
+            terminalText.append(message)
+        if self.logFormat != 'json':
+            logText.append(message)
+            return
+        # Printed text becomes one JSON object per line
+        lines = (self.pendingOutput + message).split('\n')
+        self.pendingOutput = lines.pop()
+        for line in lines:
+            logText.append(json.dumps({'time': self.formatTime(time.time()), 'severity': 'output', 'message': line}) + '\n')
+
+    def formatRecord(self, record, logText, terminalText):
+        timestamp, severity, name, lineNumber, message, data = record
+        details = None
+        if severity == 'code-breaker' and data:
             if data['code'] == 2: # Response recieved but unsuccessful
-                details = '\n[ErrorDetailsStart]\n' + data['response'] + '\n[ErrorDetailsEnd]'
-                toWrite = toWrite + details
+                details = str(data['response'])
             elif data['code'] == 3: # YAML loading error
-                details = '\n[ErrorDetailsStart]\n' + data['error'] + '\n[ErrorDetailsEnd]'
-                toWrite = toWrite + details
-        
-        # Write out the message
-        self.log.write(toWrite + '\n')
-        if self.verbose:
-            self.terminal.write(message + '\n')
-            self.terminal.flush()
+                details = str(data['error'])
 
-    def getCurrentTimestamp(self):
+        if self.logFormat == 'json':
+            entry = {'time': self.formatTime(timestamp), 'severity': severity, 'logger': name, 'message': message}
+            if lineNumber is not None:
+                entry['line'] = lineNumber
+            if details is not None:
+                entry['details'] = details
+            logText.append(json.dumps(entry) + '\n')
+        else:
+            toWrite = ' {}  | {:^5} | {}: {}'.format(LOG_INDICATORS[severity], '' if lineNumber is None else lineNumber, self.getCurrentTimestamp(timestamp), message)
+            if details is not None:
+                toWrite += '\n[ErrorDetailsStart]\n' + details + '\n[ErrorDetailsEnd]'
+            logText.append(toWrite + '\n')
+        terminalText.append(message + '\n')
+
+    def formatTime(self, timestamp):
+        return datetime.fromtimestamp(timestamp).isoformat(timespec='milliseconds')
+
+    def getCurrentTimestamp(self, timestamp=None):
         """
         Simple function that calculates the current time stamp and simply formats it as a string and returns.
         Mainly aimed for logging.
 
+        Parameters
+        ----------
+            - timestamp : float
+                Time to format instead of the current time
+
         Returns
         -------
             - timestamp : str
                 A formatted string of current time
         """
-        return datetime.now().strftime("%H:%M:%S.%f")[:-3]
+        return (datetime.now() if timestamp is None else datetime.fromtimestamp(timestamp)).strftime("%H:%M:%S.%f")[:-3]
 
     def exceptionLogger(self, exctype, value, traceBack):
         """
@@ -718,6 +5693,7 @@ class Logger(object):
             - traceBack : traceback object
                 Contains information about the stack trace.
         """
+        import traceback
         LOGGER.write('Exception Occured! Details follow below.\n')
         LOGGER.write('Type:{}\n'.format(exctype))
         LOGGER.write('Value:{}\n'.format(value))
@@ -726,29 +5702,79 @@ class Logger(object):
             LOGGER.write(i)
 
     def flush(self):
-        # This flush method is needed for python 3 compatibility.
-        # This handles the flush command by doing nothing.
-        # You might want to specify some extra behavior here.
+        """ Function that waits until everything queued so far is written. """
+        writer = self.writer
+        if writer is None or writer is threading.current_thread() or not writer.is_alive():
+            return
+        flushed = threading.Event()
+        self.queue.put(flushed)
+        flushed.wait()
+
+    def close(self):
+        """ Function that writes what is left in the queue and stops the background writer, later messages are written directly. """
+        writer = self.writer
+        if writer is None:
+            return
+        self.queue.put(None)
+        writer.join()
+        self.writer = None
+        # Messages queued by other threads while the writer was stopping
+        items = []
+        while True:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        with self.lock:
+            self.writeItems(items)
+
+class NullLogger(object):
+    """ Stands in for the Logger until startLogging() creates it, so importing this module writes nothing. Messages are dropped. """
+    verbose = False
+
+    def write(self, message):
+        pass
+
+    def writeLog(self, message, severity='normal', data=None):
+        pass
+
+    def flush(self):
         pass
 
+def startLogging(verbose=False):
+    """
+    Function that creates the logger of the script, and makes it the destination of the console output and of uncaught exceptions
+
+    Returns
+    -------
+        - logger : Logger
+    """
+    global LOGGER
+    LOGGER = Logger(verbose)
+    sys.stdout = LOGGER
+    sys.excepthook = LOGGER.exceptionLogger
+    return LOGGER
+
 # Global variables
-PYTHON_VERSION = float(sys.version[:sys.version.index(' ')-2])
-LOGGER = Logger()
+PYTHON_VERSION = sys.version_info[:2]
+LOGGER = NullLogger()
+METRICS = RunMetrics()
+DELETER = BackgroundDeleter()
+# Content stores by directory, see getContentStore()
+CONTENT_STORES = {}
+CONTENT_STORES_LOCK = threading.Lock()
 
 # It all starts here
 if __name__ == "__main__":
     """
     Workflow:
     1. Tests to make sure you are using a minimum version of Python
-    2. Gets and parses the arguments from the command-line execution.
-    3. Creates a logger, logs in 2 places: log file and console.
+    2. Creates a logger in main(), logs in 2 places: log file and console.
+    3. Gets and parses the arguments from the command-line execution.
     """
-    sys.stdout = LOGGER
-    sys.excepthook = LOGGER.exceptionLogger
-
-    requiredPythonVersion = 3.5
+    # asyncio.get_running_loop() and queue.SimpleQueue came with 3.7, FTPS on the async engine needs 3.11
+    requiredPythonVersion = (3, 7)
     if not PYTHON_VERSION >= requiredPythonVersion:
-        LOGGER.writeLog("Must use Python version 3.5 or higher! Currently using {}.".format(PYTHON_VERSION), localFrame.f_lineno, severity='code-breaker', data={'code':1})
-        exit()
+        sys.exit("Must use Python version 3.7 or higher! Currently using {}.{}.".format(*PYTHON_VERSION))
     
     main(sys.argv[1:])
\ No newline at end of file
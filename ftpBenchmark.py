@@ -0,0 +1,746 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+FTP download benchmark
+
+Starts an FTP server on the loopback interface inside this process, generates a reproducible set of files
+for it to serve, and runs the connectToFTP/downloadFiles/unzipZippedFiles path of automatedFTPDownloader
+against it. Reports throughput, files/sec, per-file latency percentiles and peak memory, and can compare
+the results with those of an earlier run.
+"""
+
+# Help message
+HELP_MESSAGE = """
+Usage:
+    $ python3 ftpBenchmark.py [options]
+
+Parameters/Options:
+    -h  | --help            : View usage help and examples
+    -d  | --dataset         : File set to serve (default: tiny)
+        |                       - tiny     : many small CSV files
+        |                       - huge     : a few large files
+        |                       - nested   : a directory tree of small files, downloaded with the recursive mirror mode
+        |                       - archives : zip and tar archives, unzipped after downloading
+    -S  | --scale           : Multiplies the number and size of the generated files (default: 1.0)
+    -c  | --connections     : Number of connections per site (default: 1)
+    -e  | --engine          : Transfer engine, 'thread' (default) or 'async'
+    -b  | --block-size      : Transfer block size in bytes of the downloader (default: its own default)
+    -l  | --latency         : Artificial delay in milliseconds added by the server to every reply (default: 0)
+    -w  | --bandwidth       : Kilobytes per second the server sends on every data connection, to simulate a slow link
+        |                       (default: unlimited)
+    -z  | --mode-z          : MODE Z setting of the downloader, 'off' (default), 'auto' or 'on'. The server supports it,
+        |                       stream mode by default keeps the results comparable with earlier runs.
+    -t  | --tls             : Explicit FTPS (default: off), needs the openssl command to create the server's certificate
+        |                       - off     : plain FTP
+        |                       - on      : data connections resume the TLS session of the control connection
+        |                       - noreuse : a full TLS handshake on every data connection
+    -n  | --repeat          : Number of times the download is run, the best run is reported (default: 1)
+    -s  | --seed            : Seed of the generated files (default: 1)
+    -o  | --output          : Write the results to this JSON file
+    -C  | --compare         : Compare the results with a JSON file written by an earlier run
+
+Example:
+    $ python3 ftpBenchmark.py -d tiny -c 8 -l 20 -o tiny.json
+    $ python3 ftpBenchmark.py -d tiny -c 8 -l 20 --compare tiny.json
+
+    $ python3 ftpBenchmark.py -d huge -b 8192 -o small-blocks.json
+    $ python3 ftpBenchmark.py -d huge --compare small-blocks.json
+
+    $ python3 ftpBenchmark.py -d huge -S 0.1 -w 2048 -z off -o stream.json
+    $ python3 ftpBenchmark.py -d huge -S 0.1 -w 2048 -z on --compare stream.json
+
+    $ python3 ftpBenchmark.py -d tiny -c 4 -t noreuse -o handshakes.json
+    $ python3 ftpBenchmark.py -d tiny -c 4 -t on --compare handshakes.json
+"""
+
+# Imports
+import sys
+import os
+import io
+import getopt
+import json
+import random
+import shutil
+import socket
+import socketserver
+import ssl
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+
+import automatedFTPDownloader
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+DATASETS = ('tiny', 'huge', 'nested', 'archives')
+TLS_MODES = ('off', 'on', 'noreuse')
+
+""" Local FTP server starts """
+class BenchmarkFTPHandler(socketserver.StreamRequestHandler):
+    """ Serves one FTP control connection, with the commands used by the downloader. """
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        # Like real FTP servers, send replies right away: Nagle's algorithm would hold the '226' after a
+        # small transfer until the client's delayed ACK of the '150', 40 ms later
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.cwd = '/'
+        self.passiveSocket = None
+        self.restOffset = 0
+        self.mode = 'S'
+        self.protectData = False
+
+    def handle(self):
+        self.reply('220 Benchmark FTP server ready.')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.decode('utf-8', 'replace').rstrip('\r\n')
+            command, _, argument = line.partition(' ')
+            handler = getattr(self, 'command' + command.capitalize(), None)
+            if handler is None:
+                self.reply('502 Command not implemented.')
+                continue
+            if handler(argument) == 'quit':
+                return
+
+    def reply(self, text):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.wfile.write((text + '\r\n').encode('utf-8'))
+        self.wfile.flush()
+
+    def getLocalPath(self, path):
+        """ Function that maps a path of the client to the served directory, never outside of it. """
+        path = path if path.startswith('/') else self.cwd.rstrip('/') + '/' + path
+        parts = []
+        for part in path.split('/'):
+            if part == '..':
+                if parts:
+                    parts.pop()
+            elif part not in ('', '.'):
+                parts.append(part)
+        return os.path.join(self.server.root, *parts), '/' + '/'.join(parts)
+
+    def sendData(self, blocks, transferred=None):
+        """ Function that sends blocks of data over the passive data connection and returns the number of bytes sent. """
+        if self.passiveSocket is None:
+            self.reply('425 Use PASV or EPSV first.')
+            return 0
+        self.reply('150 Opening data connection.')
+        connection, _ = self.passiveSocket.accept()
+        self.passiveSocket.close()
+        self.passiveSocket = None
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.protectData:
+            try:
+                connection = self.server.tlsContext.wrap_socket(connection, server_side=True)
+            except (OSError, ssl.SSLError):
+                connection.close()
+                self.reply('425 TLS negotiation failed.')
+                return 0
+            self.server.recordHandshake(connection.session_reused)
+        if self.mode == 'Z':
+            blocks = compressBlocks(blocks)
+        sent = 0
+        startTime = time.perf_counter()
+        try:
+            for block in blocks:
+                connection.sendall(block)
+                sent += len(block)
+                if self.server.bandwidth:
+                    # Sleep until the link would have carried what was sent so far
+                    delay = sent / self.server.bandwidth - (time.perf_counter() - startTime)
+                    if delay > 0:
+                        time.sleep(delay)
+            if self.protectData:
+                connection.unwrap()
+        except (OSError, ssl.SSLError):
+            # The client may close without shutting the TLS layer down
+            pass
+        finally:
+            connection.close()
+        self.reply('226 Transfer complete.')
+        return sent
+
+    def listEntries(self, argument):
+        path, _ = self.getLocalPath(argument if argument and not argument.startswith('-') else '.')
+        if not os.path.isdir(path):
+            return path, None
+        return path, sorted(os.listdir(path))
+
+    def commandAuth(self, argument):
+        if self.server.tlsContext is None or argument.upper() not in ('TLS', 'SSL'):
+            self.reply('504 AUTH not supported.')
+            return
+        self.reply('234 Proceed with negotiation.')
+        try:
+            self.connection = self.server.tlsContext.wrap_socket(self.connection, server_side=True)
+        except (OSError, ssl.SSLError):
+            # e.g. the client doesn't trust the certificate
+            return 'quit'
+        self.rfile = self.connection.makefile('rb')
+        self.wfile = self.connection.makefile('wb')
+
+    def commandPbsz(self, argument):
+        self.reply('200 PBSZ=0')
+
+    def commandProt(self, argument):
+        if argument.upper() not in ('C', 'P'):
+            self.reply('536 Protection level not supported.')
+            return
+        self.protectData = argument.upper() == 'P'
+        self.reply('200 Protection level set.')
+
+    def commandUser(self, argument):
+        self.reply('331 Password required.')
+
+    def commandPass(self, argument):
+        self.reply('230 Logged in.')
+
+    def commandSyst(self, argument):
+        self.reply('215 UNIX Type: L8')
+
+    def commandFeat(self, argument):
+        self.wfile.write(b'211-Features:\r\n EPSV\r\n MDTM\r\n MLSD\r\n MODE Z\r\n REST STREAM\r\n SIZE\r\n UTF8\r\n')
+        self.reply('211 End')
+
+    def commandOpts(self, argument):
+        self.reply('200 OK.')
+
+    def commandType(self, argument):
+        self.reply('200 Type set.')
+
+    def commandMode(self, argument):
+        if argument.upper() in ('S', 'Z'):
+            self.mode = argument.upper()
+            self.reply('200 Mode set.')
+        else:
+            self.reply('504 Mode not supported.')
+
+    def commandNoop(self, argument):
+        self.reply('200 OK.')
+
+    def commandQuit(self, argument):
+        self.reply('221 Goodbye.')
+        return 'quit'
+
+    def commandPwd(self, argument):
+        self.reply('257 "{}"'.format(self.cwd))
+
+    def commandCwd(self, argument):
+        path, virtualPath = self.getLocalPath(argument)
+        if os.path.isdir(path):
+            self.cwd = virtualPath
+            self.reply('250 Directory changed.')
+        else:
+            self.reply('550 No such directory.')
+
+    def commandSize(self, argument):
+        path, _ = self.getLocalPath(argument)
+        if os.path.isfile(path):
+            self.reply('213 {}'.format(os.path.getsize(path)))
+        else:
+            self.reply('550 No such file.')
+
+    def commandMdtm(self, argument):
+        path, _ = self.getLocalPath(argument)
+        if os.path.isfile(path):
+            self.reply('213 ' + time.strftime('%Y%m%d%H%M%S', time.gmtime(os.path.getmtime(path))))
+        else:
+            self.reply('550 No such file.')
+
+    def commandRest(self, argument):
+        self.restOffset = int(argument)
+        self.reply('350 Restarting at {}.'.format(self.restOffset))
+
+    def openPassiveSocket(self):
+        if self.passiveSocket is not None:
+            self.passiveSocket.close()
+        self.passiveSocket = socket.socket()
+        self.passiveSocket.bind(('127.0.0.1', 0))
+        self.passiveSocket.listen(1)
+        return self.passiveSocket.getsockname()[1]
+
+    def commandPasv(self, argument):
+        port = self.openPassiveSocket()
+        self.reply('227 Entering Passive Mode (127,0,0,1,{},{}).'.format(port >> 8, port & 255))
+
+    def commandEpsv(self, argument):
+        port = self.openPassiveSocket()
+        self.reply('229 Entering Extended Passive Mode (|||{}|).'.format(port))
+
+    def commandNlst(self, argument):
+        path, names = self.listEntries(argument)
+        if names is None:
+            self.reply('550 No such directory.')
+            return
+        self.sendData([''.join(name + '\r\n' for name in names).encode('utf-8')])
+
+    def commandList(self, argument):
+        path, names = self.listEntries(argument)
+        if names is None:
+            self.reply('550 No such directory.')
+            return
+        lines = []
+        for name in names:
+            stat = os.stat(os.path.join(path, name))
+            isDirectory = os.path.isdir(os.path.join(path, name))
+            lines.append('{} 1 owner group {:>12} {} {}\r\n'.format(
+                'drwxr-xr-x' if isDirectory else '-rw-r--r--',
+                stat.st_size,
+                time.strftime('%b %d %H:%M', time.gmtime(stat.st_mtime)),
+                name,
+            ))
+        self.sendData([''.join(lines).encode('utf-8')])
+
+    def commandMlsd(self, argument):
+        path, names = self.listEntries(argument)
+        if names is None:
+            self.reply('550 No such directory.')
+            return
+        lines = []
+        for name in names:
+            entryPath = os.path.join(path, name)
+            stat = os.stat(entryPath)
+            lines.append('type={};size={};modify={}; {}\r\n'.format(
+                'dir' if os.path.isdir(entryPath) else 'file',
+                stat.st_size,
+                time.strftime('%Y%m%d%H%M%S', time.gmtime(stat.st_mtime)),
+                name,
+            ))
+        self.sendData([''.join(lines).encode('utf-8')])
+
+    def commandRetr(self, argument):
+        path, virtualPath = self.getLocalPath(argument)
+        offset, self.restOffset = self.restOffset, 0
+        if not os.path.isfile(path):
+            self.reply('550 No such file.')
+            return
+
+        def readBlocks():
+            with open(path, 'rb') as stream:
+                stream.seek(offset)
+                while True:
+                    block = stream.read(256 * 1024)
+                    if not block:
+                        return
+                    yield block
+
+        startTime = time.perf_counter()
+        sent = self.sendData(readBlocks())
+        self.server.recordTransfer(virtualPath, sent, time.perf_counter() - startTime)
+
+def compressBlocks(blocks):
+    """ Function that deflates the data of a MODE Z transfer as one zlib stream. """
+    compressor = zlib.compressobj()
+    for block in blocks:
+        block = compressor.compress(block)
+        if block:
+            yield block
+    yield compressor.flush()
+
+class BenchmarkFTPServer(socketserver.ThreadingTCPServer):
+    """ An FTP server on the loopback interface serving a local directory, run in a background thread. """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root, latency=0.0, bandwidth=None, certificate=None):
+        """
+        Parameters
+        ----------
+            - root : str
+                Directory served as the root of the FTP site
+            - latency : float
+                Seconds the server waits before every reply, to simulate a distant server
+            - bandwidth : float
+                Bytes per second sent on every data connection, unlimited if None
+            - certificate : tuple
+                (certificate, private key) files of the server, to accept AUTH TLS. See generateCertificate().
+        """
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), BenchmarkFTPHandler)
+        self.root = root
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.tlsContext = None
+        if certificate is not None:
+            self.tlsContext = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.tlsContext.load_cert_chain(*certificate)
+        self.handshakes = {'full': 0, 'resumed': 0}
+        self.transfers = []
+        self.lock = threading.Lock()
+
+    def recordTransfer(self, path, size, seconds):
+        with self.lock:
+            self.transfers.append({'path': path, 'bytes': size, 'seconds': seconds})
+
+    def recordHandshake(self, resumed):
+        with self.lock:
+            self.handshakes['resumed' if resumed else 'full'] += 1
+
+    def start(self):
+        """ Function that starts serving in a background thread and returns the port. """
+        thread = threading.Thread(target=self.serve_forever, name='ftp-server', daemon=True)
+        thread.start()
+        return self.server_address[1]
+
+def generateCertificate(directory):
+    """ Function that creates a self-signed certificate for 127.0.0.1 with the openssl command and returns (certificate, key) paths. """
+    certificatePath = os.path.join(directory, 'server.crt')
+    keyPath = os.path.join(directory, 'server.key')
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=127.0.0.1',
+         '-addext', 'subjectAltName=IP:127.0.0.1', '-keyout', keyPath, '-out', certificatePath],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    return certificatePath, keyPath
+""" Local FTP server ends """
+
+""" Dataset generation starts """
+def generateDataset(root, dataset, scale=1.0, seed=1):
+    """
+    Function that generates a reproducible set of files to serve
+
+    Parameters
+    ----------
+        - root : str
+            Directory the files are generated in
+        - dataset : str
+            One of DATASETS
+        - scale : float
+            Multiplies the number and size of the generated files
+        - seed : int
+            Seed of the random generator, the same seed always generates the same files
+
+    Returns
+    -------
+        - totalBytes : int
+            Size of all the generated files
+    """
+    randomGenerator = random.Random(seed)
+    os.makedirs(root, exist_ok=True)
+
+    if dataset == 'tiny':
+        for index in range(max(1, int(500 * scale))):
+            writeFile(os.path.join(root, 'SureDone_tiny_{:05d}.csv'.format(index)), generateCsv(randomGenerator, 2 * 1024))
+    elif dataset == 'huge':
+        for index in range(3):
+            writeFile(os.path.join(root, 'SureDone_huge_{}.csv'.format(index)), generateCsv(randomGenerator, int(64 * 1024 * 1024 * scale)))
+    elif dataset == 'nested':
+        def generateTree(path, depth):
+            os.makedirs(path, exist_ok=True)
+            for index in range(max(1, int(10 * scale))):
+                writeFile(os.path.join(path, 'export_{:03d}.csv'.format(index)), generateCsv(randomGenerator, 4 * 1024))
+            if depth:
+                for index in range(4):
+                    generateTree(os.path.join(path, 'dir_{}'.format(index)), depth - 1)
+        generateTree(root, 3)
+    elif dataset == 'archives':
+        for index in range(max(1, int(8 * scale))):
+            members = [('member_{:03d}.csv'.format(member), generateCsv(randomGenerator, 64 * 1024)) for member in range(20)]
+            with zipfile.ZipFile(os.path.join(root, 'SureDone_archive_{:03d}.zip'.format(index)), 'w', zipfile.ZIP_DEFLATED) as archive:
+                for name, data in members:
+                    archive.writestr('zip_{:03d}/{}'.format(index, name), data)
+            with tarfile.open(os.path.join(root, 'SureDone_archive_{:03d}.tar.gz'.format(index)), 'w:gz') as archive:
+                for name, data in members:
+                    info = tarfile.TarInfo('tar_{:03d}/{}'.format(index, name))
+                    info.size = len(data)
+                    info.mtime = 1500000000
+                    archive.addfile(info, io.BytesIO(data))
+    else:
+        raise ValueError("Unknown dataset '{}'".format(dataset))
+
+    totalBytes = 0
+    for directory, _, names in os.walk(root):
+        for name in names:
+            totalBytes += os.path.getsize(os.path.join(directory, name))
+    return totalBytes
+
+def generateCsv(randomGenerator, size):
+    """ Function that generates about `size` bytes of CSV rows, compressible like real vendor exports. """
+    words = ['widget', 'gadget', 'sprocket', 'bolt', 'nut', 'washer', 'gear', 'spring', 'valve', 'bracket']
+    rows = ['sku,title,price,quantity,updated\n']
+    length = len(rows[0])
+    while length < size:
+        row = '{:08d},{} {} {},{}.{:02d},{},2026-{:02d}-{:02d}\n'.format(
+            randomGenerator.randrange(10 ** 8),
+            randomGenerator.choice(words), randomGenerator.choice(words), randomGenerator.choice(words),
+            randomGenerator.randrange(1000), randomGenerator.randrange(100),
+            randomGenerator.randrange(500),
+            randomGenerator.randrange(1, 13), randomGenerator.randrange(1, 29),
+        )
+        rows.append(row)
+        length += len(row)
+    return ''.join(rows).encode('ascii')[:size]
+
+def writeFile(path, data):
+    with open(path, 'wb') as stream:
+        stream.write(data)
+    # A fixed modify time keeps the listings identical between runs
+    os.utime(path, (1500000000, 1500000000))
+""" Dataset generation ends """
+
+""" Benchmark starts """
+def runBenchmark(dataset='tiny', scale=1.0, connections=1, engine='thread', latency=0.0, repeat=1, seed=1, blockSize=None, bandwidth=None, modeZ='off', tls='off'):
+    """
+    Function that serves a generated dataset and downloads it with automatedFTPDownloader
+
+    Parameters
+    ----------
+        - dataset : str
+            One of DATASETS
+        - scale : float
+            Multiplies the number and size of the generated files
+        - connections : int
+            Number of connections per site
+        - engine : str
+            'thread' or 'async'
+        - latency : float
+            Seconds the server waits before every reply
+        - repeat : int
+            Number of times the download is run, the fastest run is reported
+        - seed : int
+            Seed of the generated files
+        - blockSize : int
+            Transfer block size of the downloader, its default if None
+        - bandwidth : float
+            Bytes per second the server sends on every data connection, unlimited if None
+        - modeZ : str
+            'mode_z' setting of the downloader
+        - tls : str
+            One of TLS_MODES
+
+    Returns
+    -------
+        - results : dict
+            Parameters and measurements of the fastest run
+    """
+    workDirectory = tempfile.mkdtemp(prefix='ftpBenchmark_')
+    try:
+        serverRoot = os.path.join(workDirectory, 'server')
+        datasetBytes = generateDataset(os.path.join(serverRoot, 'export'), dataset, scale, seed)
+        certificate = generateCertificate(workDirectory) if tls != 'off' else None
+        server = BenchmarkFTPServer(serverRoot, latency=latency, bandwidth=bandwidth, certificate=certificate)
+        port = server.start()
+        siteConfig = {
+            'site': '127.0.0.1',
+            'port': port,
+            'user': 'benchmark',
+            'password': 'benchmark',
+            'remote_path': '/export',
+            'connections': connections,
+            'incremental': False,
+            'block_size': blockSize or automatedFTPDownloader.DEFAULT_BLOCK_SIZE,
+            'mode_z': modeZ,
+        }
+        if tls != 'off':
+            siteConfig.update({'tls': True, 'tls_ca_file': certificate[0], 'tls_session_reuse': tls == 'on'})
+
+        runs = []
+        for run in range(max(1, repeat)):
+            outputDirectory = os.path.join(workDirectory, 'output_{}'.format(run))
+            os.makedirs(outputDirectory)
+            with server.lock:
+                server.transfers = []
+                server.handshakes = {'full': 0, 'resumed': 0}
+            runs.append(downloadDataset(siteConfig, outputDirectory, dataset, engine, server))
+            shutil.rmtree(outputDirectory, ignore_errors=True)
+        server.shutdown()
+        server.server_close()
+    finally:
+        shutil.rmtree(workDirectory, ignore_errors=True)
+
+    results = min(runs, key=lambda run: run['seconds'])
+    results.update({
+        'dataset': dataset,
+        'scale': scale,
+        'connections': connections,
+        'engine': engine,
+        'blockSize': siteConfig['block_size'],
+        'latencyMs': latency * 1000,
+        'bandwidthKBps': bandwidth / 1024 if bandwidth else None,
+        'modeZ': modeZ,
+        'tls': tls,
+        'seed': seed,
+        'datasetBytes': datasetBytes,
+        'peakRssMb': getPeakRssMb(),
+    })
+    return results
+
+def downloadDataset(siteConfig, outputDirectory, dataset, engine, server):
+    """
+    Function that runs one download of the served dataset and measures it
+
+    Returns
+    -------
+        - measurements : dict
+            Duration, throughput and per-file latencies of the run
+    """
+    recursive = dataset == 'nested'
+    automatedFTPDownloader.METRICS.reset()
+    cpuStart = time.process_time()
+    startTime = time.perf_counter()
+    if engine == 'async':
+        downloadedFiles = automatedFTPDownloader.runSitesAsync(['benchmark'], {'benchmark': siteConfig}, outputDirectory, False, {'workers': 1, 'recursive': recursive})
+    else:
+        downloadedFiles = automatedFTPDownloader.connectToFTP(siteConfig, 'benchmark', outputDirectory, recursive=recursive)
+    downloadSeconds = time.perf_counter() - startTime
+    if dataset == 'archives':
+        automatedFTPDownloader.unzipZippedFiles(outputDirectory, downloadedFiles)
+    seconds = time.perf_counter() - startTime
+    cpuSeconds = time.process_time() - cpuStart
+
+    with server.lock:
+        transfers = list(server.transfers)
+        handshakes = dict(server.handshakes)
+    # What the server sent, deflated with MODE Z, and what the downloader wrote
+    wireBytes = sum(transfer['bytes'] for transfer in transfers)
+    transferSpans = [span for span in automatedFTPDownloader.METRICS.getReport()['spans'] if span['phase'] == 'transfer']
+    transferredBytes = sum(span.get('bytes', 0) for span in transferSpans)
+    # Latencies are measured by the downloader, from sending RETR to the end of the file
+    latencies = sorted(span['seconds'] for span in transferSpans)
+    return {
+        'files': len(downloadedFiles),
+        'bytes': transferredBytes,
+        'wireBytes': wireBytes,
+        'wireMb': wireBytes / 1048576,
+        'fullHandshakes': handshakes['full'],
+        'resumedHandshakes': handshakes['resumed'],
+        'seconds': seconds,
+        'downloadSeconds': downloadSeconds,
+        'cpuSeconds': cpuSeconds,
+        'throughputMBps': transferredBytes / 1048576 / downloadSeconds if downloadSeconds else 0.0,
+        'filesPerSecond': len(downloadedFiles) / downloadSeconds if downloadSeconds else 0.0,
+        'cpuSecondsPerGB': cpuSeconds / (transferredBytes / 1073741824) if transferredBytes else 0.0,
+        'p50LatencyMs': getPercentile(latencies, 50) * 1000,
+        'p99LatencyMs': getPercentile(latencies, 99) * 1000,
+    }
+
+def getPercentile(values, percentile):
+    """ Function that returns the nearest-rank percentile of sorted values, 0 if there are none. """
+    if not values:
+        return 0.0
+    rank = max(0, min(len(values) - 1, int(round(percentile / 100.0 * len(values) + 0.5)) - 1))
+    return values[rank]
+
+def getPeakRssMb():
+    """ Function that returns the peak resident memory of the process in MB, None where it can't be measured. """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1048576.0 if sys.platform == 'darwin' else 1024.0)
+
+REPORTED_METRICS = [
+    ('seconds', 'Total time', 's', False),
+    ('wireMb', 'Bytes on the wire', 'MB', False),
+    ('throughputMBps', 'Throughput', 'MB/s', True),
+    ('filesPerSecond', 'Files/sec', '', True),
+    ('p50LatencyMs', 'p50 per-file latency', 'ms', False),
+    ('p99LatencyMs', 'p99 per-file latency', 'ms', False),
+    ('cpuSecondsPerGB', 'CPU time per GB', 's', False),
+    ('peakRssMb', 'Peak RSS', 'MB', False),
+]
+
+def printResults(results, previous=None):
+    """
+    Function that prints the results of a benchmark, with the change from a previous run if given
+
+    Parameters
+    ----------
+        - results : dict
+            Results of runBenchmark()
+        - previous : dict
+            Results of an earlier runBenchmark() to compare with
+    """
+    print ("Dataset: {} (scale {}, {} bytes), engine: {}, connections: {}, block size: {}, latency: {} ms, bandwidth: {}, MODE Z: {}".format(
+        results['dataset'], results['scale'], results['datasetBytes'], results['engine'], results['connections'], results.get('blockSize'), results['latencyMs'],
+        '{} KB/s'.format(results['bandwidthKBps']) if results.get('bandwidthKBps') else 'unlimited', results.get('modeZ', 'off')))
+    print ("Files downloaded: {}, bytes transferred: {}, bytes on the wire: {}".format(results['files'], results['bytes'], results.get('wireBytes', results['bytes'])))
+    if results.get('tls', 'off') != 'off':
+        print ("FTPS ({}): {} full and {} resumed TLS handshakes on data connections".format(results['tls'], results['fullHandshakes'], results['resumedHandshakes']))
+    for key, label, unit, higherIsBetter in REPORTED_METRICS:
+        value = results.get(key)
+        if value is None:
+            continue
+        line = "\t{:<24}{:>12.3f} {}".format(label + ':', value, unit)
+        if previous and previous.get(key):
+            change = (value - previous[key]) / previous[key] * 100
+            better = change > 0 if higherIsBetter else change < 0
+            line += "\t({:+.1f}% vs {:.3f}, {})".format(change, previous[key], 'better' if better else 'worse')
+        print (line)
+
+def main(argv):
+    options = "hd:S:c:e:b:l:w:z:t:n:s:o:C:"
+    long_options = ["help", "dataset=", "scale=", "connections=", "engine=", "block-size=", "latency=", "bandwidth=", "mode-z=", "tls=", "repeat=", "seed=", "output=", "compare="]
+    try:
+        opts, args = getopt.getopt(argv, options, long_options)
+    except getopt.GetoptError:
+        print ("Error in arguments!")
+        print (HELP_MESSAGE)
+        sys.exit(2)
+
+    settings = {'dataset': 'tiny', 'scale': 1.0, 'connections': 1, 'engine': 'thread', 'latency': 0.0, 'repeat': 1, 'seed': 1}
+    outputPath = None
+    comparePath = None
+    for option, value in opts:
+        if option in ("-h", "--help"):
+            print (HELP_MESSAGE)
+            sys.exit()
+        elif option in ("-d", "--dataset"):
+            if value not in DATASETS:
+                print ("Dataset must be one of {}".format(', '.join(DATASETS)))
+                sys.exit(2)
+            settings['dataset'] = value
+        elif option in ("-S", "--scale"):
+            settings['scale'] = float(value)
+        elif option in ("-c", "--connections"):
+            settings['connections'] = int(value)
+        elif option in ("-e", "--engine"):
+            settings['engine'] = value
+        elif option in ("-b", "--block-size"):
+            settings['blockSize'] = int(value)
+        elif option in ("-l", "--latency"):
+            settings['latency'] = float(value) / 1000
+        elif option in ("-w", "--bandwidth"):
+            settings['bandwidth'] = float(value) * 1024
+        elif option in ("-z", "--mode-z"):
+            if value not in ('auto', 'on', 'off'):
+                print ("MODE Z must be one of auto, on, off")
+                sys.exit(2)
+            settings['modeZ'] = value
+        elif option in ("-t", "--tls"):
+            if value not in TLS_MODES:
+                print ("TLS must be one of {}".format(', '.join(TLS_MODES)))
+                sys.exit(2)
+            settings['tls'] = value
+        elif option in ("-n", "--repeat"):
+            settings['repeat'] = int(value)
+        elif option in ("-s", "--seed"):
+            settings['seed'] = int(value)
+        elif option in ("-o", "--output"):
+            outputPath = value
+        elif option in ("-C", "--compare"):
+            comparePath = value
+
+    previous = None
+    if comparePath:
+        with open(comparePath, 'r') as stream:
+            previous = json.load(stream)
+
+    results = runBenchmark(**settings)
+    printResults(results, previous)
+    if outputPath:
+        with open(outputPath, 'w') as stream:
+            json.dump(results, stream, indent=2, sort_keys=True)
+""" Benchmark ends """
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,404 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Tests of automatedFTPDownloader
+
+The download tests serve generated files with the benchmark's FTP server on the loopback interface and
+check what the downloader wrote. Run with:
+    $ python3 -m pytest test_automatedFTPDownloader.py
+"""
+
+# Imports
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import automatedFTPDownloader
+from automatedFTPDownloader import RemoteEntry
+import ftpBenchmark
+
+""" Local FTP server starts """
+class RecordingFTPHandler(ftpBenchmark.BenchmarkFTPHandler):
+    """ The benchmark's handler, recording the MODE and REST commands it receives. """
+    def commandMode(self, argument):
+        self.server.recordCommand('MODE ' + argument.upper())
+        ftpBenchmark.BenchmarkFTPHandler.commandMode(self, argument)
+
+    def commandRest(self, argument):
+        self.server.recordCommand('REST ' + argument)
+        ftpBenchmark.BenchmarkFTPHandler.commandRest(self, argument)
+
+class NoModeZFeatHandler(RecordingFTPHandler):
+    """ A server that supports MODE Z without listing it in FEAT. """
+    def commandFeat(self, argument):
+        self.wfile.write(b'211-Features:\r\n EPSV\r\n MDTM\r\n MLSD\r\n REST STREAM\r\n SIZE\r\n')
+        self.reply('211 End')
+
+class NoModeZHandler(NoModeZFeatHandler):
+    """ A server that refuses MODE Z. """
+    def commandMode(self, argument):
+        if argument.upper() == 'Z':
+            self.server.recordCommand('MODE Z')
+            self.reply('504 Mode not supported.')
+            return
+        RecordingFTPHandler.commandMode(self, argument)
+
+class RecordingFTPServer(ftpBenchmark.BenchmarkFTPServer):
+    """ The benchmark's server with a choice of handler, keeping the commands the handler records. """
+    def __init__(self, root, handler=RecordingFTPHandler):
+        ftpBenchmark.BenchmarkFTPServer.__init__(self, root)
+        self.RequestHandlerClass = handler
+        self.commands = []
+
+    def recordCommand(self, command):
+        with self.lock:
+            self.commands.append(command)
+""" Local FTP server ends """
+
+""" Download tests starts """
+class DownloadTestCase(unittest.TestCase):
+    """ Serves a few generated CSV files and downloads them into a temporary directory. """
+    handler = RecordingFTPHandler
+
+    def setUp(self):
+        self.workDirectory = tempfile.mkdtemp(prefix='test_automatedFTPDownloader_')
+        self.addCleanup(shutil.rmtree, self.workDirectory, ignore_errors=True)
+        # Keep the manifests, index and run database of the tests out of the user's state directory
+        environment = mock.patch.dict(os.environ, {'HOME': self.workDirectory, 'LOCALAPPDATA': self.workDirectory})
+        environment.start()
+        self.addCleanup(environment.stop)
+
+        self.serverRoot = os.path.join(self.workDirectory, 'server')
+        ftpBenchmark.generateDataset(os.path.join(self.serverRoot, 'export'), 'tiny', scale=0.01)
+        self.remoteFiles = {}
+        for name in os.listdir(os.path.join(self.serverRoot, 'export')):
+            with open(os.path.join(self.serverRoot, 'export', name), 'rb') as stream:
+                self.remoteFiles[name] = stream.read()
+        self.server = RecordingFTPServer(self.serverRoot, self.handler)
+        self.port = self.server.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.outputDirectory = os.path.join(self.workDirectory, 'output')
+        os.makedirs(self.outputDirectory)
+        automatedFTPDownloader.METRICS.reset()
+
+    def getSiteConfig(self, **options):
+        siteConfig = {
+            'site': '127.0.0.1',
+            'port': self.port,
+            'user': 'test',
+            'password': 'test',
+            'remote_path': '/export',
+            'incremental': False,
+            'retries': 0,
+        }
+        siteConfig.update(options)
+        return siteConfig
+
+    def download(self, engine='thread', **options):
+        """ Function that downloads the served files and returns the paths the downloader reports. """
+        siteConfig = self.getSiteConfig(**options)
+        if engine == 'async':
+            return automatedFTPDownloader.runSitesAsync(['test'], {'test': siteConfig}, self.outputDirectory, False, {'workers': 1})
+        return automatedFTPDownloader.connectToFTP(siteConfig, 'test', self.outputDirectory)
+
+    def assertDownloaded(self, downloadedFiles):
+        """ Function that checks every served file was downloaded whole, and nothing else. """
+        self.assertEqual(sorted(os.path.basename(path) for path in downloadedFiles), sorted(self.remoteFiles))
+        written = {}
+        for directory, _, names in os.walk(self.outputDirectory):
+            for name in names:
+                with open(os.path.join(directory, name), 'rb') as stream:
+                    written[name] = stream.read()
+        self.assertEqual(written, self.remoteFiles)
+
+    def getWireBytes(self):
+        """ Function that returns the number of bytes the server sent for the downloaded files. """
+        with self.server.lock:
+            return sum(transfer['bytes'] for transfer in self.server.transfers)
+
+class ModeZTest(DownloadTestCase):
+    def test_stream_mode(self):
+        for engine in ('thread', 'async'):
+            with self.subTest(engine=engine):
+                shutil.rmtree(self.outputDirectory)
+                os.makedirs(self.outputDirectory)
+                with self.server.lock:
+                    self.server.transfers = []
+                    self.server.commands = []
+                self.assertDownloaded(self.download(engine, mode_z='off'))
+                self.assertNotIn('MODE Z', self.server.commands)
+                self.assertEqual(self.getWireBytes(), sum(len(data) for data in self.remoteFiles.values()))
+
+    def test_mode_z_on_and_auto(self):
+        for engine in ('thread', 'async'):
+            for setting in ('on', 'auto'):
+                with self.subTest(engine=engine, mode_z=setting):
+                    shutil.rmtree(self.outputDirectory)
+                    os.makedirs(self.outputDirectory)
+                    with self.server.lock:
+                        self.server.transfers = []
+                        self.server.commands = []
+                    self.assertDownloaded(self.download(engine, mode_z=setting))
+                    self.assertIn('MODE Z', self.server.commands)
+                    # The generated CSV files deflate well
+                    self.assertLess(self.getWireBytes(), sum(len(data) for data in self.remoteFiles.values()) / 2)
+
+    def test_mode_z_resumes_part_file(self):
+        name = sorted(self.remoteFiles)[0]
+        data = self.remoteFiles[name]
+        offset = len(data) // 3
+        with open(os.path.join(self.outputDirectory, name + '.part'), 'wb') as stream:
+            stream.write(data[:offset])
+        self.assertDownloaded(self.download(mode_z='on'))
+        self.assertIn('REST {}'.format(offset), self.server.commands)
+        self.assertIn('MODE Z', self.server.commands)
+
+class ModeZFallbackTest(DownloadTestCase):
+    handler = NoModeZFeatHandler
+
+    def test_auto_needs_feat(self):
+        for engine in ('thread', 'async'):
+            with self.subTest(engine=engine):
+                shutil.rmtree(self.outputDirectory)
+                os.makedirs(self.outputDirectory)
+                self.assertDownloaded(self.download(engine, mode_z='auto'))
+                self.assertNotIn('MODE Z', self.server.commands)
+
+class ModeZRefusedTest(DownloadTestCase):
+    handler = NoModeZHandler
+
+    def test_on_falls_back_to_stream(self):
+        for engine in ('thread', 'async'):
+            with self.subTest(engine=engine):
+                shutil.rmtree(self.outputDirectory)
+                os.makedirs(self.outputDirectory)
+                with self.server.lock:
+                    self.server.transfers = []
+                self.assertDownloaded(self.download(engine, mode_z='on'))
+                self.assertIn('MODE Z', self.server.commands)
+                self.assertEqual(self.getWireBytes(), sum(len(data) for data in self.remoteFiles.values()))
+""" Download tests ends """
+
+""" Work queue tests starts """
+class WorkQueueTest(unittest.TestCase):
+    def test_close_with_queued_tasks(self):
+        workQueue = automatedFTPDownloader.WorkQueue(1, name='test')
+        started = threading.Event()
+        release = threading.Event()
+        ran = []
+
+        def block():
+            started.set()
+            release.wait(5)
+
+        workQueue.submit(block)
+        self.assertTrue(started.wait(5))
+        for size in (10, 30, 20):
+            workQueue.submit(ran.append, size, priority=automatedFTPDownloader.getDownloadPriority(RemoteEntry(str(size), 'file', size, None)))
+        workQueue.submit(ran.append, 'listing')
+        # The tasks are still queued when the workers are told to stop
+        threading.Timer(0.1, release.set).start()
+        workQueue.close()
+        self.assertEqual(ran, ['listing', 30, 20, 10])
+""" Work queue tests ends """
+
+""" Logger tests starts """
+class LoggerTest(unittest.TestCase):
+    def setUp(self):
+        self.workDirectory = tempfile.mkdtemp(prefix='test_automatedFTPDownloader_')
+        self.addCleanup(shutil.rmtree, self.workDirectory, ignore_errors=True)
+        environment = mock.patch.dict(os.environ, {'HOME': self.workDirectory, 'USERPROFILE': self.workDirectory})
+        environment.start()
+        self.addCleanup(environment.stop)
+
+    def readLog(self, logger):
+        logger.close()
+        logger.log.close()
+        with open(logger.log.name, 'r') as stream:
+            content = stream.read()
+        # The log file is named after the current second, the next logger would append to it
+        os.remove(logger.log.name)
+        return content
+
+    def test_messages_after_a_bad_one_are_written(self):
+        for logFormat in ('text', 'json'):
+            with self.subTest(logFormat=logFormat):
+                logger = automatedFTPDownloader.Logger(logFormat=logFormat)
+                logger.writeLog("Config couldn't be loaded", severity='code-breaker', data={'code': 3, 'error': ValueError('bad indentation')})
+                logger.writeLog(object(), severity='warning')
+                logger.writeLog('Still logging')
+                log = self.readLog(logger)
+                self.assertIn('bad indentation', log)
+                self.assertIn("couldn't be formatted", log)
+                self.assertIn('Still logging', log)
+""" Logger tests ends """
+
+""" Parser tests starts """
+class ParseListLineTest(unittest.TestCase):
+    def test_unix_file_with_year(self):
+        entry = automatedFTPDownloader.parseListLine('-rw-r--r--   1 owner group     12345 Jan 31  2024 export.csv')
+        self.assertEqual(entry, RemoteEntry('export.csv', 'file', 12345, '20240131000000'))
+
+    def test_unix_directory_with_time(self):
+        entry = automatedFTPDownloader.parseListLine('drwxr-xr-x 2 owner group 4096 Mar  5 06:30 archive')
+        self.assertEqual((entry.name, entry.type, entry.size), ('archive', 'dir', 4096))
+        self.assertTrue(entry.modify.endswith('0305063000'))
+
+    def test_unix_name_with_spaces_and_link(self):
+        self.assertEqual(automatedFTPDownloader.parseListLine('-rw-r--r-- 1 owner group 10 Jan 01 2020 my file.csv').name, 'my file.csv')
+        entry = automatedFTPDownloader.parseListLine('lrwxrwxrwx 1 owner group 10 Jan 01 2020 latest.csv -> export.csv')
+        self.assertEqual((entry.name, entry.type), ('latest.csv', None))
+
+    def test_dos(self):
+        self.assertEqual(
+            automatedFTPDownloader.parseListLine('01-31-24  06:30PM             12345 export.csv'),
+            RemoteEntry('export.csv', 'file', 12345, '20240131183000'),
+        )
+        self.assertEqual(
+            automatedFTPDownloader.parseListLine('12-01-1999  12:05AM       <DIR>          old'),
+            RemoteEntry('old', 'dir', None, '19991201000500'),
+        )
+
+    def test_unknown_format(self):
+        self.assertIsNone(automatedFTPDownloader.parseListLine('total 24'))
+        self.assertIsNone(automatedFTPDownloader.parseListLine('export.csv'))
+
+class ParseMlsdFactsTest(unittest.TestCase):
+    def test_file(self):
+        entry = automatedFTPDownloader.parseMlsdFacts('export.csv', {'type': 'file', 'size': '42', 'modify': '20240131063000.123'})
+        self.assertEqual(entry, RemoteEntry('export.csv', 'file', 42, '20240131063000'))
+
+    def test_directory_and_missing_facts(self):
+        self.assertEqual(automatedFTPDownloader.parseMlsdFacts('sub', {'type': 'dir', 'sizd': '4096'}), RemoteEntry('sub', 'dir', 4096, None))
+        self.assertEqual(automatedFTPDownloader.parseMlsdFacts('odd', {'type': 'OS.unix=slink', 'size': '?'}), RemoteEntry('odd', None, None, None))
+
+    def test_current_and_parent_directory(self):
+        self.assertIsNone(automatedFTPDownloader.parseMlsdFacts('.', {'type': 'cdir'}))
+        self.assertIsNone(automatedFTPDownloader.parseMlsdFacts('..', {'type': 'pdir'}))
+        self.assertIsNone(automatedFTPDownloader.parseMlsdFacts('..', {}))
+
+class ParseChecksumFileTest(unittest.TestCase):
+    digest = 'f' * 63 + '0'
+
+    def test_bare_digest(self):
+        self.assertEqual(automatedFTPDownloader.parseChecksumFile(self.digest.upper() + '\n', 'export.csv', 'sha256'), self.digest)
+
+    def test_sha256sum_lines(self):
+        text = '{}  other.csv\n{}  export.csv\n'.format('0' * 64, self.digest)
+        self.assertEqual(automatedFTPDownloader.parseChecksumFile(text, 'sub/export.csv', 'sha256'), self.digest)
+
+    def test_bsd_line(self):
+        self.assertEqual(automatedFTPDownloader.parseChecksumFile('SHA256 (export.csv) = {}'.format(self.digest), 'export.csv', 'sha256'), self.digest)
+
+    def test_no_digest_for_the_file(self):
+        text = '{}  other.csv\n{}  another.csv\n'.format('0' * 64, self.digest)
+        self.assertIsNone(automatedFTPDownloader.parseChecksumFile(text, 'export.csv', 'sha256'))
+        # A digest of another length isn't one of this algorithm
+        self.assertIsNone(automatedFTPDownloader.parseChecksumFile('d41d8cd98f00b204e9800998ecf8427e', 'export.csv', 'sha256'))
+
+class ParseHashReplyTest(unittest.TestCase):
+    def test_hash(self):
+        digest = 'AB' * 32
+        self.assertEqual(automatedFTPDownloader.parseHashReply('HASH', 'sha256', '213 SHA-256 0-49 {} export.csv'.format(digest)), digest.lower())
+        self.assertIsNone(automatedFTPDownloader.parseHashReply('HASH', 'sha256', '213 SHA-256 0-49'))
+
+    def test_xcrc_and_xmd5(self):
+        self.assertEqual(automatedFTPDownloader.parseHashReply('XCRC', 'crc32', '250 1A2B3C'), '001a2b3c')
+        self.assertEqual(automatedFTPDownloader.parseHashReply('XMD5', 'md5', '250 D41D8CD98F00B204E9800998ECF8427E'), 'd41d8cd98f00b204e9800998ecf8427e')
+        self.assertIsNone(automatedFTPDownloader.parseHashReply('XMD5', 'md5', '250 OK'))
+
+class ListingFilterTest(unittest.TestCase):
+    entries = [
+        RemoteEntry('export_20240101.csv', 'file', 100, '20240101000000'),
+        RemoteEntry('export_20240102.csv', 'file', 100, '20240102000000'),
+        RemoteEntry('export_20240103.csv', 'file', 5, '20240103000000'),
+        RemoteEntry('readme.txt', 'file', None, None),
+        RemoteEntry('archive', 'dir', None, None),
+        RemoteEntry('archive/export_20231231.csv', 'file', 100, '20231231000000'),
+    ]
+
+    def getNames(self, entries):
+        return sorted(entry.name for entry in entries)
+
+    def test_no_rules(self):
+        kept, excluded = automatedFTPDownloader.ListingFilter().apply(self.entries)
+        self.assertEqual((kept, excluded), (self.entries, []))
+
+    def test_include_and_exclude(self):
+        kept, excluded = automatedFTPDownloader.ListingFilter(include=['*.csv'], exclude=['re:20240102']).apply(self.entries)
+        self.assertEqual(self.getNames(kept), ['archive', 'archive/export_20231231.csv', 'export_20240101.csv', 'export_20240103.csv'])
+        self.assertEqual(self.getNames(excluded), ['export_20240102.csv', 'readme.txt'])
+
+    def test_size_and_modify_time(self):
+        kept, excluded = automatedFTPDownloader.ListingFilter(minSize=10, modifiedSince='20240101000000').apply(self.entries)
+        # Files the listing gave no size or modify time for are kept
+        self.assertEqual(self.getNames(kept), ['archive', 'export_20240101.csv', 'export_20240102.csv', 'readme.txt'])
+        self.assertEqual(self.getNames(excluded), ['archive/export_20231231.csv', 'export_20240103.csv'])
+
+    def test_newest_per_pattern(self):
+        kept, excluded = automatedFTPDownloader.ListingFilter(newestPerPattern=1).apply(self.entries)
+        # Every directory keeps its own latest file
+        self.assertEqual(self.getNames(kept), ['archive', 'archive/export_20231231.csv', 'export_20240103.csv', 'readme.txt'])
+        self.assertEqual(self.getNames(excluded), ['export_20240101.csv', 'export_20240102.csv'])
+
+class ParseDurationAndSizeTest(unittest.TestCase):
+    def test_duration(self):
+        self.assertEqual(automatedFTPDownloader.parseDuration(90), 90)
+        self.assertEqual(automatedFTPDownloader.parseDuration('36h'), 36 * 3600)
+        self.assertEqual(automatedFTPDownloader.parseDuration(' 7D '), 7 * 86400)
+        self.assertEqual(automatedFTPDownloader.parseDuration('1.5m'), 90)
+        self.assertIsNone(automatedFTPDownloader.parseDuration(None))
+        for value in ('', '7 days', '-1h', 'h'):
+            with self.subTest(value=value):
+                self.assertRaises(ValueError, automatedFTPDownloader.parseDuration, value)
+
+    def test_size(self):
+        self.assertEqual(automatedFTPDownloader.parseSize(1048576), 1048576)
+        self.assertEqual(automatedFTPDownloader.parseSize('500M'), 500 * 1024 ** 2)
+        self.assertEqual(automatedFTPDownloader.parseSize('20 GiB'), 20 * 1024 ** 3)
+        self.assertEqual(automatedFTPDownloader.parseSize('1.5kb'), 1536)
+        self.assertIsNone(automatedFTPDownloader.parseSize(None))
+        for value in ('', '10 bytes', '5P'):
+            with self.subTest(value=value):
+                self.assertRaises(ValueError, automatedFTPDownloader.parseSize, value)
+
+class SelectExpiredFilesTest(unittest.TestCase):
+    now = 1000000.0
+    # The most recently downloaded first, as DownloadIndex.getFiles() returns them
+    files = [
+        ('/downloads/c.csv', 300, now - 60),
+        ('/downloads/b.csv', None, now - 3600),
+        ('/downloads/a.csv', 100, now - 86400 * 10),
+    ]
+
+    def select(self, maxAge=None, maxFiles=None, maxSize=None, keep=()):
+        policy = {'maxAge': maxAge, 'maxFiles': maxFiles, 'maxSize': maxSize}
+        return automatedFTPDownloader.selectExpiredFiles(self.files, policy, now=self.now, keep=keep)
+
+    def test_max_age(self):
+        self.assertEqual(self.select(maxAge=86400), [('/downloads/a.csv', 100)])
+
+    def test_max_files(self):
+        self.assertEqual(self.select(maxFiles=1), [('/downloads/b.csv', 0), ('/downloads/a.csv', 100)])
+
+    def test_max_size(self):
+        self.assertEqual(self.select(maxSize=400), [])
+        self.assertEqual(self.select(maxSize=350), [('/downloads/a.csv', 100)])
+        # The oldest files go first, a newer file is never expired while an older one is kept
+        self.assertEqual(self.select(maxSize=250), [('/downloads/c.csv', 300), ('/downloads/b.csv', 0), ('/downloads/a.csv', 100)])
+
+    def test_keep_files_of_the_run(self):
+        self.assertEqual(self.select(maxSize=250, keep={'/downloads/c.csv'}), [('/downloads/b.csv', 0), ('/downloads/a.csv', 100)])
+        self.assertEqual(self.select(maxFiles=1, keep={'/downloads/c.csv', '/downloads/b.csv'}), [('/downloads/a.csv', 100)])
+
+    def test_keep_everything(self):
+        self.assertEqual(self.select(), [])
+        self.assertEqual(self.select(maxAge=86400 * 30, maxFiles=3, maxSize=1000), [])
+""" Parser tests ends """
+
+if __name__ == "__main__":
+    unittest.main()